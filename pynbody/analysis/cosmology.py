@@ -3,12 +3,13 @@ Functions for common cosmological calculations.
 
 """
 
+import functools
 import math
 
 import numpy as np
 import scipy
 import scipy.integrate
-from scipy.interpolate import interp1d
+from scipy.interpolate import CubicSpline
 
 from .. import units
 from ..array import SimArray
@@ -138,6 +139,76 @@ def _test_rate_linear_growth(f, z=None, unit='h Gyr^-1'):
     return db / dt
 
 
+class CosmologyTable:
+    """Tabulated age and conformal time as a function of expansion factor, for a given cosmology
+
+    Rather than integrating the Friedmann equation for each redshift, the forward (scalefactor to time) and inverse
+    (time to scalefactor) transformations are interpolated with cubic splines in log space. The table covers
+    expansion factors between 0.001 and 1 with the number of points given by the configuration parameter
+    'cosmo-interpolation-points'; outside that range, NaN is returned.
+
+    Times are in units of (100 km s^-1 Mpc^-1)^-1, i.e. in units of the Hubble time for h=1. Tables are normally
+    obtained from :func:`get_cosmology_table`, which caches one table per cosmology.
+    """
+
+    def __init__(self, h0, omegaM0, omegaL0, num_points=None):
+        if num_points is None:
+            num_points = _interp_points
+
+        self._log_a = np.linspace(math.log(1.e-3), 0.0, num_points)
+        a = np.exp(self._log_a)
+        args = (h0, omegaM0, omegaL0)
+
+        # integrate segment by segment, so that each point is as accurate as a direct calculation
+        age_segments = [scipy.integrate.quad(_a_dot_recip, a0, a1, args)[0] for a0, a1 in zip(a[:-1], a[1:])]
+        age = scipy.integrate.quad(_a_dot_recip, 0, a[0], args)[0] + np.concatenate(([0.0], np.cumsum(age_segments)))
+
+        tau_segments = [scipy.integrate.quad(_da_dtau_recip, a0, a1, args)[0] for a0, a1 in zip(a[:-1], a[1:])]
+        tau = np.concatenate(([0.0], np.cumsum(tau_segments)))
+        tau -= tau[-1] # conformal time is measured from a=1
+
+        self._log_age = np.log(age)
+        self._log_age_from_log_a = CubicSpline(self._log_a, self._log_age, extrapolate=False)
+        self._log_a_from_log_age = CubicSpline(self._log_age, self._log_a, extrapolate=False)
+        self._tau_from_log_a = CubicSpline(self._log_a, tau, extrapolate=False)
+
+    @staticmethod
+    def _log(x):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(np.asarray(x, dtype=float))
+
+    def age(self, a):
+        """Return the age of the universe at expansion factor(s) a"""
+        return np.exp(self._log_age_from_log_a(self._log(a)))
+
+    def tau(self, a):
+        """Return the conformal time (relative to a=1) at expansion factor(s) a"""
+        return self._tau_from_log_a(self._log(a))
+
+    def scalefactor(self, age):
+        """Return the expansion factor at which the universe has the specified age(s)"""
+        return np.exp(self._log_a_from_log_age(self._log(age)))
+
+
+def _redshift_to_scalefactor(z):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1. / (1. + np.asarray(z, dtype=float))
+
+
+@functools.lru_cache(maxsize=16)
+def _get_cosmology_table(h0, omegaM0, omegaL0):
+    return CosmologyTable(h0, omegaM0, omegaL0)
+
+
+def get_cosmology_table(f):
+    """Return the :class:`CosmologyTable` for the cosmology of snapshot f
+
+    Tables are cached, keyed on the cosmological parameters, so that repeated calls (e.g. from derived arrays)
+    do not need to recompute the table."""
+    return _get_cosmology_table(float(f.properties['h']), float(f.properties['omegaM0']),
+                                float(f.properties['omegaL0']))
+
+
 def age(f, z=None, unit='Gyr'):
     """
     Calculate the age of the universe in the snapshot f by integrating the Friedmann equation.
@@ -146,7 +217,8 @@ def age(f, z=None, unit='Gyr'):
     output f.
 
     If a long array of redshifts is provided, interpolation is used to speed up the calculation. Specifically,
-    the number of interpolation points is controlled by the configuration parameter 'cosmo-interpolation-points'.
+    the number of interpolation points is controlled by the configuration parameter 'cosmo-interpolation-points',
+    and the interpolation table is shared between all calls with the same cosmology (see :class:`CosmologyTable`).
 
     Parameters
     ----------
@@ -182,12 +254,7 @@ def age(f, z=None, unit='Gyr'):
 
     if isinstance(z, np.ndarray) or isinstance(z, list):
         if len(z) > _interp_points:
-            a_vals = np.logspace(-3,0, _interp_points)
-            z_vals = 1./a_vals-1.
-            log_age_vals = np.log(age(f, z_vals))
-            interp = interp1d(np.log(a_vals), log_age_vals, bounds_error=False)
-            log_a_input = np.log(1./(1.+z))
-            results = np.exp(interp(log_a_input))
+            results = get_cosmology_table(f).age(_redshift_to_scalefactor(z)) * conv
         else:
             results = np.array([get_age(_z) for _z in z])
         results = results.view(SimArray)
@@ -203,6 +270,8 @@ def tau(f, z=None, unit="Gyr"):
     The output is given in the specified units. If a redshift z is specified, it is used in place of the redshift in the
     output f.
 
+    As for :func:`age`, long arrays of redshifts are converted by interpolation from a :class:`CosmologyTable`.
+
     Parameters
     ----------
 
@@ -242,7 +311,10 @@ def tau(f, z=None, unit="Gyr"):
             args=(h0, omM, omL)
         )[0]
 
-    results = (get_tau(z) * conv)
+    if (isinstance(z, np.ndarray) or isinstance(z, list)) and len(z) > _interp_points:
+        results = get_cosmology_table(f).tau(_redshift_to_scalefactor(z)) * conv
+    else:
+        results = (get_tau(z) * conv)
 
     if isinstance(results, np.ndarray):
         results = results.view(SimArray)
@@ -257,8 +329,9 @@ def redshift(f, time):
     Calculate the redshift given a snapshot and a time since Big Bang in Gyr.
 
     Uses scipy.optimize.newton to do the root finding if number of
-    elements in the time array is less than 1000; otherwise uses a linear
-    interpolation.
+    elements in the time array is less than 1000; otherwise interpolates
+    the inverse transformation from a :class:`CosmologyTable`. In the latter
+    case, NaN is returned for times outside the tabulated range.
 
 
     Parameters
@@ -277,7 +350,6 @@ def redshift(f, time):
 
     """
 
-    from scipy.interpolate import interp1d
     from scipy.optimize import newton
 
     def func(x, sim, time):
@@ -285,10 +357,9 @@ def redshift(f, time):
 
     if isinstance(time, list) or isinstance(time, np.ndarray):
         if len(time) > _interp_points:
-            zs = np.logspace(3, -10, _interp_points)
-            ages = age(f, zs)
-            i = interp1d(ages, zs)
-            return i(time)
+            conv = units.Unit("0.01 s Mpc km^-1").ratio("Gyr", **f.conversion_context())
+            a = get_cosmology_table(f).scalefactor(np.asarray(time, dtype=float) / conv)
+            return 1. / a - 1.
         else:
             return np.array([newton(func, 1, args=(f, x)) for x in time])
     else:
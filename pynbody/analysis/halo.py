@@ -7,14 +7,18 @@ Also contains functions for transforming the simulation so that a given halo is
 """
 
 import functools
+import heapq
 import logging
 import math
+import multiprocessing
+import numbers
 import operator
 import warnings
 
 import numpy as np
 
-from .. import array, config, filt, transformation, units, util
+from .. import array, config, family, filt, snapshot, transformation, units, util
+from ..array import shared
 from . import _com, cosmology, profile
 
 logger = logging.getLogger('pynbody.analysis.halo')
@@ -702,3 +706,189 @@ def shape(sim, nbins=100, rmin=None, rmax=None, bins='equal',
         rotations = np.array([flip_axes(R_global, i) for i in rotations])
 
     return rbins, np.squeeze(axis_lengths.T).T, N_in_bin, np.squeeze(rotations)
+
+
+def calculate_for_all_halos(halos, fn, properties, arrays=('pos', 'vel', 'mass'), processes=None,
+                            halo_numbers=None):
+    """Evaluate a function on every halo in a catalogue, returning the results as columns.
+
+    Each halo is presented to *fn* as a standalone snapshot holding a copy of its particles, so that *fn* may freely
+    centre or rotate it. When running on more than one process, the base arrays are placed in shared memory (see
+    :ref:`using_shared_arrays`) and each worker gathers its own halos' particles from there, so that no particle data
+    is pickled. Halos are distributed between workers in batches balanced by particle count, largest halos first.
+
+    Parameters
+    ----------
+
+    halos : HaloCatalogue
+        The catalogue of halos to process.
+
+    fn : callable
+        A function taking a single halo snapshot and returning either a dictionary containing (at least) the
+        requested *properties*, or a sequence of values in the same order as *properties*. When running on more than
+        one process, this must be picklable, i.e. defined at module level.
+
+    properties : list of str
+        The names of the properties computed by *fn*.
+
+    arrays : list of str, optional
+        The snapshot-level arrays to make available to *fn*. Arrays not listed here can still be derived on the
+        halo snapshot if they depend only on the listed arrays. Default is ``('pos', 'vel', 'mass')``.
+
+    processes : int, optional
+        The number of worker processes to use. If None, the ``number_of_threads`` configuration value is used. If 1,
+        all halos are processed in the calling process.
+
+    halo_numbers : array_like, optional
+        The halo numbers to process. If None, all halos in the catalogue are processed.
+
+    Returns
+    -------
+
+    dict
+        A dictionary mapping ``'halo_number'`` and each of the *properties* to an array with one entry per halo, in
+        the order of *halo_numbers*. Where *fn* returns values with units, the corresponding column is a SimArray.
+
+    Examples
+    --------
+
+    >>> def get_properties(h):
+    ...     pynbody.analysis.halo.center(h, with_velocity=False)
+    ...     return {'r200': pynbody.analysis.halo.virial_radius(h, overden=200, rho_def='critical'),
+    ...             'mass': h['mass'].sum()}
+    >>> result = pynbody.analysis.halo.calculate_for_all_halos(f.halos(), get_properties, ['r200', 'mass'])
+
+    """
+
+    if processes is None:
+        processes = config['number_of_threads']
+
+    base = halos.base
+    index_lists = halos._get_all_particle_indices_cached()
+
+    if halo_numbers is None:
+        halo_numbers = np.asarray(halos.number_mapper.all_numbers)
+    else:
+        halo_numbers = np.asarray(halo_numbers)
+
+    boundaries = index_lists.particle_index_list_boundaries[halos.number_mapper.number_to_index(halo_numbers)]
+    boundaries = np.asarray(boundaries).reshape(-1, 2)
+
+    base_arrays = [base[name] for name in arrays]
+    base_units = [ar.units for ar in base_arrays]
+    family_slices = [(fam.name, sl.start, sl.stop) for fam, sl in base._family_slice.items()]
+    base_properties = {k: v for k, v in base.properties.items()
+                       if isinstance(v, (numbers.Number, str, units.UnitBase, np.ndarray))}
+    particle_ids = index_lists.particle_index_list
+    tasks = list(zip(halo_numbers, boundaries[:, 0], boundaries[:, 1]))
+
+    if processes <= 1 or len(tasks) <= 1:
+        results = _calculate_for_halos(fn, properties, tasks, particle_ids, list(arrays), base_arrays,
+                                       base_units, family_slices, base_properties)
+        results = dict(zip(halo_numbers, results))
+    else:
+        batches = _balance_halos_between_batches(tasks, 4 * processes)
+        particle_ids = _as_shared_array(particle_ids)
+        base_arrays = [_as_shared_array(ar) for ar in base_arrays]
+        n = len(batches)
+        pool = multiprocessing.Pool(processes)
+        try:
+            batch_results = shared.remote_map(pool, _calculate_for_halos_remote,
+                                              [fn] * n, [properties] * n, batches, [particle_ids] * n,
+                                              [list(arrays)] * n, [base_arrays] * n, [base_units] * n,
+                                              [family_slices] * n, [base_properties] * n)
+        finally:
+            # workers inherit pynbody's SIGTERM handler, so shut the pool down cleanly rather than terminating it
+            pool.close()
+            pool.join()
+        results = {}
+        for batch, batch_result in zip(batches, batch_results):
+            results.update(zip((t[0] for t in batch), batch_result))
+
+    return _results_to_columns(halo_numbers, [results[n] for n in halo_numbers], properties)
+
+
+def _as_shared_array(ar):
+    """Return *ar* if it is already backed by shared memory, otherwise a shared-memory copy of it"""
+    ar_base = ar
+    while isinstance(ar_base.base, array.SimArray):
+        ar_base = ar_base.base
+    if isinstance(ar_base, shared.SharedMemorySimArray):
+        return ar
+
+    shared_ar = shared.make_shared_array(ar.shape, ar.dtype)
+    shared_ar[:] = ar
+    return shared_ar
+
+
+def _balance_halos_between_batches(tasks, num_batches):
+    """Split (halo_number, start, stop) tasks into batches of similar total particle count
+
+    Halos are assigned largest first to whichever batch currently has the fewest particles."""
+    num_batches = min(num_batches, len(tasks))
+    order = sorted(tasks, key=lambda t: t[2] - t[1], reverse=True)
+    heap = [(0, i) for i in range(num_batches)]
+    batches = [[] for _ in range(num_batches)]
+    for task in order:
+        load, i = heapq.heappop(heap)
+        batches[i].append(task)
+        heapq.heappush(heap, (load + task[2] - task[1], i))
+    return [b for b in batches if len(b) > 0]
+
+
+def _halo_snapshot(indices, array_names, base_arrays, base_units, family_slices, base_properties):
+    """Construct a new snapshot holding a copy of the particles at *indices* in the base arrays"""
+    indices = np.sort(indices)
+    f = snapshot.SimSnap()
+    f._num_particles = len(indices)
+    f._filename = "<halo>"
+    for fam_name, start, stop in family_slices:
+        i0, i1 = np.searchsorted(indices, [start, stop])
+        if i1 > i0:
+            f._family_slice[family.get_family(fam_name)] = slice(int(i0), int(i1))
+    f._decorate()
+    f.properties.update(base_properties)
+
+    for name, ar, ar_units in zip(array_names, base_arrays, base_units):
+        halo_ar = np.asarray(ar)[indices].view(array.SimArray)
+        halo_ar.units = ar_units
+        f._create_array(name, 1 if halo_ar.ndim == 1 else halo_ar.shape[1], halo_ar.dtype, source_array=halo_ar)
+
+    return f
+
+
+def _calculate_for_halos(fn, properties, tasks, particle_ids, array_names, base_arrays, base_units, family_slices,
+                         base_properties):
+    """Apply *fn* to each (halo_number, start, stop) task, returning a list of (values, units) per halo
+
+    Values are returned as plain numpy arrays, with the units split out, so that they can be passed back from a
+    remote process."""
+    results = []
+    for halo_number, start, stop in tasks:
+        h = _halo_snapshot(particle_ids[start:stop], array_names, base_arrays, base_units, family_slices,
+                           base_properties)
+        h.properties['halo_number'] = halo_number
+        result = fn(h)
+        if isinstance(result, dict):
+            result = [result[p] for p in properties]
+        elif len(result) != len(properties):
+            raise ValueError("The function returned %d values, but %d properties were requested" % (
+                len(result), len(properties)))
+        results.append(([np.asarray(v) for v in result], [getattr(v, 'units', None) for v in result]))
+    return results
+
+
+@shared.shared_array_remote
+def _calculate_for_halos_remote(*args):
+    return _calculate_for_halos(*args)
+
+
+def _results_to_columns(halo_numbers, results, properties):
+    columns = {'halo_number': np.asarray(halo_numbers)}
+    for i, name in enumerate(properties):
+        column = np.array([values[i] for values, _ in results])
+        column_units = results[0][1][i] if len(results) > 0 else None
+        if column_units is not None and not isinstance(column_units, units.NoUnit):
+            column = array.SimArray(column, column_units)
+        columns[name] = column
+    return columns
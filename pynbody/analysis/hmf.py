@@ -36,6 +36,9 @@ logger = logging.getLogger('pynbody.analysis.hmf')
 class FieldFilter:
     """Represents a filter acting on a field"""
 
+    #: If not None, the filter is a sharp step in harmonic space, passing only wavenumbers with ln(kR) below this value
+    ln_kR_cutoff = None
+
     def M_to_R(self, M):
         """Return the mass scale (Msol h^-1) for a given length (Mpc h^-1 comoving)"""
         return (M / (self.gammaF * self.rho_bar)) ** 0.3333
@@ -76,6 +79,8 @@ class GaussianFilter(FieldFilter):
 class HarmonicStepFilter(FieldFilter):
     """A step filter in harmonic space"""
 
+    ln_kR_cutoff = 0.0
+
     def __init__(self, context):
         self.gammaF = 6 * math.pi ** 2
         self.rho_bar = cosmology.rho_M(context, unit="Msol Mpc^-3 h^2 a^-3")
@@ -346,10 +351,20 @@ def variance(M_or_R, f_filter=TophatFilter, powspec=PowerSpectrum, arg_is_R=Fals
     float or array
         The variance of the density field smoothed on the given scale(s).
 
+    Notes
+    -----
+    For a single scale, the integral is evaluated with adaptive quadrature. For an array of scales, all scales
+    are integrated at once on a shared grid in ln k, and the result is memoised as a table of sigma(R) on the
+    power spectrum object. Subsequent calls with the same power spectrum and filter type (e.g. from
+    :func:`halo_mass_function` or :func:`halo_bias`) interpolate the table instead of integrating again.
+
     """
     if hasattr(M_or_R, '__len__'):
-        ax = pynbody.array.SimArray(
-            [variance(Mi, f_filter, powspec, arg_is_R) for Mi in M_or_R])
+        if arg_is_R:
+            R = np.asarray(M_or_R, dtype=float)
+        else:
+            R = f_filter.M_to_R(np.asarray(M_or_R, dtype=float))
+        ax = _variance_from_table(R, f_filter, powspec).view(pynbody.array.SimArray)
         # hopefully dimensionless
         ax.units = powspec.Pk_z0_unnormalised.units * powspec.k.units ** 3
         return ax
@@ -367,6 +382,66 @@ def variance(M_or_R, f_filter=TophatFilter, powspec=PowerSpectrum, arg_is_R=Fals
     return v
 
 
+def _variance_on_log_k_grid(R, f_filter, powspec, delta_ln_k=0.005):
+    """Calculate the variance for an array of filter scales R at once, using a shared quadrature grid in ln k
+
+    The integration limits are the same as those used by :func:`variance` for a single scale."""
+    R = np.asarray(R, dtype=float)
+    ln_k_min = math.log(powspec.min_k)
+    ln_k_max = np.log(1. / R) + 3
+    if f_filter.ln_kR_cutoff is not None:
+        # the filter is unity up to the cutoff, so the integral is the same for all R except for its upper limit;
+        # this also avoids the discontinuity spoiling the accuracy of the quadrature
+        ln_k_max = np.minimum(ln_k_max, np.log(1. / R) + f_filter.ln_kR_cutoff)
+    ln_k_max = np.minimum(ln_k_max, math.log(powspec.max_k))
+
+    ln_k = np.arange(ln_k_min, ln_k_max.max() + delta_ln_k, delta_ln_k)
+    ln_k[-1] = min(ln_k[-1], math.log(powspec.max_k))
+    k = np.exp(ln_k)
+
+    integrand_ln_k = k ** 3 * np.asarray(powspec(k))
+    if f_filter.ln_kR_cutoff is None:
+        integrand_ln_k = integrand_ln_k * f_filter.Wk(np.outer(R, k)) ** 2
+    else:
+        integrand_ln_k = np.broadcast_to(integrand_ln_k, (len(R), len(k)))
+
+    cumulative = np.zeros_like(integrand_ln_k)
+    cumulative[:, 1:] = np.cumsum(0.5 * (integrand_ln_k[:, 1:] + integrand_ln_k[:, :-1]) * np.diff(ln_k), axis=1)
+
+    # interpolate the cumulative integral to the upper limit for each scale
+    j = np.clip(np.searchsorted(ln_k, ln_k_max) - 1, 0, len(ln_k) - 2)
+    rows = np.arange(len(R))
+    frac = (ln_k_max - ln_k[j]) / (ln_k[j + 1] - ln_k[j])
+    v = cumulative[rows, j] + frac * (cumulative[rows, j + 1] - cumulative[rows, j])
+
+    return v / (2 * math.pi ** 2)
+
+
+_variance_table_log_R = np.arange(-3.0, 2.5, 0.02)
+
+def _variance_from_table(R, f_filter, powspec):
+    """Return the variance for an array of filter scales R, using a table memoised on the power spectrum object
+
+    The table is tabulated once per filter type and power spectrum normalisation, and then interpolated with a
+    cubic spline in log-log space. Scales outside the tabulated range are evaluated directly."""
+    filter_type = f_filter if isinstance(f_filter, type) else type(f_filter)
+    key = (filter_type, powspec._norm)
+
+    tables = powspec.__dict__.setdefault('_variance_tables', {})
+    if key not in tables:
+        table = _variance_on_log_k_grid(10 ** _variance_table_log_R, f_filter, powspec)
+        tables[key] = scipy.interpolate.CubicSpline(_variance_table_log_R, np.log(table))
+
+    log_R = np.log10(R)
+    in_range = (log_R >= _variance_table_log_R[0]) & (log_R <= _variance_table_log_R[-1])
+
+    v = np.empty(len(log_R))
+    v[in_range] = np.exp(tables[key](log_R[in_range]))
+    if not in_range.all():
+        v[~in_range] = _variance_on_log_k_grid(R[~in_range], f_filter, powspec)
+    return v
+
+
 def get_neffm(mass, sigma):
     """Calculate the effective spectral index of the power spectrum at a given mass scale."""
     dlnm = np.diff(np.log(mass))
@@ -68,10 +68,10 @@ See the documentation for :func:`use_custom_ssp_table` for more information.
 
 import functools
 import os
+import threading
 import warnings
 
 import numpy as np
-from scipy.interpolate import RegularGridInterpolator
 
 import pynbody
 
@@ -121,6 +121,8 @@ class SSPTable:
                     band = band.lower()
                 self._magnitudes.pop(band, None)
 
+        self._grids = {}
+
     def __repr__(self):
         return f"<{type(self).__name__}; bands={', '.join(self.bands)}>"
 
@@ -151,25 +153,76 @@ class SSPTable:
             Magnitude(s) per solar mass interpolated from the SSP table
 
         """
+        return self.interpolate_bands(ages, metallicities, [band])[band]
+
+    def interpolate_bands(self, ages, metallicities, bands):
+        """Interpolate the magnitudes for a given age and metallicity in several bandpasses at once
+
+        The grid cells and bilinear weights are computed only once, and then shared between all the bandpasses.
+
+        Parameters
+        ----------
+
+        ages : float or array-like
+             Age in log10 years
+
+        metallicities : float or array-like
+            Metallicity in log10 mass fraction
+
+        bands : list[str]
+            Bandpass names
+
+        Returns
+        -------
+
+        dict[str, array-like]
+            Magnitude(s) per solar mass interpolated from the SSP table, for each bandpass
+
+        """
+        age_index, met_index, age_weight, met_weight, nan_mask = self._get_interpolation_weights(ages, metallicities)
+
+        results = {}
+        for band in bands:
+            grid = self._get_grid(band)
+            result = (grid[age_index, met_index] * (1.0 - age_weight) * (1.0 - met_weight)
+                      + grid[age_index + 1, met_index] * age_weight * (1.0 - met_weight)
+                      + grid[age_index, met_index + 1] * (1.0 - age_weight) * met_weight
+                      + grid[age_index + 1, met_index + 1] * age_weight * met_weight)
+            result[nan_mask] = np.nan
+            results[band] = result
+
+        return results
+
+    def _get_grid(self, band):
         if self._case_insensitive:
             band = band.lower()
-        metallicities = np.copy(metallicities)
-        ages = np.copy(ages)
+        if band not in self._grids:
+            self._grids[band] = np.ascontiguousarray(self._magnitudes[band].T, dtype=np.float64)
+        return self._grids[band]
+
+    def _get_interpolation_weights(self, ages, metallicities):
+        ages = np.atleast_1d(np.asarray(ages, dtype=np.float64))
+        metallicities = np.atleast_1d(np.asarray(metallicities, dtype=np.float64))
+
         # clamp to the edge of the table
-        metallicities = self._clamp_value(metallicities, self._metallicities)
-        ages = self._clamp_value(ages, self._ages)
+        clamped_ages = self._clamp_value(np.copy(ages), self._ages)
+        clamped_metallicities = self._clamp_value(np.copy(metallicities), self._metallicities)
 
-        nan_mask = np.isnan(metallicities) | np.isnan(ages)
+        nan_mask = np.isnan(clamped_metallicities) | np.isnan(clamped_ages)
 
-        ages[nan_mask ] = self._ages[0]
-        metallicities[nan_mask] = self._metallicities[0]
+        clamped_ages[nan_mask] = self._ages[0]
+        clamped_metallicities[nan_mask] = self._metallicities[0]
 
-        interpolator = RegularGridInterpolator((self._ages, self._metallicities), self._magnitudes[band].T,
-                                               method='linear', bounds_error=False, fill_value=np.nan)
-        result = interpolator(np.array([ages, metallicities]).T)
-        result[nan_mask] = np.nan
+        age_index, age_weight = self._grid_index_and_weight(clamped_ages, self._ages)
+        met_index, met_weight = self._grid_index_and_weight(clamped_metallicities, self._metallicities)
 
-        return result
+        return age_index, met_index, age_weight, met_weight, nan_mask
+
+    @staticmethod
+    def _grid_index_and_weight(value, grid):
+        index = np.clip(np.searchsorted(grid, value, side='right') - 1, 0, len(grid) - 2)
+        weight = (value - grid[index]) / (grid[index + 1] - grid[index])
+        return index, weight
 
     def __call__(self, snapshot, band):
         """Interpolate the magnitude for a given snapshot and bandpass
@@ -180,33 +233,37 @@ class SSPTable:
         snapshot : pynbody.SimSnap
             Snapshot containing the stars
 
-        band : str
-            Bandpass name
+        band : str or list[str]
+            Bandpass name, or a list of bandpass names to be evaluated together
 
         Returns
         -------
 
-        array-like
-            Magnitudes of star particles interpolated from the SSP table
+        array-like or dict[str, array-like]
+            Magnitudes of star particles interpolated from the SSP table. If a list of bandpasses was given, a
+            dictionary mapping each bandpass name to the magnitudes is returned.
 
         """
 
-        age_star = snapshot['age'].in_units('yr')
-        age_star[age_star<1.0] = 1.0
-        metals = snapshot['metals']
-        try:
-            masses = snapshot['massform'].in_units('Msol')
-        except KeyError:
-            masses = snapshot['mass'].in_units('Msol')
+        age_star, metals, masses = _get_star_properties(snapshot)
 
-        with np.errstate(invalid='ignore'):
-            output_mags = self.interpolate(np.log10(age_star), metals, band)
+        bands = [band] if isinstance(band, str) else list(band)
 
-
-        vals = output_mags - 2.5 * np.log10(masses)
-        vals = vals.view(pynbody.array.SimArray)
-        vals.units = None
-        return vals
+        with np.errstate(invalid='ignore'):
+            output_mags = self.interpolate_bands(np.log10(age_star), metals, bands)
+
+        log_masses = 2.5 * np.log10(masses)
+        results = {}
+        for b in bands:
+            vals = output_mags[b] - log_masses
+            vals = vals.view(pynbody.array.SimArray)
+            vals.units = None
+            results[b] = vals
+
+        if isinstance(band, str):
+            return results[band]
+        else:
+            return results
 
     def get_central_wavelength(self, band):
         """Get the estimated central wavelength of a bandpass
@@ -287,8 +344,27 @@ class MultiSSPTable(SSPTable):
     def interpolate(self, ages, metallicities, band):
         return self._bandpass_to_table[band].interpolate(ages, metallicities, band)
 
+    def interpolate_bands(self, ages, metallicities, bands):
+        results = {}
+        for table, table_bands in self._group_bands_by_table(bands):
+            results.update(table.interpolate_bands(ages, metallicities, table_bands))
+        return {band: results[band] for band in bands}
+
     def __call__(self, snapshot, band):
-        return self._bandpass_to_table[band](snapshot, band)
+        if isinstance(band, str):
+            return self._bandpass_to_table[band](snapshot, band)
+
+        results = {}
+        for table, table_bands in self._group_bands_by_table(band):
+            results.update(table(snapshot, table_bands))
+        return {b: results[b] for b in band}
+
+    def _group_bands_by_table(self, bands):
+        tables = {}
+        for band in bands:
+            table = self._bandpass_to_table[band]
+            tables.setdefault(id(table), (table, []))[1].append(band)
+        return tables.values()
 
     def get_central_wavelength(self, band):
         return self._bandpass_to_table[band].get_central_wavelength(band)
@@ -471,9 +547,11 @@ def calc_mags(simstars, band='V', cmd_path=None):
         Snapshot containing the stars (only). If you have a snapshot with non-star particles, pass
         ``sim.s`` to this function.
 
-    band : str
+    band : str or list[str]
         Bandpass name. Can be any that is defined in the SSP table (which by default includes
         'U', 'B', 'V', 'R', 'I', 'J', 'H', 'K'). See the module documentation (:mod:`pynbody.analysis.luminosity`).
+        If a list of bandpass names is given, they are evaluated together (sharing the interpolation weights)
+        and a dictionary mapping each bandpass name to the magnitudes is returned.
 
     cmd_path : str, optional
         Path to the SSP table file. If not provided, the default table will be used. This is either the
@@ -489,6 +567,34 @@ def calc_mags(simstars, band='V', cmd_path=None):
     return table(simstars, band)
 
 
+def derive_mags(simstars, bands):
+    """Derive the ``<band>_mag`` arrays of stars for several bandpasses at once
+
+    This has the same effect as accessing ``simstars[band + '_mag']`` for each band in turn, but the SSP table
+    interpolation is carried out only once and shared between all the bands. Arrays that are already present are
+    left untouched.
+
+    Parameters
+    ----------
+
+    simstars : pynbody.SimSnap
+        Snapshot containing the stars (only)
+
+    bands : list[str]
+        Bandpass names
+
+    """
+
+    bands = [b for b in dict.fromkeys(bands) if b + '_mag' not in simstars]
+
+    _mags_derived_together.pending = bands, {}
+    try:
+        for band in bands:
+            simstars[band + '_mag']
+    finally:
+        _mags_derived_together.pending = None
+
+
 def halo_mag(sim, band='V'):
     """Calculate the absolute magnitude of the provided halo (or other collection of particles)
 
@@ -595,17 +701,46 @@ def half_light_r(sim, band='V', cylindrical=False):
     return test_r
 
 
+def _get_star_properties(snapshot):
+    """Return the ages (in yr), metallicities and masses (in Msol) of stars, as used to interpolate SSP tables"""
+    age_star = snapshot['age'].in_units('yr')
+    age_star[age_star<1.0] = 1.0
+    metals = snapshot['metals']
+    try:
+        masses = snapshot['massform'].in_units('Msol')
+    except KeyError:
+        masses = snapshot['mass'].in_units('Msol')
+    return age_star, metals, masses
+
+
+# while derive_mags is running, the bands it is deriving and the magnitudes calculated so far
+_mags_derived_together = threading.local()
+
+
 def _setup_derived_arrays():
 
     bands_available = 'UBVRIJHKugrizy'
 
+    def _mag_template(band, s):
+        pending = getattr(_mags_derived_together, 'pending', None)
+        if pending is None or band not in pending[0]:
+            return calc_mags(s, band=band)
+
+        bands, results = pending
+        if len(results) == 0:
+            results.update(calc_mags(s, bands))
+        else:
+            # the magnitudes have already been calculated, but the dependencies of this array must still be noted
+            _get_star_properties(s)
+        return results.pop(band)
+
     def _lum_den_template(band, s):
         val = (10 ** (-0.4 * s[band + "_mag"])) * s['rho'] / s['mass']
         val.units = s['rho'].units/s['mass'].units
         return val
 
     for band in bands_available:
-        X = lambda s, b=str(band): calc_mags(s, band=b)
+        X = functools.partial(_mag_template, band)
         X.__name__ = band + "_mag"
         X.__doc__ = band + " magnitude from analysis.luminosity.calc_mags"""
         snapshot.SimSnap.derived_array(X)
@@ -147,7 +147,8 @@ class Profile:
                 self.min = data['min']
                 self.nbins = data['nbins']
                 self._profiles = data['profiles']
-                self.binind = data['binind']
+                self._set_bin_order(np.concatenate([np.asarray(b, dtype=np.intp) for b in data['binind']]),
+                                    np.concatenate(([0], np.cumsum([len(b) for b in data['binind']]))))
 
                 logger.info("Loaded profile from %s" % filename)
 
@@ -233,13 +234,10 @@ class Profile:
         self._properties['dr'].units = self['rbins'].units
         self._properties['dr'].sim = self.sim
 
-        self.binind = []
         if len(self._x) > 0:
             self.partbin = np.digitize(self._x, self['bin_edges']) - 1
         else:
-            self.partbin = np.array([])
-
-        self._properties['npart_bins'] = np.zeros(self.nbins, dtype=int)
+            self.partbin = np.array([], dtype=np.intp)
 
         assert self.ndim in [2, 3]
         if self.ndim == 2:
@@ -249,18 +247,41 @@ class Profile:
             self._binsize = 4. / 3. * np.pi * (self['bin_edges'][1:] ** 3 -
                                                self['bin_edges'][:-1] ** 3)
 
-        # sort the partbin array
-        from bisect import bisect
-        sortind = self.partbin.argsort()
-        sort_pind = self.partbin[sortind]
+        # sort the particles by bin; the stable sort keeps the particles in each bin in ascending order
+        sortind = np.argsort(self.partbin, kind='stable')
+        boundaries = np.searchsorted(self.partbin[sortind], np.arange(-1, self.nbins), side='right')
+        self._set_bin_order(sortind[boundaries[0]:boundaries[-1]], boundaries - boundaries[0])
 
-        # create the bin index arrays
-        prev_index = bisect(sort_pind, -1)
-        for i in range(self.nbins):
-            new_index = bisect(sort_pind, i)
-            self.binind.append(np.sort(sortind[prev_index:new_index]))
-            self._properties['npart_bins'][i] = len(self.binind[i])
-            prev_index = new_index
+    def _set_bin_order(self, bin_order, bin_offsets):
+        """Store the particles in each bin, as a single index array sorted by bin
+
+        The particles in bin ``i`` are ``bin_order[bin_offsets[i]:bin_offsets[i+1]]``. All the vectorised
+        per-bin reductions (see :meth:`_bin_sum`) share this ordering, so it is only computed once per profile.
+        """
+        self._bin_order = bin_order
+        self._bin_offsets = bin_offsets
+        npart_bins = np.diff(bin_offsets)
+        self._bin_labels = np.repeat(np.arange(self.nbins), npart_bins)
+        self._properties['npart_bins'] = npart_bins
+        self.binind = [bin_order[bin_offsets[i]:bin_offsets[i + 1]] for i in range(self.nbins)]
+
+    def _bin_sum(self, values):
+        """Return the sum of the given per-particle values within each bin
+
+        The values must already be in bin order, i.e. indexed by ``self._bin_order``."""
+        return np.bincount(self._bin_labels, weights=values, minlength=self.nbins)
+
+    def _bin_median(self, values):
+        """Return the median of the given per-particle values within each bin (NaN for empty bins)
+
+        The values must already be in bin order, i.e. indexed by ``self._bin_order``."""
+        # sort by value within each bin, using the bin labels as the primary key
+        values = values[np.lexsort((values, self._bin_labels))]
+        npart_bins = np.diff(self._bin_offsets)
+        result = np.full(self.nbins, np.nan)
+        nonempty = npart_bins > 0
+        result[nonempty] = values[self._bin_offsets[:-1][nonempty] + npart_bins[nonempty] // 2]
+        return result
 
     def __len__(self):
         """Returns the number of bins used in this profile object"""
@@ -319,38 +340,32 @@ class Profile:
             raise KeyError(name + " is not a valid profile")
 
     def _auto_profile(self, name, dispersion=False, rms=False, median=False):
-        result = np.zeros(self.nbins)
-
         # force derivation of array if necessary:
         self.sim[name]
 
-        for i in range(self.nbins):
-            subs = self.sim[self.binind[i]]
-            name_array = subs[name].view(np.ndarray)
-            mass_array = subs[self._weight_by].view(np.ndarray)
+        with self.sim.immediate_mode:
+            name_array = self.sim[name].view(np.ndarray)[self._bin_order]
 
-            if dispersion:
-                sq_mean = (name_array ** 2 * mass_array).sum() / \
-                    self['weight_fn'][i]
-                mean_sq = (
-                    (name_array * mass_array).sum() / self['weight_fn'][i]) ** 2
-                try:
-                    result[i] = math.sqrt(sq_mean - mean_sq)
-                except ValueError:
-                    # sq_mean<mean_sq occasionally from numerical roundoff
-                    result[i] = 0
+        if median:
+            result = self._bin_median(name_array)
+        else:
+            with self.sim.immediate_mode:
+                mass_array = self.sim[self._weight_by].view(np.ndarray)[self._bin_order]
+            weight_fn = self['weight_fn'].view(np.ndarray)
+
+            if dispersion or rms:
+                sq_mean = self._bin_sum(name_array ** 2 * mass_array) / weight_fn
+            if not rms:
+                mean = self._bin_sum(name_array * mass_array) / weight_fn
 
+            if dispersion:
+                variance = sq_mean - mean ** 2
+                # sq_mean<mean_sq occasionally from numerical roundoff
+                result = np.sqrt(np.where(variance < 0, 0, variance))
             elif rms:
-                result[i] = np.sqrt(
-                    (name_array ** 2 * mass_array).sum() / self['weight_fn'][i])
-            elif median:
-                if len(subs) == 0:
-                    result[i] = np.nan
-                else:
-                    sorted_name = sorted(name_array)
-                    result[i] = sorted_name[int(np.floor(0.5 * len(subs)))]
+                result = np.sqrt(sq_mean)
             else:
-                result[i] = (name_array * mass_array).sum() / self['weight_fn'][i]
+                result = mean
 
         result = result.view(array.SimArray)
         result.units = self.sim[name].units
@@ -550,8 +565,7 @@ def weight_fn(pro, weight_by=None):
     with pro.sim.immediate_mode:
         pmass = pro.sim[weight_by].view(np.ndarray)
 
-    for i in range(pro.nbins):
-        mass[i] = (pmass[pro.binind[i]]).sum()
+    mass[:] = pro._bin_sum(pmass[pro._bin_order])
 
     mass.sim = pro.sim
     mass.units = pro.sim[weight_by].units
@@ -110,8 +110,11 @@ def make_shared_array(dims, dtype, zeros=False, fname=None, create=True,
     ret_ar._shared_fname = fname
     ret_ar._shared_owner = create
 
-    if strides:
-        ret_ar.strides = strides
+    # assigning to ret_ar.strides is deprecated from numpy 2.4, so make a new view with the required strides
+    if strides and tuple(strides) != ret_ar.strides:
+        ret_ar = np.lib.stride_tricks.as_strided(ret_ar, strides=strides).view(SharedMemorySimArray)
+        ret_ar._shared_fname = fname
+        ret_ar._shared_owner = create
 
     if zero_size:
         ret_ar = ret_ar[1:]
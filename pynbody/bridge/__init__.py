@@ -19,6 +19,7 @@ import typing
 import weakref
 
 import numpy as np
+import scipy.sparse
 
 from .. import util
 from . import _bridge
@@ -97,14 +98,27 @@ class AbstractBridge(abc.ABC):
 
         self._check_compatible_halo_catalogues(halos_1, halos_2)
 
-        particles_in_common_matrix = self.count_particles_in_common(halos_1, halos_2, use_family=use_family)
+        particles_in_common_matrix = self.count_particles_in_common(halos_1, halos_2, use_family=use_family,
+                                                                    sparse=True)
+
+        # find the largest entry in each row of the sparse matrix. Sorting on (row, -count, column) puts the best
+        # match first within each row, taking the lowest column in case of ties (as for a dense argmax)
+        num_rows = particles_in_common_matrix.shape[0]
+        counts_per_row = np.diff(particles_in_common_matrix.indptr)
+        rows = np.repeat(np.arange(num_rows), counts_per_row)
+        order = np.lexsort((particles_in_common_matrix.indices, -particles_in_common_matrix.data, rows))
+        nonempty_rows = counts_per_row > 0
+        best_entry = order[particles_in_common_matrix.indptr[:-1][nonempty_rows]]
+
+        highest_commonality_index = np.zeros(num_rows, dtype=np.intp)
+        highest_commonality_index[nonempty_rows] = particles_in_common_matrix.indices[best_entry]
+        highest_commonality = np.zeros(num_rows, dtype=particles_in_common_matrix.dtype)
+        highest_commonality[nonempty_rows] = particles_in_common_matrix.data[best_entry]
+        row_sums = np.bincount(rows, weights=particles_in_common_matrix.data, minlength=num_rows)
 
-        highest_commonality_index = particles_in_common_matrix.argmax(axis=1)
-        highest_commonality = particles_in_common_matrix[np.arange(particles_in_common_matrix.shape[0]),
-                                                         highest_commonality_index]
         # return nan for zero division
         with np.errstate(divide='ignore', invalid='ignore'):
-            frac_commonality = highest_commonality/particles_in_common_matrix.sum(axis=1)
+            frac_commonality = highest_commonality/row_sums
         frac_commonality[~np.isfinite(frac_commonality)] = 0
 
         invalid_matches = frac_commonality<threshold
@@ -167,29 +181,34 @@ class AbstractBridge(abc.ABC):
             else:
                 return for_halos.number_mapper.index_to_number(index)
 
-        particles_in_common_matrix = self.count_particles_in_common(halos_1, halos_2, use_family=use_family)
+        particles_in_common_matrix = self.count_particles_in_common(halos_1, halos_2, use_family=use_family,
+                                                                    sparse=True)
+        indptr = particles_in_common_matrix.indptr
+        indices = particles_in_common_matrix.indices
+        data = particles_in_common_matrix.data
 
         output = {}
 
-        for source_index, row in enumerate(particles_in_common_matrix):
-            if source_index >= len(halos_1):
-                # count_particles_in_common returns a square matrix, so we might run over the end of the first catalogue
-                break
-
+        # count_particles_in_common returns a square matrix, so we might run over the end of the first catalogue
+        for source_index in range(min(len(halos_1), particles_in_common_matrix.shape[0])):
             this_row_matches = []
+            columns = indices[indptr[source_index]:indptr[source_index+1]]
+            row = data[indptr[source_index]:indptr[source_index+1]]
             row_sum = row.sum()
             if row_sum > 0:
                 frac_particles_transferred = row / row_sum
                 above_threshold = np.where(frac_particles_transferred > threshold)[0]
                 above_threshold = above_threshold[np.argsort(frac_particles_transferred[above_threshold])[::-1]]
-                for column in above_threshold:
-                    this_row_matches.append((map_index_to_output(column, halos_2), frac_particles_transferred[column]))
+                for entry in above_threshold:
+                    this_row_matches.append((map_index_to_output(columns[entry], halos_2),
+                                             frac_particles_transferred[entry]))
 
             output[map_index_to_output(source_index, halos_1)] = this_row_matches
 
         return output
 
-    def count_particles_in_common(self, halos_1, halos_2, /, max_num_halos=None, use_family=None) -> np.ndarray:
+    def count_particles_in_common(self, halos_1, halos_2, /, max_num_halos=None, use_family=None,
+                                  sparse=False) -> np.ndarray | scipy.sparse.csr_matrix:
         """Return a matrix with the number of particles transferred from ``groups_1`` to groups_2.
 
         Normally, :func:`match_catalog` (or :func:`fuzzy_match_catalog`) are easier to use, but this routine
@@ -212,10 +231,14 @@ class AbstractBridge(abc.ABC):
             The maximum number of halos
         use_family : str
             Only match particles of this family. Default is None, in which case all particles are matched.
+        sparse : bool
+            If True, return a :class:`scipy.sparse.csr_matrix` rather than a dense array. Only pairs of halos that
+            actually have particles in common are stored, so this is strongly recommended for large catalogues,
+            where the dense matrix would be too large to hold in memory. Default is False.
 
         Returns
         -------
-        numpy.ndarray
+        numpy.ndarray | scipy.sparse.csr_matrix
             A matrix with the number of particles transferred from each halo in the first catalogue to each halo in the
             second. The size of the matrix is determined by the maximum number of halos in either catalogue, or
             by the value of ``max_num_halos`` if specified.
@@ -253,9 +276,10 @@ class AbstractBridge(abc.ABC):
         if max_num_halos is None:
             max_num_halos = max(len(halos_1), len(halos_2))
 
-        transfer_matrix = _bridge.match(g1, g2, 0, max_num_halos)
-
-        return transfer_matrix
+        if sparse:
+            return _sparse_match(g1, g2, max_num_halos)
+        else:
+            return _bridge.match(g1, g2, 0, max_num_halos)
 
 
 
@@ -441,6 +465,22 @@ class OrderBridge(AbstractBridge):
         return to_[output_index]
 
 
+def _sparse_match(group_list_1, group_list_2, imax):
+    """Sparse equivalent of _bridge.match, with imin=0, returning a CSR matrix of shape (imax+1, imax+1)"""
+    size = imax + 1
+    group_list_1 = np.asarray(group_list_1, dtype=np.int64)
+    group_list_2 = np.asarray(group_list_2, dtype=np.int64)
+    valid = (group_list_1 >= 0) & (group_list_1 <= imax) & (group_list_2 >= 0) & (group_list_2 <= imax)
+
+    # np.unique sorts the (g1, g2) pairs by row then column, which is exactly the CSR ordering
+    pairs, counts = np.unique(group_list_1[valid] * size + group_list_2[valid], return_counts=True)
+    rows, columns = np.divmod(pairs, size)
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+
+    return scipy.sparse.csr_matrix((counts.astype(np.int64), columns, indptr), shape=(size, size))
+
+
 def bridge_factory(a: snapshot.SimSnap, b: snapshot.SimSnap) -> AbstractBridge:
     """Create a bridge connecting the two specified snapshots.
 
@@ -55,6 +55,7 @@ import numpy as np
 import pynbody.util.indexing_tricks
 
 from .. import util
+from . import spatial_index
 
 if TYPE_CHECKING:
     from .. import family
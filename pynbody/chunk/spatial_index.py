@@ -0,0 +1,207 @@
+"""
+Spatial indexing of snapshot files, to allow a region to be loaded without reading the whole file.
+
+Most file formats store particles in an order that has no particular relation to their positions. To load only
+the particles in a given region, :func:`build_spatial_index` divides the volume into a regular grid of cubic cells
+and writes a small sidecar file alongside the snapshot recording which particles fall in each cell. Subsequently,
+passing a filter as ``take_region`` when loading the snapshot, e.g.
+
+.. code-block:: python
+
+   pynbody.chunk.spatial_index.build_spatial_index("my_snapshot") # once only
+   f = pynbody.load("my_snapshot", take_region=pynbody.filt.Sphere(0.01, (0.1, 0.2, 0.3)))
+
+loads all particles in cells that intersect the region, using the normal partial loading mechanism (see
+:mod:`pynbody.chunk`). As with the equivalent option for SWIFT files, the region is specified in the units used on
+disk, and the selection is made at the level of cells. Particles near the edge of the region but outside it will
+therefore also be loaded; apply the same filter to the loaded snapshot to get the exact selection.
+
+The index only records which particles lie in each cell; the snapshot file itself is not reordered. The particles
+in a region are therefore usually scattered throughout the file, and the loader still has to read most of it
+(apart from the gaps between selected particles that the file format allows it to skip). The saving is chiefly in
+memory and in the time taken to process particles after reading, rather than in the amount of data read from disk.
+
+Currently ``take_region`` is supported by :class:`~pynbody.snapshot.tipsy.TipsySnap`,
+:class:`~pynbody.snapshot.nchilada.NchiladaSnap` and :class:`~pynbody.snapshot.gadgethdf.GadgetHDFSnap`. For a
+GadgetHDF snapshot spanning several files, the index is stored alongside the base name of the files
+(e.g. ``snap.spatial-index.npz`` for ``snap.0.hdf5``, ``snap.1.hdf5``, ...). :class:`~pynbody.snapshot.swift.SwiftSnap`
+has its own ``take_region`` option, which uses the cell structure stored in the file instead.
+
+"""
+
+from __future__ import annotations
+
+import os
+
+import numpy as np
+
+# version number written into the index file; increment if the format changes
+_FORMAT_VERSION = 1
+
+
+def index_filename(filename) -> str:
+    """Return the name of the spatial index sidecar file for the specified snapshot file"""
+    return str(filename) + ".spatial-index.npz"
+
+
+class SpatialIndex:
+    """A regular grid of cubic cells, with the list of particles that fall within each cell."""
+
+    def __init__(self, origin: float, cell_size: float, nside: int, cell_offsets: np.ndarray,
+                 particle_indices: np.ndarray):
+        """Create a spatial index from its underlying arrays.
+
+        Most users will want to use :meth:`from_positions` or :meth:`load` instead.
+
+        Parameters
+        ----------
+        origin : float
+            The lower corner of the grid, which is the same along each axis
+        cell_size : float
+            The side length of each cell
+        nside : int
+            The number of cells along each axis
+        cell_offsets : np.ndarray
+            Array of length ``nside**3 + 1``; the particles in cell ``i`` are
+            ``particle_indices[cell_offsets[i]:cell_offsets[i+1]]``
+        particle_indices : np.ndarray
+            Indices of particles in the file, sorted by cell and then by index
+        """
+        self.origin = float(origin)
+        self.cell_size = float(cell_size)
+        self.nside = int(nside)
+        self.cell_offsets = cell_offsets
+        self.particle_indices = particle_indices
+
+    @classmethod
+    def from_positions(cls, pos: np.ndarray, nside: int = 64, boxsize: float | None = None) -> SpatialIndex:
+        """Generate a spatial index for the specified particle positions.
+
+        Parameters
+        ----------
+        pos : np.ndarray
+            Nx3 array of particle positions
+        nside : int
+            The number of cells along each axis of the grid
+        boxsize : float, optional
+            If specified, and the particles fit within a periodic box of this size, the grid covers exactly one
+            box. Otherwise, the grid is the smallest cube enclosing all the particles.
+        """
+        if nside < 2:
+            raise ValueError("nside must be at least 2")
+
+        pos = np.asarray(pos)
+        origin = float(pos.min()) if len(pos) > 0 else 0.0
+        extent = float(pos.max()) - origin if len(pos) > 0 else 1.0
+
+        if boxsize is not None and boxsize > 0 and extent <= boxsize:
+            extent = boxsize
+        else:
+            # ensure the particles at the maximum coordinate fall within the last cell
+            extent = max(extent * (1.0 + 1e-6), np.finfo(np.float32).tiny)
+
+        cell_size = extent / nside
+
+        cell_xyz = np.floor((pos - origin) / cell_size).astype(np.int64)
+        np.clip(cell_xyz, 0, nside - 1, out=cell_xyz)
+        cell_id = (cell_xyz[:, 0] * nside + cell_xyz[:, 1]) * nside + cell_xyz[:, 2]
+
+        index_dtype = np.uint32 if len(pos) < 2**32 else np.int64
+        particle_indices = np.argsort(cell_id, kind='stable').astype(index_dtype)
+        cell_offsets = np.zeros(nside**3 + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell_id, minlength=nside**3), out=cell_offsets[1:])
+
+        return cls(origin, cell_size, nside, cell_offsets, particle_indices)
+
+    def cell_centres(self) -> np.ndarray:
+        """Return an array of the centres of the cells, ordered in the same way as :attr:`cell_offsets`"""
+        centres_1d = self.origin + (np.arange(self.nside) + 0.5) * self.cell_size
+        x, y, z = np.meshgrid(centres_1d, centres_1d, centres_1d, indexing='ij')
+        return np.stack((x.ravel(), y.ravel(), z.ravel()), axis=-1)
+
+    def particles_in_region(self, region) -> np.ndarray:
+        """Return the sorted indices of all particles in cells which intersect the specified region.
+
+        Parameters
+        ----------
+        region : pynbody.filt.Filter
+            The region to select. This must be a filter that implements ``cubic_cell_intersection``, e.g. a
+            :class:`~pynbody.filt.Sphere` or :class:`~pynbody.filt.Cuboid`.
+        """
+        cells = np.where(region.cubic_cell_intersection(self.cell_centres()))[0]
+        starts = self.cell_offsets[cells]
+        stops = self.cell_offsets[cells + 1]
+        lengths = stops - starts
+
+        # gather the particle lists for all selected cells in one go
+        offsets_in_result = np.cumsum(lengths) - lengths
+        source = np.repeat(starts - offsets_in_result, lengths) + np.arange(lengths.sum())
+        return np.sort(self.particle_indices[source].astype(np.int64))
+
+    def save(self, filename, snapshot_files):
+        """Save the index to the specified file, recording the identity of the snapshot files it describes"""
+        file_size, file_mtime_ns = _identify_files(snapshot_files)
+        with open(filename, "wb") as f:
+            np.savez(f, format=_FORMAT_VERSION, origin=self.origin, cell_size=self.cell_size, nside=self.nside,
+                     cell_offsets=self.cell_offsets, particle_indices=self.particle_indices,
+                     file_size=file_size, file_mtime_ns=file_mtime_ns)
+
+    @classmethod
+    def load(cls, snapshot_filename, snapshot_files=None) -> SpatialIndex:
+        """Load the spatial index for the specified snapshot.
+
+        If the snapshot is made up of several files, these should be listed in *snapshot_files*; otherwise
+        *snapshot_filename* is taken to be the only file.
+
+        Raises OSError if there is no index, or if the snapshot has been modified since it was written."""
+        filename = index_filename(snapshot_filename)
+        if not os.path.exists(filename):
+            raise OSError(f"No spatial index is available for {snapshot_filename}; create one with "
+                          f"pynbody.chunk.spatial_index.build_spatial_index")
+
+        if snapshot_files is None:
+            snapshot_files = [snapshot_filename]
+        file_size, file_mtime_ns = _identify_files(snapshot_files)
+        with np.load(filename) as data:
+            if (int(data['format']) != _FORMAT_VERSION or int(data['file_size']) != file_size
+                    or int(data['file_mtime_ns']) != file_mtime_ns):
+                raise OSError(f"The spatial index for {snapshot_filename} is out of date; recreate it with "
+                              f"pynbody.chunk.spatial_index.build_spatial_index")
+            return cls(data['origin'], data['cell_size'], data['nside'], data['cell_offsets'],
+                       data['particle_indices'])
+
+
+def _identify_files(filenames):
+    """Return the total size and latest modification time of the specified files, used to spot a stale index"""
+    stats = [os.stat(f) for f in filenames]
+    return sum(s.st_size for s in stats), max(s.st_mtime_ns for s in stats)
+
+
+def build_spatial_index(filename, nside: int = 64) -> SpatialIndex:
+    """Build a spatial index for the specified snapshot file and save it alongside the file.
+
+    The positions are read in the units used on disk, which are also the units in which regions must
+    subsequently be specified.
+
+    Parameters
+    ----------
+    filename : str
+        The snapshot file to index
+    nside : int
+        The number of cells along each axis of the grid. The default, 64, gives cells which are 1/64th of the
+        width of the box.
+
+    Returns
+    -------
+    SpatialIndex
+        The index that has been written to disk
+    """
+    from .. import load
+
+    sim = load(filename)
+    with sim.lazy_derive_off:
+        pos = sim['pos'].view(np.ndarray)
+    boxsize = sim._get_boxsize_for_kdtree()
+    index = SpatialIndex.from_positions(pos, nside, boxsize)
+    index.save(index_filename(sim.filename), sim._spatial_index_files())
+    return index
@@ -65,6 +65,8 @@ def _get_basic_config_from_parser(config_parser):
         except ValueError:
             pass
     config['sph']['kernel'] = config_parser.get('sph', 'kernel')
+    config['sph']['tree-cache'] = config_parser.getboolean('sph', 'tree-cache')
+    config['sph']['tree-survives-transformation'] = config_parser.getboolean('sph', 'tree-survives-transformation')
 
     config['threading'] = config_parser.get('general', 'threading')
     config['number_of_threads'] = int(
@@ -75,10 +77,13 @@ def _get_basic_config_from_parser(config_parser):
 
     config['gravity_calculation_mode'] = config_parser.get(
         'general', 'gravity_calculation_mode')
+    config['gravity_opening_angle'] = float(config_parser.get('general', 'gravity_opening_angle'))
     config['disk-fit-function'] = config_parser.get('general', 'disk-fit-function')
 
     config['image-default-resolution'] = int(config_parser.get('general', 'image-default-resolution'))
     config['image-default-nside'] = int(config_parser.get('general', 'image-default-nside'))
+    config['deferred-rotation'] = config_parser.getboolean('general', 'deferred-rotation')
+    config['halo-catalogue-cache'] = config_parser.getboolean('general', 'halo-catalogue-cache')
     return config
 
 def _setup_logger(config):
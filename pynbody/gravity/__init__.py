@@ -1,5 +1,12 @@
 """Routines for calculating gravitational potential and accelerations.
 
+Two algorithms are available for calculating the gravity from a set of particles: direct summation
+(:func:`direct`), which is exact but scales as O(N M) for N particles and M target points; and a
+Barnes-Hut tree (:func:`tree`), which re-uses the :class:`~pynbody.kdtree.KDTree` and scales as
+O(M log N) at the cost of a small, controllable error. Higher-level routines such as
+:func:`midplane_rot_curve` choose between them according to the ``gravity_calculation_mode`` configuration
+option (``direct`` or ``tree``); see :func:`calculate`.
+
 .. seealso::
 
     :mod:`pynbody.analysis.profile` provides a user-friendly interface to rotation curves.
@@ -59,6 +66,81 @@ def direct(f: SimSnap, ipos: np.ndarray, eps: float | SimArray | None = None, nu
     return direct(f, ipos, eps, num_threads or 0)
 
 
+def tree(f: SimSnap, ipos: np.ndarray, eps: float | SimArray | None = None, theta: float | None = None,
+         num_threads: int | None = None):
+    """Calculate the gravitational acceleration and potential at the specified positions using a Barnes-Hut tree
+
+    The tree is the same :class:`~pynbody.kdtree.KDTree` used for SPH operations, and will be built if it is not
+    already present. Each cell of the tree is treated as a single point mass at its centre of mass, softened by the
+    mass-weighted mean of its particles' softening lengths, if the distance from the target point to the centre of
+    mass exceeds ``b_max/theta``, where ``b_max`` is the distance from the centre of mass to the furthest corner of
+    the cell. Otherwise the cell is opened, and leaf cells are summed directly.
+
+    The gravitational softening length is determined in the same way as for :func:`direct`.
+
+    Parameters
+    ----------
+
+    f : :class:`pynbody.snapshot.SimSnap`
+        The snapshot containing the particles to be used in the calculation.
+
+    ipos : array_like
+        The position at which the potential is to be calculated.
+
+    eps : float, :class:`pynbody.units.Unit`, or array_like, optional
+        The gravitational softening length. See :func:`direct` for what happens if this is not specified.
+
+    theta : float, optional
+        The opening angle. Smaller values are more accurate but slower; ``theta=0`` reproduces the result of
+        :func:`direct` (up to rounding errors). If not specified, the configuration parameter
+        ``gravity_opening_angle`` is used.
+
+    num_threads : int, optional
+        The number of threads to use. If not specified, the number of threads is determined by the
+        configuration parameter ``number_of_threads``.
+
+    Returns
+    -------
+
+    pot : :class:`pynbody.array.SimArray`
+        The gravitational potential at the specified positions, with units.
+
+    accel : :class:`pynbody.array.SimArray`
+        The gravitational acceleration at the specified positions, with units.
+
+    """
+    from ._gravity import tree
+
+    if theta is None:
+        theta = config['gravity_opening_angle']
+
+    f.build_tree(num_threads=num_threads)
+
+    # the tree may have been built before the snapshot was translated or rotated, in which case the calculation
+    # proceeds in the frame of the tree
+    kdtree = f.kdtree
+    ipos_tree_frame = np.ascontiguousarray(kdtree.points_to_tree_frame(ipos), dtype=np.asarray(ipos).dtype)
+    pot, accel = tree(f, ipos_tree_frame, eps, theta, num_threads or 0)
+    accel[:] = kdtree.vectors_from_tree_frame(accel)
+    return pot, accel
+
+
+def calculate(f: SimSnap, ipos: np.ndarray, eps: float | SimArray | None = None, num_threads: int | None = None):
+    """Calculate the gravitational acceleration and potential using the configured algorithm
+
+    The algorithm is chosen by the configuration parameter ``gravity_calculation_mode``, which may be
+    ``direct`` (see :func:`direct`) or ``tree`` (see :func:`tree`). Parameters and return values are as for
+    :func:`direct`.
+    """
+    mode = config['gravity_calculation_mode']
+    if mode == 'direct':
+        return direct(f, ipos, eps, num_threads)
+    elif mode == 'tree':
+        return tree(f, ipos, eps, num_threads=num_threads)
+    else:
+        raise ValueError("Unknown gravity_calculation_mode %r; must be 'direct' or 'tree'" % mode)
+
+
 def all_direct(f: SimSnap, eps: float | SimArray | None = None):
     """Calculate the potential and acceleration for all particles in the snapshot using a direct summation algorithm.
 
@@ -84,6 +166,31 @@ def all_direct(f: SimSnap, eps: float | SimArray | None = None):
     f['acc'] = acc
 
 
+def all_tree(f: SimSnap, eps: float | SimArray | None = None, theta: float | None = None):
+    """Calculate the potential and acceleration for all particles in the snapshot using a Barnes-Hut tree.
+
+    The results are stored inside the snapshot itself, as f['phi'] and f['acc']. This scales as O(N log N)
+    and is therefore suitable for much larger snapshots than :func:`all_direct`.
+
+    Parameters
+    ----------
+
+    f :
+        The snapshot to calculate the potential and acceleration for
+
+    eps :
+        The gravitational softening length. See :func:`pynbody.gravity.direct` for details of
+        how this is used, or what happens when it is not specified.
+
+    theta :
+        The opening angle; see :func:`pynbody.gravity.tree`.
+
+    """
+    phi, acc = tree(f, f['pos'].view(np.ndarray), eps, theta)
+    f['phi'] = phi
+    f['acc'] = acc
+
+
 def all_pm(f: SimSnap, ngrid: int = 10):
     """Calculate the potential and acceleration for all particles in the snapshot using a Particle-Mesh algorithm.
     This is faster than, but much less accurate than, :func:`pynbody.gravity.all_direct`. It also takes into account
@@ -216,7 +323,7 @@ def midplane_rot_curve(f: SimSnap, rxy_points: np.ndarray, eps: float | SimArray
     rs = [pos for r in rxy_points for pos in [
         (r, 0, 0), (0, r, 0), (-r, 0, 0), (0, -r, 0)]]
 
-    pot, accel = direct(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
+    pot, accel = calculate(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
 
     u_out = (accel.units * f['pos'].units) ** (1, 2)
 
@@ -271,7 +378,7 @@ def midplane_potential(f, rxy_points, eps=None):
     rs = [pos for r in rxy_points for pos in [
         (r, 0, 0), (0, r, 0), (-r, 0, 0), (0, -r, 0)]]
 
-    m_by_r, m_by_r2 = direct(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
+    m_by_r, m_by_r2 = calculate(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
 
     potential = units.G * m_by_r * f['mass'].units / f['pos'].units
 
@@ -21,14 +21,9 @@ cdef extern from "math.h" nogil:
       float sqrt(float)
 
 
-@cython.cdivision(True)
-@cython.boundscheck(False)
-def direct(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, int num_threads = 0):
-    from cython.parallel cimport prange
-
+def _setup_threads(int num_threads):
     global config
 
-
     if num_threads == 0 :
         num_threads = int(config["number_of_threads"])
 
@@ -40,6 +35,10 @@ def direct(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, int num_threads = 0):
 
     openmp.set_threads(num_threads)
 
+    return num_threads
+
+def _get_eps_array(f, dtype, eps=None):
+    """Return the softening length for each particle in f as a plain numpy array, in the units of f['pos']"""
     if eps is None:
         try:
             eps = f['eps']
@@ -53,12 +52,23 @@ def direct(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, int num_threads = 0):
         eps = eps.in_units(f['pos'].units, **f.conversion_context())
 
     if np.isscalar(eps):
-        eps = np.repeat(np.array(eps, dtype=ipos.dtype), len(ipos))
+        eps = np.repeat(np.array(eps, dtype=dtype), len(f))
 
     if isinstance(eps, array.SimArray):
         eps = eps.in_units(f['pos'].units, **f.conversion_context())
         eps = eps.view(np.ndarray)
 
+    return np.asarray(eps, dtype=dtype)
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+def direct(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, int num_threads = 0):
+    from cython.parallel cimport prange
+
+    _setup_threads(num_threads)
+
+    eps = _get_eps_array(f, ipos.dtype, eps)
 
     cdef unsigned int nips = len(ipos)
     cdef np.ndarray[DTYPE_t, ndim=2] m_by_r2 = np.zeros((nips,3), dtype = ipos.dtype)
@@ -90,3 +100,163 @@ def direct(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, int num_threads = 0):
     accel = array.SimArray(-m_by_r2,units=f['mass'].units/f['pos'].units**2 * units.G)
 
     return pot, accel
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _node_moments(Py_ssize_t cell, np.float32_t[:, :] node_min, np.float32_t[:, :] node_max,
+                               np.intp_t[:] node_lower, np.intp_t[:] node_upper, np.intp_t[:] particle_offsets,
+                               DTYPE_t[:, :] pos, DTYPE_t[:] mass, DTYPE_t[:] epssq,
+                               double[:] node_mass, double[:, :] node_com, double[:] node_epssq,
+                               double[:] node_bmax) noexcept nogil:
+    cdef Py_ssize_t j, k, pj
+    cdef double mtot = 0.0, meps = 0.0, m_j
+    cdef double com[3]
+    cdef double extent, bmax2 = 0.0
+
+    com[0] = 0.0
+    com[1] = 0.0
+    com[2] = 0.0
+
+    for j in range(node_lower[cell], node_upper[cell] + 1):
+        pj = particle_offsets[j]
+        m_j = mass[pj]
+        mtot = mtot + m_j
+        meps = meps + m_j * epssq[pj]
+        for k in range(3):
+            com[k] = com[k] + m_j * pos[pj, k]
+
+    if mtot > 0:
+        for k in range(3):
+            com[k] = com[k] / mtot
+        meps = meps / mtot
+    else:
+        # massless cell: use the geometric centre so that distances remain well-defined
+        for k in range(3):
+            com[k] = 0.5 * (node_min[cell, k] + node_max[cell, k])
+
+    # bmax is the distance from the centre of mass to the furthest corner of the cell
+    for k in range(3):
+        extent = com[k] - node_min[cell, k]
+        if node_max[cell, k] - com[k] > extent:
+            extent = node_max[cell, k] - com[k]
+        bmax2 = bmax2 + extent * extent
+
+    node_mass[cell] = mtot
+    node_epssq[cell] = meps
+    node_bmax[cell] = sqrt(bmax2)
+    for k in range(3):
+        node_com[cell, k] = com[k]
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _tree_walk(DTYPE_t x, DTYPE_t y, DTYPE_t z, double theta2,
+                            np.int32_t[:] node_idim, np.intp_t[:] node_lower, np.intp_t[:] node_upper,
+                            np.intp_t[:] particle_offsets, DTYPE_t[:, :] pos, DTYPE_t[:] mass, DTYPE_t[:] epssq,
+                            double[:] node_mass, double[:, :] node_com, double[:] node_epssq,
+                            double[:] node_bmax, double *result) noexcept nogil:
+    # Walks the tree in the same order as the KDTree C++ code (see SETNEXT in kd.h), either accepting the
+    # monopole approximation for a cell or descending into it. result receives m/r and the three components
+    # of m dx/r^3.
+    cdef Py_ssize_t cp = 1, j, pj
+    cdef double dx, dy, dz, d2, drsoft, drsoft3, m_j
+
+    while True:
+        dx = x - node_com[cp, 0]
+        dy = y - node_com[cp, 1]
+        dz = z - node_com[cp, 2]
+        d2 = dx * dx + dy * dy + dz * dz
+
+        if node_bmax[cp] * node_bmax[cp] < theta2 * d2:
+            # cell is sufficiently distant to be treated as a single softened point mass
+            m_j = node_mass[cp]
+            drsoft = 1.0 / sqrt(d2 + node_epssq[cp])
+            drsoft3 = drsoft * drsoft * drsoft
+            result[0] += m_j * drsoft
+            result[1] += m_j * dx * drsoft3
+            result[2] += m_j * dy * drsoft3
+            result[3] += m_j * dz * drsoft3
+        elif node_idim[cp] == -1:
+            # leaf cell that cannot be approximated; sum directly over its particles
+            for j in range(node_lower[cp], node_upper[cp] + 1):
+                pj = particle_offsets[j]
+                m_j = mass[pj]
+                dx = x - pos[pj, 0]
+                dy = y - pos[pj, 1]
+                dz = z - pos[pj, 2]
+                drsoft = 1.0 / sqrt(dx * dx + dy * dy + dz * dz + epssq[pj])
+                drsoft3 = drsoft * drsoft * drsoft
+                result[0] += m_j * drsoft
+                result[1] += m_j * dx * drsoft3
+                result[2] += m_j * dy * drsoft3
+                result[3] += m_j * dz * drsoft3
+        else:
+            # open the cell
+            cp = 2 * cp
+            continue
+
+        # move on to the next cell that has not yet been visited
+        while (cp & 1) and cp != 1:
+            cp = cp >> 1
+        if cp == 1:
+            break
+        cp += 1
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tree(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, theta=None, int num_threads = 0):
+    from cython.parallel cimport prange
+
+    if theta is None:
+        theta = config['gravity_opening_angle']
+
+    _setup_threads(num_threads)
+
+    kdtree = f.kdtree
+    nodes = kdtree.kdnodes
+
+    cdef DTYPE_t[:] epssq = _get_eps_array(f, ipos.dtype, eps) ** 2
+    # positions in the frame in which the tree was built (see KDTree.apply_rigid_transformation)
+    cdef DTYPE_t[:, :] pos = kdtree.get_array_ref('pos').view(np.ndarray)
+    cdef DTYPE_t[:] mass = f['mass'].view(np.ndarray)
+    cdef DTYPE_t[:, :] ipos_view = ipos
+
+    cdef np.float32_t[:, :] node_min = nodes['bnd']['fMin']
+    cdef np.float32_t[:, :] node_max = nodes['bnd']['fMax']
+    cdef np.int32_t[:] node_idim = nodes['iDim']
+    cdef np.intp_t[:] node_lower = nodes['pLower']
+    cdef np.intp_t[:] node_upper = nodes['pUpper']
+    cdef np.intp_t[:] particle_offsets = kdtree.particle_offsets
+
+    cdef Py_ssize_t nnodes = len(nodes)
+    cdef double[:] node_mass = np.zeros(nnodes)
+    cdef double[:, :] node_com = np.zeros((nnodes, 3))
+    cdef double[:] node_epssq = np.zeros(nnodes)
+    cdef double[:] node_bmax = np.zeros(nnodes)
+
+    cdef Py_ssize_t nips = len(ipos)
+    cdef np.ndarray[np.float64_t, ndim=2] result = np.zeros((nips, 4))
+    cdef double[:, :] result_view = result
+    cdef double theta2 = theta * theta
+    cdef Py_ssize_t cell, pi
+
+    # Unused cells (children of leaves) have zeroed entries and so harmlessly describe the first particle;
+    # they are never reached by the walk.
+    for cell in prange(1, nnodes, nogil=True, schedule='static'):
+        _node_moments(cell, node_min, node_max, node_lower, node_upper, particle_offsets, pos, mass, epssq,
+                      node_mass, node_com, node_epssq, node_bmax)
+
+    for pi in prange(nips, nogil=True, schedule='dynamic'):
+        _tree_walk(ipos_view[pi, 0], ipos_view[pi, 1], ipos_view[pi, 2], theta2,
+                   node_idim, node_lower, node_upper, particle_offsets, pos, mass, epssq,
+                   node_mass, node_com, node_epssq, node_bmax, &result_view[pi, 0])
+
+    pot = array.SimArray(-result[:, 0].astype(ipos.dtype), units=f['mass'].units/f['pos'].units * units.G)
+    accel = array.SimArray(-result[:, 1:].astype(ipos.dtype), units=f['mass'].units/f['pos'].units**2 * units.G)
+
+    return pot, accel
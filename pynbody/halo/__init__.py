@@ -183,6 +183,8 @@ class HaloCatalogue(snapshot.util.ContainerWithPhysicalUnitsOption,
       offsets within the snapshot, not particle IDs or 'iord's. Many halo finders output particle IDs which must
       therefore be mapped. To aid this, call :meth:`_init_iord_to_fpos` in your :meth:`__init__` method, which creates
       a mapper as :attr:`_iord_to_fpos`. See :mod:`details.iord_mapping` for more information.
+    * If your format is slow to parse (e.g. plain text), consider storing the parsed arrays in a binary sidecar
+      using :class:`details.catalogue_cache.HaloCatalogueCache`, as :class:`~pynbody.halo.ahf.AHFCatalogue` does.
 
     """
 
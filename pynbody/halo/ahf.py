@@ -13,6 +13,7 @@ import numpy as np
 
 from .. import snapshot, util
 from . import HaloCatalogue, HaloParticleIndices, logger
+from .details.catalogue_cache import HaloCatalogueCache
 from .details.number_mapping import (
     NonMonotonicHaloNumberMapper,
     SimpleHaloNumberMapper,
@@ -27,7 +28,7 @@ class AHFCatalogue(HaloCatalogue):
 
     def __init__(self, sim, filename=None, make_grp=None, get_all_parts=None, use_iord=None, ahf_basename=None,
                  dosort=None, only_stat=None, write_fpos=True, halo_numbers='ahf',
-                 ignore_missing_substructure=True,
+                 ignore_missing_substructure=True, binary_cache=None,
                  **kwargs):
         """Initialize an AHFCatalogue.
 
@@ -68,6 +69,12 @@ class AHFCatalogue(HaloCatalogue):
             called. If :meth`load_all` is called, there is no benefit to writing the file and better performance
             is obtained by using ``write_fpos=False``.
 
+        binary_cache : bool, optional
+            If True, the halo properties and particle membership parsed from the text files are stored in a binary
+            cache directory alongside the catalogue (``<basename>.AHF_pynbody-cache``) and re-used when the catalogue
+            is next opened, which is much faster for large catalogues. If None (default), the
+            ``halo-catalogue-cache`` configuration option is used. See :mod:`pynbody.halo.details.catalogue_cache`.
+
         ahf_basename : str, optional
           Deprecated way to specify the location of the catalogue
 
@@ -111,6 +118,8 @@ class AHFCatalogue(HaloCatalogue):
 
         self._determine_format_revision_from_filename()
 
+        self._binary_cache = HaloCatalogueCache(self._ahfBasename + 'pynbody-cache', enabled=binary_cache)
+
         logger.info("AHFCatalogue loading halo properties")
         self._load_ahf_halo_properties(self._ahfBasename + 'halos')
 
@@ -259,6 +268,14 @@ class AHFCatalogue(HaloCatalogue):
 
     def _load_ahf_particle_block(self, f, nparts):
         """Load the particles for the next halo described in particle file f"""
+        data = self._read_ahf_particle_block(f, nparts)
+        if self._is_new_format:
+            data = self._ahf_to_pynbody_particle_ids(data)
+        data.sort()
+        return data
+
+    def _read_ahf_particle_block(self, f, nparts):
+        """Read the particle IDs, as written by AHF, for the next halo described in particle file f"""
         if self._is_new_format:
             if not isinstance(f, gzip.GzipFile):
                 data = np.fromfile(
@@ -274,8 +291,6 @@ class AHFCatalogue(HaloCatalogue):
                 data = np.empty(nparts, dtype=int)
                 for i in range(nparts):
                     data[i] = int(f.readline().split()[0])
-
-            data = self._ahf_to_pynbody_particle_ids(data)
         else:
             if not isinstance(f, gzip.GzipFile):
                 data = np.fromfile(f, dtype=int, sep=" ", count=nparts)
@@ -284,7 +299,6 @@ class AHFCatalogue(HaloCatalogue):
                 data = np.empty(nparts, dtype=int)
                 for i in range(nparts):
                     data[i] = int(f.readline())
-        data.sort()
         return data
 
     def _ahf_to_pynbody_particle_ids(self, data):
@@ -334,17 +348,46 @@ class AHFCatalogue(HaloCatalogue):
         return data
 
     def _get_particle_indices_one_halo(self, halo_number):
-        fpos = self._get_file_positions()
         file_index = self.number_mapper.number_to_index(halo_number)
+        if self._binary_cache.available:
+            ahf_ids, boundaries = self._get_ahf_particle_ids_all_halos()
+            start, end = boundaries[file_index]
+            ids = np.array(ahf_ids[start:end])
+            if self._is_new_format:
+                ids = self._ahf_to_pynbody_particle_ids(ids)
+            ids.sort()
+            return ids
+
+        fpos = self._get_file_positions()
         with util.open_(self._ahfBasename + 'particles') as f:
             f.seek(fpos[file_index],0)
             ids = self._load_ahf_particle_block(f, nparts=self._halo_properties['npart'][file_index])
         return ids
 
     def _get_all_particle_indices(self):
+        if not self._binary_cache.available:
+            return self._get_all_particle_indices_from_text()
+
+        ahf_ids, boundaries = self._get_ahf_particle_ids_all_halos()
+        if self._is_new_format and self._use_iord:
+            # the iord mapping does not preserve ordering, so must be applied halo by halo
+            particle_ids = np.empty(len(ahf_ids), dtype=int)
+            for start, end in boundaries:
+                particle_ids[start:end] = self._ahf_to_pynbody_particle_ids(np.array(ahf_ids[start:end]))
+        elif self._is_new_format:
+            particle_ids = self._ahf_to_pynbody_particle_ids(np.array(ahf_ids, dtype=int))
+        else:
+            particle_ids = np.array(ahf_ids, dtype=int)
+
+        # sort the particles within each halo
+        halo_index = np.repeat(np.arange(len(boundaries)), boundaries[:, 1] - boundaries[:, 0])
+        particle_ids = particle_ids[np.lexsort((particle_ids, halo_index))]
+
+        return HaloParticleIndices(particle_ids=particle_ids, boundaries=np.array(boundaries))
+
+    def _get_all_particle_indices_from_text(self):
         fpos = self._get_file_positions()
-        boundaries = np.cumsum(np.concatenate(([0], self._halo_properties['npart'])))
-        boundaries = np.vstack((boundaries[:-1], boundaries[1:])).T
+        boundaries = self._particle_boundaries()
         particle_ids = np.empty(boundaries[-1,1], dtype=int)
         with util.open_(self._ahfBasename + 'particles') as f:
             for i in range(len(self._halo_properties['npart'])):
@@ -355,6 +398,30 @@ class AHFCatalogue(HaloCatalogue):
                 particle_ids[start:end] = self._load_ahf_particle_block(f, nparts=nparts)        
         return HaloParticleIndices(particle_ids=particle_ids, boundaries=boundaries)
 
+    def _particle_boundaries(self):
+        boundaries = np.cumsum(np.concatenate(([0], self._halo_properties['npart'])))
+        return np.vstack((boundaries[:-1], boundaries[1:])).T
+
+    def _get_ahf_particle_ids_all_halos(self):
+        """Return the particle IDs for all halos as written by AHF (i.e. before mapping onto the snapshot), and the
+        boundaries of each halo within that array, using the binary cache where possible"""
+        if not hasattr(self, "_ahf_particle_ids"):
+            sources = [self._ahfBasename + 'halos', self._ahfBasename + 'particles']
+            cached = self._binary_cache.load('particles', sources, mmap=True)
+            if cached is not None:
+                self._ahf_particle_ids = cached['ids'], cached['boundaries']
+            else:
+                fpos = self._get_file_positions()
+                boundaries = self._particle_boundaries()
+                ids = np.empty(boundaries[-1, 1], dtype=int)
+                with util.open_(self._ahfBasename + 'particles') as f:
+                    for i, (start, end) in enumerate(boundaries):
+                        f.seek(fpos[i])
+                        ids[start:end] = self._read_ahf_particle_block(f, end - start)
+                self._binary_cache.save('particles', sources, {'ids': ids, 'boundaries': boundaries})
+                self._ahf_particle_ids = ids, boundaries
+        return self._ahf_particle_ids
+
 
     def get_properties_one_halo(self, i):
         index = self.number_mapper.number_to_index(i)
@@ -364,6 +431,16 @@ class AHFCatalogue(HaloCatalogue):
         return self._halo_properties
 
     def _load_ahf_halo_properties(self, filename):
+        cached = self._binary_cache.load('properties', [filename])
+        if cached is not None:
+            self._halo_properties = cached
+            self._num_halos = len(cached['npart'])
+            return
+
+        self._parse_ahf_halo_properties(filename)
+        self._binary_cache.save('properties', [filename], self._halo_properties)
+
+    def _parse_ahf_halo_properties(self, filename):
         # Note: we need to open in 'rt' mode in case the AHF catalogue
         # is gzipped.
         with util.open_(filename, "rt") as f:
@@ -0,0 +1,131 @@
+"""Binary sidecar cache for halo catalogues stored in slow-to-parse formats.
+
+Some halo finders (notably AHF) write their catalogues as plain text, which must be parsed line by line every time
+the catalogue is opened. For catalogues with millions of halos this can take minutes. A :class:`HaloCatalogueCache`
+stores the parsed arrays in a directory alongside the catalogue, as one ``.npy`` file per array, so that later
+sessions can read them back (memory-mapped where appropriate) in a fraction of the time.
+
+The cache is split into named *sections* (e.g. ``properties`` and ``particles``), each of which records the size and
+modification time of the source files from which it was derived. A section is only used if these still match;
+otherwise the caller re-parses the source files and the section is silently rewritten. It is always safe to delete
+the cache directory.
+
+Caching is enabled by the ``halo-catalogue-cache`` option in the ``[general]`` section of the configuration, or
+per catalogue by the ``binary_cache`` keyword of catalogues that support it.
+
+To opt a :class:`~pynbody.halo.HaloCatalogue` subclass into caching, construct a :class:`HaloCatalogueCache` in
+its ``__init__``, then wrap each expensive parsing step with :meth:`HaloCatalogueCache.load` and
+:meth:`HaloCatalogueCache.save`, passing the source files on which that step depends.
+
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from ...configuration import config
+
+logger = logging.getLogger("pynbody.halo.details.catalogue_cache")
+
+_FORMAT_VERSION = 1
+
+
+class HaloCatalogueCache:
+    """Reads and writes named sections of cached arrays for a halo catalogue."""
+
+    def __init__(self, directory, enabled=None):
+        """Prepare a cache in the specified directory
+
+        Parameters
+        ----------
+        directory : str | pathlib.Path
+            The directory in which to store the cache. It is created when a section is first saved.
+        enabled : bool, optional
+            Whether to use the cache at all. If None (default), the ``halo-catalogue-cache`` configuration option
+            is used.
+        """
+        if enabled is None:
+            enabled = config['halo-catalogue-cache']
+        self._directory = os.path.abspath(str(directory)) if enabled else None
+
+    @property
+    def available(self) -> bool:
+        """True if caching is enabled for this catalogue"""
+        return self._directory is not None
+
+    @staticmethod
+    def _describe_sources(source_filenames):
+        description = []
+        for filename in source_filenames:
+            filename = str(filename)
+            if not os.path.exists(filename) and os.path.exists(filename + ".gz"):
+                # mirror util.open_, which falls back to the gzipped file
+                filename += ".gz"
+            stat = os.stat(filename)
+            description.append([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+        return description
+
+    def _path(self, section, suffix):
+        return os.path.join(self._directory, f"{section}.{suffix}")
+
+    def load(self, section, source_filenames, mmap=False) -> dict[str, np.ndarray] | None:
+        """Return the arrays stored in a section, or None if the section is missing or out of date
+
+        Parameters
+        ----------
+        section : str
+            The name of the section
+        source_filenames : list[str]
+            The files from which the section was derived
+        mmap : bool
+            If True, the arrays are memory-mapped read-only; otherwise they are read into memory
+        """
+        if not self.available:
+            return None
+        try:
+            with open(self._path(section, "json")) as f:
+                metadata = json.load(f)
+            if metadata['format'] != _FORMAT_VERSION or \
+                    metadata['sources'] != self._describe_sources(source_filenames):
+                return None
+            result = {name: np.load(self._path(section, f"{i}.npy"), mmap_mode='r' if mmap else None,
+                                    allow_pickle=False)
+                      for i, name in enumerate(metadata['names'])}
+        except (OSError, ValueError, KeyError):
+            return None
+        logger.info("Loaded %s from halo catalogue cache %s", section, self._directory)
+        return result
+
+    def save(self, section, source_filenames, arrays: dict[str, np.ndarray]):
+        """Store arrays as a section, replacing any existing (possibly stale) entry
+
+        Failure to write (e.g. because the directory is read-only) is logged but otherwise ignored."""
+        if not self.available:
+            return
+        try:
+            metadata = {'format': _FORMAT_VERSION,
+                        'sources': self._describe_sources(source_filenames),
+                        'names': list(arrays.keys())}
+            os.makedirs(self._directory, exist_ok=True)
+            # remove the metadata first so that the section is invalid until it has been completely rewritten
+            if os.path.exists(self._path(section, "json")):
+                os.remove(self._path(section, "json"))
+            for i, array in enumerate(arrays.values()):
+                self._write_atomically(self._path(section, f"{i}.npy"), "wb",
+                                       lambda f: np.save(f, np.asarray(array), allow_pickle=False))
+            self._write_atomically(self._path(section, "json"), "w", lambda f: json.dump(metadata, f))
+            logger.info("Saved %s to halo catalogue cache %s", section, self._directory)
+        except (OSError, ValueError) as e:
+            logger.warning("Unable to write %s to halo catalogue cache %s: %s", section, self._directory, e)
+
+    @staticmethod
+    def _write_atomically(path, mode, write):
+        # write to a temporary file then rename, so that a half-written file is never seen by another process
+        temp_path = path + f".tmp{os.getpid()}"
+        with open(temp_path, mode) as f:
+            write(f)
+        os.replace(temp_path, path)
@@ -24,6 +24,13 @@ class SubFindHDFHaloCatalogue(HaloCatalogue) :
 
     See :class:`Gadget4SubfindHDFCatalogue`, :class:`ArepoSubfindHDFCatalogue` and :class:`TNGSubfindHDFCatalogue`.
 
+    Only the offset and length tables are read when the catalogue is constructed. To analyse a few halos of a large
+    run without reading the particle data for the whole box, use :meth:`~pynbody.halo.HaloCatalogue.load_copy`, which
+    reads just the slices of each particle type belonging to the halo from the relevant snapshot files:
+
+    >>> snap = pynbody.load('path/to/snapshot')
+    >>> halo = snap.halos().load_copy(1) # a standalone SimSnap containing only the particles in halo 1
+
     .. warning::
 
         At present, the Gadget 4, Arepo and TNG subclasses of this class are not tested against multi-file
@@ -2,6 +2,7 @@
 Efficient 3D KDTree implementation for fast geometrical calculations such as neighbour lists and smoothing lengths.
 
 """
+import contextlib
 import logging
 import time
 import warnings
@@ -9,7 +10,7 @@ import warnings
 import numpy as np
 
 from .. import array as ar, config, util
-from . import kdmain
+from . import cache, kdmain
 
 logger = logging.getLogger("pynbody.kdtree")
 
@@ -64,6 +65,12 @@ class KDTree:
     >>> pynbody.analysis.faceon(f) # rotate the snapshot
     >>> pynbody.plot.image(f.g, qty='rho', width='10 kpc')
 
+    By default, translating or rotating the snapshot discards the tree. If the ``tree-survives-transformation``
+    option in the ``[sph]`` section of the configuration is True, the tree is instead retained: it keeps its own
+    copy of the positions in the frame in which it was built, and maps query positions into that frame (see
+    :meth:`apply_rigid_transformation`). Periodicity is then still correctly applied after rotation. The cost is
+    the memory taken by the copy, which is as large as the snapshot's ``pos`` array and lasts as long as the tree.
+
     """
 
     PROPID_HSM = 1
@@ -74,6 +81,17 @@ class KDTree:
     PROPID_QTYDISP_ND = 6
     PROPID_QTYDIV  = 7
     PROPID_QTYCURL = 8
+    PROPID_QTYDISP_COLUMNS = 9
+
+    neighbour_cache_max_mb = None
+    """Maximum memory (in MB) to spend caching neighbour lists between smoothing operations.
+
+    If None, the ``neighbour-cache-max-mb`` option in the ``[sph]`` section of the configuration is used.
+    See :meth:`populate`."""
+
+    _neighbour_cache = None
+
+    _frame = None
 
     def __init__(self, pos, mass, leafsize=32, boxsize=None, num_threads=None, shared_mem=False):
         """Create a KDTree
@@ -99,12 +117,6 @@ class KDTree:
 
         num_threads = self._set_num_threads(num_threads)
 
-        # get a power of 2 for num_threads to pass to the constructor, because
-        # otherwise the workload will not be balanced across threads and they
-        # will be wasted
-        num_threads_init = 2 ** int(np.log2(num_threads))
-
-
         self.leafsize = int(leafsize)
         self.kdtree = kdmain.init(pos, mass, self.leafsize)
         nodes = kdmain.get_node_count(self.kdtree)
@@ -120,7 +132,7 @@ class KDTree:
             self.kdnodes = np.zeros(nodes, dtype=KDNode)
             self.particle_offsets = np.empty(len(pos), dtype=np.intp)
 
-        kdmain.build(self.kdtree, self.kdnodes, self.particle_offsets, num_threads_init)
+        kdmain.build(self.kdtree, self.kdnodes, self.particle_offsets, num_threads)
 
         self.boxsize = boxsize
         self._pos = pos
@@ -134,6 +146,8 @@ class KDTree:
 
     def serialize(self):
         """Produce a serialized description of the tree"""
+        if self._frame is not None:
+            raise ValueError("Cannot serialize a KDTree after its positions have been transformed")
         return self.leafsize, self.boxsize, self.kdnodes, self.particle_offsets, self._kernel_id
 
     @classmethod
@@ -163,6 +177,70 @@ class KDTree:
 
 
 
+    def apply_rigid_transformation(self, matrix=None, offset=None):
+        """Update the tree to remain valid after the positions it was built from are rigidly transformed.
+
+        This must be called *before* the positions are changed. The transformation maps each position ``x``
+        to ``matrix @ x + offset``. Rather than rebuilding the tree, the tree retains a private copy of the
+        positions in the frame in which it was built, and subsequently transforms any query positions into
+        that frame. The copy is made on the first call; further transformations are simply composed. Note that
+        the copy occupies as much memory as the original positions, for as long as the tree exists.
+
+        Most users will not need to call this directly; it is called by the snapshot transformation system
+        (see :mod:`pynbody.transformation`).
+
+        Parameters
+        ----------
+        matrix : array_like, optional
+            The 3x3 orthogonal matrix by which positions will be rotated. If None, no rotation is applied.
+        offset : array_like, optional
+            The translation that will be applied after the rotation. If None, no translation is applied.
+        """
+        matrix = np.eye(3) if matrix is None else np.asarray(matrix, dtype=np.float64)
+        offset = np.zeros(3) if offset is None else np.asarray(offset, dtype=np.float64).reshape(3)
+
+        if self._frame is None:
+            self._retain_positions()
+            self._frame = (matrix, offset)
+        else:
+            frame_matrix, frame_offset = self._frame
+            self._frame = (matrix @ frame_matrix, matrix @ frame_offset + offset)
+
+    def _retain_positions(self):
+        """Replace the positions used by the tree with a private copy, so that the originals may be changed"""
+        pos = np.array(self._pos, copy=True)
+        if hasattr(self._pos, "units"):
+            pos = pos.view(ar.SimArray)
+            pos.units = self._pos.units
+        self.set_array_ref("pos", pos)
+        self._pos = pos
+
+    def points_to_tree_frame(self, points):
+        """Map positions in the frame of the snapshot into the frame in which the tree was built.
+
+        See :meth:`apply_rigid_transformation`. If the snapshot has not been transformed since the tree was
+        built, the points are returned unchanged."""
+        if self._frame is None:
+            return points
+        matrix, offset = self._frame
+        return (np.asarray(points, dtype=np.float64) - offset) @ matrix
+
+    def vectors_to_tree_frame(self, vectors):
+        """Rotate vectors in the frame of the snapshot into the frame in which the tree was built.
+
+        Unlike :meth:`points_to_tree_frame`, no translation is applied."""
+        if self._frame is None:
+            return vectors
+        return np.asarray(vectors) @ self._frame[0]
+
+    def vectors_from_tree_frame(self, vectors):
+        """Rotate vectors in the frame in which the tree was built into the frame of the snapshot.
+
+        This is the inverse of :meth:`vectors_to_tree_frame`."""
+        if self._frame is None:
+            return vectors
+        return np.asarray(vectors) @ self._frame[0].T
+
     def particles_in_sphere(self, center, radius):
         """Find particles within a sphere.
 
@@ -180,6 +258,7 @@ class KDTree:
         indices : array_like
             Indices of the particles within the sphere.
         """
+        center = self.points_to_tree_frame(center)
         smx = kdmain.nn_start(self.kdtree, 1, self.boxsize)
 
         particle_ids = kdmain.particles_in_sphere(self.kdtree, smx, center[0], center[1], center[2], radius)
@@ -187,6 +266,121 @@ class KDTree:
         kdmain.nn_stop(self.kdtree, smx)
         return particle_ids
 
+    def particles_in_spheres(self, centres, radii):
+        """Find particles within each of many spheres, in a single parallel call.
+
+        This is equivalent to calling :meth:`particles_in_sphere` once for each sphere, but the queries are
+        distributed across the tree's threads and the results are returned in compressed sparse row (CSR) form,
+        avoiding per-query Python overhead. This is useful for, e.g., aperture measurements around every halo
+        in a catalogue.
+
+        Parameters
+        ----------
+        centres : array_like
+            Nx3 array of sphere centres.
+        radii : array_like or float
+            Length-N array of sphere radii, or a single radius to use for all spheres.
+
+        Returns
+        -------
+        offsets : np.ndarray
+            Length N+1 array; the particles within sphere ``i`` are ``indices[offsets[i]:offsets[i+1]]``.
+        indices : np.ndarray
+            Indices of the particles within each sphere, concatenated. Within each sphere, the indices are not
+            sorted.
+        """
+        dtype = self._pos.dtype
+        centres = np.ascontiguousarray(np.asarray(self.points_to_tree_frame(np.reshape(centres, (-1, 3))),
+                                                  dtype=dtype))
+        radii = np.ascontiguousarray(np.broadcast_to(np.asarray(radii, dtype=dtype), (len(centres),)))
+
+        num_threads = max(1, min(self.num_threads, len(centres)))
+
+        # queries are assigned to threads in a strided pattern, so that catalogues ordered by size (as most are)
+        # are spread evenly across the threads
+        query_ids = [np.arange(i, len(centres), num_threads) for i in range(num_threads)]
+
+        def run_queries(ids):
+            smx = kdmain.nn_start(self.kdtree, 1, self.boxsize)
+            try:
+                return kdmain.particles_in_spheres(self.kdtree, smx, centres[ids], radii[ids])
+            finally:
+                kdmain.nn_stop(self.kdtree, smx)
+
+        if num_threads == 1:
+            results = [run_queries(query_ids[0])]
+        else:
+            results = util.thread_map(run_queries, query_ids)
+
+        counts = np.zeros(len(centres), dtype=np.intp)
+        for ids, (counts_this, _) in zip(query_ids, results):
+            counts[ids] = counts_this
+
+        offsets = np.zeros(len(centres) + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+
+        if num_threads == 1:
+            return offsets, results[0][1]
+
+        indices = np.empty(offsets[-1], dtype=np.intp)
+        for ids, (counts_this, indices_this) in zip(query_ids, results):
+            local_starts = np.cumsum(counts_this) - counts_this
+            destination = np.repeat(offsets[ids] - local_starts, counts_this) + np.arange(len(indices_this))
+            indices[destination] = indices_this
+
+        return offsets, indices
+
+    def query(self, points, k=1):
+        """Find the k nearest particles to each of a set of arbitrary points.
+
+        Unlike :meth:`nn`, which iterates over the neighbours of the particles in the tree, this accepts any
+        positions (e.g. grid cells, sightline samples, or star particles queried against a gas tree). The
+        queries are distributed across the tree's threads, and the periodic boxsize of the tree is respected.
+
+        Parameters
+        ----------
+        points : array_like
+            Nx3 array of positions, in the same units as the positions used to build the tree.
+        k : int
+            The number of nearest neighbours to find for each point.
+
+        Returns
+        -------
+        distances : np.ndarray
+            NxK array of distances to the neighbours, sorted in increasing order for each point.
+        indices : np.ndarray
+            NxK array of the indices of the neighbours, in the same order as ``distances``.
+        """
+        k = int(k)
+        if k < 1:
+            raise ValueError("Number of neighbours must be at least one")
+        if k > len(self._pos):
+            raise ValueError("Number of neighbours exceeds number of particles in tree")
+
+        dtype = self._pos.dtype
+        points = np.ascontiguousarray(np.asarray(self.points_to_tree_frame(np.reshape(points, (-1, 3))),
+                                                 dtype=dtype))
+        distances = np.empty((len(points), k), dtype=dtype)
+        indices = np.empty((len(points), k), dtype=np.intp)
+
+        num_threads = max(1, min(self.num_threads, len(points)))
+        boundaries = np.linspace(0, len(points), num_threads + 1).astype(np.intp)
+
+        def run_queries(start, stop):
+            smx = kdmain.nn_start(self.kdtree, k, self.boxsize)
+            try:
+                kdmain.nearest_neighbours(self.kdtree, smx, points[start:stop],
+                                          distances[start:stop].reshape(-1), indices[start:stop].reshape(-1))
+            finally:
+                kdmain.nn_stop(self.kdtree, smx)
+
+        if num_threads == 1:
+            run_queries(0, len(points))
+        else:
+            util.thread_map(run_queries, boundaries[:-1], boundaries[1:])
+
+        return distances, indices
+
     def nn(self, nn=None):
         """Generator of neighbour list.
 
@@ -242,6 +436,8 @@ class KDTree:
             return 3
         elif name == "qty_sm":
             return 4
+        elif name == "pos":
+            return 5
         else:
             raise ValueError("Unknown KDTree array")
 
@@ -252,13 +448,13 @@ class KDTree:
         ----------
 
         name : str
-            Name of the array to set (can be 'smooth', 'rho', 'mass', 'qty', 'qty_sm')
+            Name of the array to set (can be 'smooth', 'rho', 'mass', 'qty', 'qty_sm', 'pos')
         ar : pynbody.array.SimArray
             Array that the C++ code will access. Note that INCREF is called on the array, so it will be kept
             alive as long as the KDTree object is alive (or until another set_array_ref call replaces it.)
         """
 
-        if self.array_name_to_id(name) < 3:
+        if self.array_name_to_id(name) < 3 or name == "pos":
             if not np.issubdtype(self._pos.dtype, ar.dtype):
                 raise TypeError(
                     "KDTree requires matching dtypes for %s (%s) and pos (%s) arrays"
@@ -268,7 +464,7 @@ class KDTree:
         assert self.get_array_ref(name) is ar
 
     def get_array_ref(self, name):
-        """Get the current array reference for a given name ('smooth', 'rho', 'mass', 'qty', or 'qty_sm')."""
+        """Get the current array reference for a given name ('smooth', 'rho', 'mass', 'qty', 'qty_sm' or 'pos')."""
         return kdmain.get_arrayref(self.kdtree, self.array_name_to_id(name))
 
     def smooth_operation_to_id(self, name):
@@ -279,7 +475,8 @@ class KDTree:
         * 'hsm' : compute smoothing lengths
         * 'rho' : compute density
         * 'qty_mean' : compute SPH mean of the 'qty' array
-        * 'qty_disp' : compute SPH dispersion of the 'qty' array
+        * 'qty_disp' : compute SPH dispersion of the 'qty' array (combining all columns of an NxK array)
+        * 'qty_disp_columns' : compute SPH dispersion of each column of the NxK 'qty' array separately
         * 'qty_div' : compute divergence of the 'qty' array
         * 'qty_curl' : compute curl of the 'qty' array
 
@@ -294,17 +491,22 @@ class KDTree:
             if len(input_array.shape) == 1:
                 return self.PROPID_QTYMEAN_1D
             elif len(input_array.shape) == 2:
-                if input_array.shape[1] != 3:
-                    raise ValueError("Currently only able to smooth 3D or 1D arrays")
                 return self.PROPID_QTYMEAN_ND
+            else:
+                raise ValueError("Can only smooth 1D or NxK arrays")
         elif name == "qty_disp":
             input_array = self.get_array_ref("qty")
             if len(input_array.shape) == 1:
                 return self.PROPID_QTYDISP_1D
             elif len(input_array.shape) == 2:
-                if input_array.shape[1] != 3:
-                    raise ValueError("Currently only able to smooth 3D or 1D arrays")
                 return self.PROPID_QTYDISP_ND
+            else:
+                raise ValueError("Can only smooth 1D or NxK arrays")
+        elif name == "qty_disp_columns":
+            input_array = self.get_array_ref("qty")
+            if len(input_array.shape) != 2:
+                raise ValueError("Can only compute column-wise dispersion of NxK arrays")
+            return self.PROPID_QTYDISP_COLUMNS
         elif name == "qty_div":
             input_array = self.get_array_ref("qty")
             if len(input_array.shape) != 2 and input_array.shape[1] != 3:
@@ -337,6 +539,11 @@ class KDTree:
     def populate(self, mode, nn):
         """Create the KDTree and perform the operation specified by `mode`.
 
+        Every operation other than computing smoothing lengths needs the neighbours within the smoothing kernel
+        of each particle. If a neighbour cache is enabled (see :attr:`neighbour_cache_max_mb`), these neighbour
+        lists are stored after the first search and re-used by subsequent operations with the same smoothing
+        lengths, so that e.g. computing ``rho``, ``v_mean``, ``v_disp`` and ``v_div`` only searches the tree once.
+
         Parameters
         --------
         mode : str (see `kdtree.smooth_operation_to_id`)
@@ -356,23 +563,140 @@ class KDTree:
 
             if propid == self.PROPID_HSM:
                 kdmain.domain_decomposition(self.kdtree, self.num_threads)
-
-
-            if self.num_threads == 1:
-                kdmain.populate(self.kdtree, smx, propid, 0, self._kernel_id)
+                self.clear_neighbour_cache()
+                neighbour_lists = ()
             else:
-                util.thread_map(
-                    kdmain.populate,
-                    [self.kdtree] * self.num_threads,
-                    [smx] * self.num_threads,
-                    [propid] * self.num_threads,
-                    list(range(0, self.num_threads)),
-                    [self._kernel_id] * self.num_threads
-                )
+                neighbour_lists = self._get_cached_neighbour_lists(int(nn))
+
+            with self._differential_operator_in_tree_frame(propid):
+                if self.num_threads == 1:
+                    kdmain.populate(self.kdtree, smx, propid, 0, self._kernel_id, *neighbour_lists)
+                else:
+                    util.thread_map(
+                        kdmain.populate,
+                        [self.kdtree] * self.num_threads,
+                        [smx] * self.num_threads,
+                        [propid] * self.num_threads,
+                        list(range(0, self.num_threads)),
+                        [self._kernel_id] * self.num_threads,
+                        *[[x] * self.num_threads for x in neighbour_lists]
+                    )
         finally:
             # Free C-structures memory
             kdmain.nn_stop(self.kdtree, smx)
 
+    @contextlib.contextmanager
+    def _differential_operator_in_tree_frame(self, propid):
+        """Within the context, the 'qty' array is expressed in the tree frame if required by the operation.
+
+        Particle separations are calculated in the frame in which the tree was built, so the vectors entering a
+        divergence or curl must be rotated into that frame; the curl is then rotated back on exit."""
+        if self._frame is None or propid not in (self.PROPID_QTYDIV, self.PROPID_QTYCURL):
+            yield
+            return
+
+        qty = self.get_array_ref("qty")
+        self.set_array_ref("qty", np.ascontiguousarray(self.vectors_to_tree_frame(qty), dtype=qty.dtype))
+        try:
+            yield
+        finally:
+            self.set_array_ref("qty", qty)
+
+        if propid == self.PROPID_QTYCURL:
+            # the curl is a pseudovector, so picks up a sign change under improper rotations
+            output = self.get_array_ref("qty_sm")
+            output[:] = np.linalg.det(self._frame[0]) * self.vectors_from_tree_frame(output)
+
+    def neighbour_lists(self, nn):
+        """Find the neighbours within the smoothing kernel (i.e. within twice the smoothing length) of every particle.
+
+        The smoothing lengths must already have been set, using :meth:`set_array_ref`.
+
+        Parameters
+        ----------
+        nn : int
+            Number of neighbours used to calculate the smoothing lengths.
+
+        Returns
+        -------
+        offsets : np.ndarray
+            Length N+1 array; the neighbours of the ``i``-th particle in tree order are
+            ``indices[offsets[i]:offsets[i+1]]``.
+        indices : np.ndarray
+            The tree-ordered indices of the neighbours, concatenated. Use :attr:`particle_offsets` to map these
+            to indices in the snapshot.
+        distances_squared : np.ndarray
+            The squared distances to each of the neighbours.
+        """
+        npart = len(self.particle_offsets)
+        num_threads = max(1, min(self.num_threads, npart))
+        boundaries = np.linspace(0, npart, num_threads + 1).astype(np.intp)
+
+        def run_block(start, stop):
+            smx = kdmain.nn_start(self.kdtree, int(nn), self.boxsize)
+            try:
+                return kdmain.neighbour_lists(self.kdtree, smx, start, stop)
+            finally:
+                kdmain.nn_stop(self.kdtree, smx)
+
+        if num_threads == 1:
+            results = [run_block(0, npart)]
+        else:
+            results = util.thread_map(run_block, boundaries[:-1], boundaries[1:])
+
+        offsets = np.zeros(npart + 1, dtype=np.intp)
+        np.cumsum(np.concatenate([r[0] for r in results]), out=offsets[1:])
+
+        if num_threads == 1:
+            return offsets, results[0][1], results[0][2]
+
+        # blocks are contiguous in tree order, so concatenating them gives the full CSR arrays
+        return offsets, np.concatenate([r[1] for r in results]), np.concatenate([r[2] for r in results])
+
+    def _get_neighbour_cache_max_bytes(self):
+        max_mb = self.neighbour_cache_max_mb
+        if max_mb is None:
+            max_mb = config['sph'].get('neighbour-cache-max-mb', 0)
+        return max_mb * 1024 ** 2
+
+    def _get_cached_neighbour_lists(self, nn):
+        """Return the cached neighbour lists for the current smoothing lengths, building them if permitted
+
+        Returns an empty tuple if the cache is disabled or the neighbour lists would exceed the memory limit."""
+        max_bytes = self._get_neighbour_cache_max_bytes()
+        if max_bytes <= 0:
+            return ()
+
+        smooth = self.get_array_ref('smooth')
+        if self._neighbour_cache is not None:
+            cached_nn, cached_smooth, neighbour_lists = self._neighbour_cache
+            if cached_nn == nn and cached_smooth is smooth:
+                return neighbour_lists
+
+        self.clear_neighbour_cache()
+
+        # each particle has very close to nn neighbours within its kernel
+        entry_bytes = np.dtype(np.intp).itemsize + self._pos.dtype.itemsize
+        if len(self.particle_offsets) * nn * entry_bytes > max_bytes:
+            logger.info("Neighbour lists would exceed neighbour-cache-max-mb; not caching")
+            return ()
+
+        logger.info("Building neighbour lists for caching")
+        start = time.time()
+        neighbour_lists = self.neighbour_lists(nn)
+        logger.info("Neighbour lists built in %5.3g s" % (time.time() - start))
+
+        if sum(x.nbytes for x in neighbour_lists) > max_bytes:
+            logger.info("Neighbour lists exceed neighbour-cache-max-mb; not caching")
+        else:
+            self._neighbour_cache = (nn, smooth, neighbour_lists)
+
+        return neighbour_lists
+
+    def clear_neighbour_cache(self):
+        """Discard any cached neighbour lists (see :meth:`populate`)"""
+        self._neighbour_cache = None
+
     def sph_mean(self, array, nsmooth=64):
         r"""Calculate the SPH mean of a simulation array.
 
@@ -390,7 +714,8 @@ class KDTree:
         Parameters
         ----------
         array : pynbody.array.SimArray
-            Quantity to smooth (compute SPH interpolation at particles position).
+            Quantity to smooth (compute SPH interpolation at particles position). This may be a 1D array or an NxK
+            array, in which case each of the K columns is smoothed in the same pass over the neighbours.
 
         nsmooth:
             Number of neighbours to use when smoothing.
@@ -418,7 +743,7 @@ class KDTree:
 
         return output
 
-    def sph_dispersion(self, array, nsmooth=64):
+    def sph_dispersion(self, array, nsmooth=64, separate_columns=False):
         r"""Calculate the SPH dispersion of a simulation array.
 
         Given a kernel W, this routine computes the smoothed quantity:
@@ -441,17 +766,28 @@ class KDTree:
         Parameters
         ----------
         array : pynbody.array.SimArray
-            Quantity to compute dispersion of.
+            Quantity to compute dispersion of. This may be a 1D array or an NxK array.
 
         nsmooth: int
             Number of neighbours to use when smoothing.
 
+        separate_columns: bool
+            If False (default), the dispersion of an NxK array is that of the K-dimensional vector, i.e.
+            the squared differences are summed over the columns before the square root is taken, and the output
+            is 1D. If True, the dispersion of each column is calculated separately and the output is NxK.
+
         Returns
         -------
         output : pynbody.array.SimArray
             The dispersion of the input array.
         """
-        output = np.empty_like(array)
+        if separate_columns and len(array.shape) == 2:
+            output = np.empty_like(array)
+            operation = "qty_disp_columns"
+        else:
+            output = np.empty(len(array), dtype=array.dtype)
+            operation = "qty_disp"
+
         if hasattr(array, "units"):
             output = output.view(ar.SimArray)
             output.units = array.units
@@ -461,7 +797,7 @@ class KDTree:
 
         logger.info("Getting dispersion of array with %d nearest neighbours" % nsmooth)
         start = time.time()
-        self.populate("qty_disp", nsmooth)
+        self.populate(operation, nsmooth)
         end = time.time()
 
         logger.info("SPH dispersion done in %5.3g s" % (end - start))
@@ -0,0 +1,163 @@
+"""On-disk cache for KDTrees, smoothing lengths and densities.
+
+Building a :class:`~pynbody.kdtree.KDTree` for a large snapshot can take minutes, and by default this cost is
+paid again in every new session. If the ``tree-cache`` option in the ``[sph]`` section of the configuration is set
+to ``True`` (or ``cache=True`` is passed to :meth:`~pynbody.snapshot.simsnap.SimSnap.build_tree`), the tree is
+instead written to disk alongside the snapshot the first time it is built, and memory-mapped back in subsequent
+sessions. Smoothing lengths and densities calculated from the tree are cached in the same way.
+
+The cache lives in a directory named ``<snapshot filename>.kdtree-cache``. Each particle selection (e.g. the full
+snapshot, or the gas particles only) has its own entry, keyed by the snapshot's inclusion hash. An entry is only
+used if the snapshot file's size and modification time, the number of particles, the tree leaf size and boxsize,
+and a sample of the particle positions and masses all match those recorded when the entry was written; otherwise
+the entry is silently rebuilt. It is always safe to delete the cache directory.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger("pynbody.kdtree.cache")
+
+_FORMAT_VERSION = 1
+
+# number of particles sampled when fingerprinting the positions and masses
+_FINGERPRINT_SAMPLES = 4096
+
+
+class KDTreeCache:
+    """Reads and writes cached KDTree information for a given snapshot or sub-snapshot."""
+
+    def __init__(self, sim, leafsize, boxsize):
+        """Prepare a cache for the specified (sub-)snapshot
+
+        Parameters
+        ----------
+        sim : pynbody.snapshot.simsnap.SimSnap
+            The snapshot (or sub-snapshot) for which the tree is built
+        leafsize : int
+            The leaf size of the tree
+        boxsize : float
+            The boxsize passed to the tree (or -1 for non-periodic)
+        """
+        self._directory = None
+        filename = getattr(sim.ancestor, "_filename", None)
+
+        if filename is None or not os.path.exists(filename):
+            return
+
+        filename = os.path.abspath(str(filename))
+        stat = os.stat(filename)
+
+        self._directory = filename.rstrip(os.sep) + ".kdtree-cache"
+        self._key = sim._inclusion_hash.hex()
+        self._metadata = {'format': _FORMAT_VERSION,
+                          'filename': filename,
+                          'size': stat.st_size,
+                          'mtime_ns': stat.st_mtime_ns,
+                          'npart': len(sim),
+                          'dtype': str(sim['pos'].dtype),
+                          'leafsize': int(leafsize),
+                          'boxsize': float(boxsize),
+                          'fingerprint': self._fingerprint(sim)}
+
+    @property
+    def available(self) -> bool:
+        """True if the snapshot is associated with a file, so that caching is possible"""
+        return self._directory is not None
+
+    @staticmethod
+    def _fingerprint(sim):
+        """Hash a sample of the positions and masses, so that in-memory changes invalidate the cache"""
+        npart = len(sim)
+        sample = np.linspace(0, npart - 1, min(npart, _FINGERPRINT_SAMPLES)).astype(np.intp)
+        hash = hashlib.md5()
+        for name in 'pos', 'mass':
+            hash.update(np.ascontiguousarray(sim[name].view(np.ndarray)[sample]).tobytes())
+        return hash.hexdigest()
+
+    def _path(self, suffix):
+        return os.path.join(self._directory, f"{self._key}.{suffix}")
+
+    def _is_valid(self):
+        try:
+            with open(self._path("json")) as f:
+                return json.load(f) == self._metadata
+        except (OSError, ValueError):
+            return False
+
+    def _save_npy(self, suffix, array):
+        # write to a temporary file then rename, so that a half-written cache is never seen by another process
+        temp_path = self._path(suffix + f".tmp{os.getpid()}")
+        with open(temp_path, "wb") as f:
+            np.save(f, np.asarray(array), allow_pickle=False)
+        os.replace(temp_path, self._path(suffix))
+
+    def _load_npy(self, suffix):
+        try:
+            return np.load(self._path(suffix), mmap_mode='r', allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+    def load_tree(self):
+        """Return memory-mapped ``(kdnodes, particle_offsets)`` arrays, or None if no valid cache is available"""
+        if not self.available or not self._is_valid():
+            return None
+        kdnodes = self._load_npy("kdnodes.npy")
+        particle_offsets = self._load_npy("offsets.npy")
+        if kdnodes is None or particle_offsets is None:
+            return None
+        logger.info("Loaded KDTree from cache %s", self._directory)
+        return kdnodes, particle_offsets
+
+    def save_tree(self, kdtree):
+        """Write the tree to the cache, replacing any existing (possibly stale) entry for this particle selection"""
+        if not self.available:
+            return
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            # remove the metadata first so that the entry is invalid until it has been completely rewritten
+            if os.path.exists(self._path("json")):
+                os.remove(self._path("json"))
+            for existing in os.listdir(self._directory):
+                if existing.startswith(self._key + "."):
+                    os.remove(os.path.join(self._directory, existing))
+            self._save_npy("kdnodes.npy", kdtree.kdnodes)
+            self._save_npy("offsets.npy", kdtree.particle_offsets)
+            with open(self._path("json"), "w") as f:
+                json.dump(self._metadata, f)
+            logger.info("Saved KDTree to cache %s", self._directory)
+        except OSError as e:
+            logger.warning("Unable to write KDTree cache to %s: %s", self._directory, e)
+
+    def load_array(self, name, nsmooth, kernel=None):
+        """Return a cached smoothing-derived array (e.g. ``smooth`` or ``rho``), or None if not available"""
+        if not self.available or not self._is_valid():
+            return None
+        result = self._load_npy(self._array_suffix(name, nsmooth, kernel))
+        if result is not None:
+            logger.info("Loaded %s from KDTree cache %s", name, self._directory)
+            result = np.array(result)
+        return result
+
+    def save_array(self, name, nsmooth, array, kernel=None):
+        """Store a smoothing-derived array in the cache, if a valid tree entry exists"""
+        if not self.available or not self._is_valid():
+            return
+        try:
+            self._save_npy(self._array_suffix(name, nsmooth, kernel), array)
+        except OSError as e:
+            logger.warning("Unable to write %s to KDTree cache %s: %s", name, self._directory, e)
+
+    @staticmethod
+    def _array_suffix(name, nsmooth, kernel):
+        suffix = f"{name}-{int(nsmooth)}"
+        if kernel is not None:
+            suffix += f"-{kernel}"
+        return suffix + ".npy"
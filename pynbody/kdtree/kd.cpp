@@ -2,13 +2,21 @@
 #include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <algorithm>
+#include <atomic>
 #include <thread>
+#include <vector>
 
 #define NO_IMPORT_ARRAY
 #include "kd.h"
 
 #define MAX_ROOT_ITTR 32
 
+// Ranges of more than this many particles are split with kdPartitionSelect rather than kdSelect
+#define PARTITION_SELECT_MIN (1 << 18)
+#define PARTITION_SELECT_BLOCK (1 << 15)
+#define PARTITION_SELECT_SAMPLE 4096
+
 
 void kdCombine(KDNode *p1, KDNode *p2, KDNode *pOut) {
   int j;
@@ -110,26 +118,142 @@ void kdCountNodes(KDContext *kd) {
   kd->nNodes = l << 1;
 }
 
-template <typename T> void kdBuildTree(KDContext* kd, int num_threads) {
-  npy_intp i, j;
-  T rj;
-  Boundary bnd;
+template <typename F>
+void kdParallelFor(npy_intp start, npy_intp stop, int num_threads, F func) {
+  // Call func(i) for each i in [start, stop), handing out iterations
+  // dynamically so that uneven work per iteration is balanced between threads
+  std::atomic<npy_intp> next(start);
+  auto worker = [&]() {
+    npy_intp i;
+    while ((i = next++) < stop)
+      func(i);
+  };
+
+  if (num_threads > stop - start)
+    num_threads = (int)(stop - start);
+
+  std::vector<std::thread> threads;
+  for (int t = 1; t < num_threads; ++t)
+    threads.emplace_back(worker);
+  worker();
+  for (auto &t : threads)
+    t.join();
+}
 
-  // start by assuming kdCountNodes(kd) has been called and kd->kdNodes!=NULL
+template <typename T>
+void kdPartitionSelect(KDContext* kd, npy_intp d, npy_intp k, npy_intp l, npy_intp r, int num_threads) {
+  // Same effect as kdSelect, but suited to very large ranges. Two pivots are taken from an evenly spaced
+  // sample of the range so that they bracket the value expected at k; a stable three-way partition about
+  // them, carried out in parallel over fixed-size blocks of particles, then usually leaves k in a middle
+  // section a few percent the size of the range. Once the range is small, kdSelect finishes the job.
+  // Because the sample positions are fixed and a stable partition is unique, the resulting order does not
+  // depend on the number of threads. Each partition needs a temporary buffer of one offset per particle
+  // in the range.
+  npy_intp *p = kd->particleOffsets;
+  std::vector<npy_intp> buffer;
+  std::vector<T> sample;
+
+  while (r - l + 1 > PARTITION_SELECT_MIN) {
+    npy_intp n = r - l + 1;
+    npy_intp nblocks = (n + PARTITION_SELECT_BLOCK - 1) / PARTITION_SELECT_BLOCK;
+    npy_intp i, b, count;
+
+    sample.clear();
+    for (i = 0; i < PARTITION_SELECT_SAMPLE; ++i) {
+      T x = GET2<T>(kd->pNumpyPos, p[l + i * (n - 1) / (PARTITION_SELECT_SAMPLE - 1)], d);
+      if (x == x) // leave out NaNs, which cannot be ordered
+        sample.push_back(x);
+    }
+    if (sample.size() < 2)
+      break;
+    std::sort(sample.begin(), sample.end());
+    npy_intp ns = sample.size(), target = (k - l) * (ns - 1) / (n - 1), margin = ns / 32;
+    T vlo = sample[std::max(target - margin, (npy_intp)0)];
+    T vhi = sample[std::min(target + margin, ns - 1)];
+
+    // count the particles below, between (inclusive) and above the pivots in each block
+    std::vector<npy_intp> offsets(3 * nblocks);
+    kdParallelFor(0, nblocks, num_threads, [&](npy_intp b) {
+      npy_intp i, lo = l + b * PARTITION_SELECT_BLOCK, hi = std::min(lo + PARTITION_SELECT_BLOCK, r + 1);
+      npy_intp nless = 0, nmid = 0;
+      T x;
+      for (i = lo; i < hi; ++i) {
+        x = GET2<T>(kd->pNumpyPos, p[i], d);
+        if (x < vlo)
+          ++nless;
+        else if (x <= vhi)
+          ++nmid;
+      }
+      offsets[3 * b] = nless;
+      offsets[3 * b + 1] = nmid;
+      offsets[3 * b + 2] = (hi - lo) - nless - nmid;
+    });
+
+    // turn the counts into the position at which each block writes each class of particle
+    npy_intp nless = 0, nmid = 0;
+    for (b = 0; b < nblocks; ++b) {
+      nless += offsets[3 * b];
+      nmid += offsets[3 * b + 1];
+    }
 
-  assert(kd->nNodes > 0);
-  assert(kd->kdNodes != NULL);
+    if (nmid == n && vlo != vhi)
+      break; // the sample was unrepresentative, so the partition would make no progress
+
+    npy_intp next[3] = {0, nless, nless + nmid};
+    for (b = 0; b < 3 * nblocks; ++b) {
+      count = offsets[b];
+      offsets[b] = next[b % 3];
+      next[b % 3] += count;
+    }
 
-  // Calculate bounds
-  // Initialize with any particle:
+    buffer.resize(n);
+    kdParallelFor(0, nblocks, num_threads, [&](npy_intp b) {
+      npy_intp i, lo = l + b * PARTITION_SELECT_BLOCK, hi = std::min(lo + PARTITION_SELECT_BLOCK, r + 1);
+      npy_intp *pos = &offsets[3 * b];
+      T x;
+      for (i = lo; i < hi; ++i) {
+        x = GET2<T>(kd->pNumpyPos, p[i], d);
+        if (x < vlo)
+          buffer[pos[0]++] = p[i];
+        else if (x <= vhi)
+          buffer[pos[1]++] = p[i];
+        else
+          buffer[pos[2]++] = p[i];
+      }
+    });
+
+    kdParallelFor(0, nblocks, num_threads, [&](npy_intp b) {
+      npy_intp lo = b * PARTITION_SELECT_BLOCK, hi = std::min(lo + PARTITION_SELECT_BLOCK, n);
+      std::copy(buffer.begin() + lo, buffer.begin() + hi, p + l + lo);
+    });
+
+    if (k < l + nless)
+      r = l + nless - 1;
+    else if (k >= l + nless + nmid)
+      l = l + nless + nmid;
+    else if (vlo == vhi)
+      return; // k lies among the particles equal to the pivot, which are now in their final place
+    else {
+      r = l + nless + nmid - 1;
+      l = l + nless;
+    }
+  }
+
+  kdSelect<T>(kd, d, k, l, r);
+}
+
+template <typename T>
+void kdCalculateBounds(KDContext *kd, npy_intp l, npy_intp u, Boundary &bnd) {
+  // Bounds of particles l to u-1 (in tree order), which must be a non-empty range
+  npy_intp i, j;
+  T rj;
   for (j = 0; j < 3; ++j) {
-    rj = GET2<T>(kd->pNumpyPos, kd->particleOffsets[0], j);
+    rj = GET2<T>(kd->pNumpyPos, kd->particleOffsets[l], j);
     bnd.fMin[j] = rj;
     bnd.fMax[j] = rj;
   }
 
-  // Expand to enclose all particles:
-  for (i = 1; i < kd->nActive; ++i) {
+  for (i = l + 1; i < u; ++i) {
     for (j = 0; j < 3; ++j) {
       rj = GET2<T>(kd->pNumpyPos, kd->particleOffsets[i], j);
       if (bnd.fMin[j] > rj)
@@ -138,96 +262,160 @@ template <typename T> void kdBuildTree(KDContext* kd, int num_threads) {
         bnd.fMax[j] = rj;
     }
   }
+}
+
+template <typename T> void kdBuildTree(KDContext* kd, int num_threads) {
+  npy_intp i, level_start;
+  Boundary bnd;
+
+  // start by assuming kdCountNodes(kd) has been called and kd->kdNodes!=NULL
+
+  assert(kd->nNodes > 0);
+  assert(kd->kdNodes != NULL);
+
+  if (num_threads < 1)
+    num_threads = 1;
+
+  // Calculate bounds, in parallel over chunks of particles
+  {
+    int nchunks = num_threads;
+    if (kd->nActive < 16 * (npy_intp)nchunks)
+      nchunks = 1;
+    std::vector<Boundary> chunk_bnd(nchunks);
+    kdParallelFor(0, nchunks, num_threads, [&](npy_intp c) {
+      kdCalculateBounds<T>(kd, (kd->nActive * c) / nchunks,
+                           (kd->nActive * (c + 1)) / nchunks, chunk_bnd[c]);
+    });
+    bnd = chunk_bnd[0];
+    for (int c = 1; c < nchunks; ++c) {
+      KDNode n1, n2, combined;
+      n1.bnd = bnd;
+      n2.bnd = chunk_bnd[c];
+      kdCombine(&n1, &n2, &combined);
+      bnd = combined.bnd;
+    }
+  }
 
   // Set up root node
   kd->kdNodes[ROOT].pLower = 0;
   kd->kdNodes[ROOT].pUpper = kd->nActive - 1;
   kd->kdNodes[ROOT].bnd = bnd;
 
-  // Recursively build tree
-  kdBuildNode<T>(kd, ROOT, num_threads);
+  if (num_threads == 1) {
+    kdBuildNode<T>(kd, ROOT);
+    kdUpPass<T>(kd, ROOT);
+    return;
+  }
 
-  // Calculate and store bounds information by passing it up the tree
-  kdUpPass<T>(kd, ROOT);
-}
+  // The top of the tree is built one level at a time, with the nodes on each level split in parallel. Once
+  // there are enough nodes to share out (several per thread), each thread picks up whole subtrees until
+  // none remain. Every node is split exactly as in the serial build, so the resulting tree is independent
+  // of the number of threads.
+  npy_intp task_level_start = ROOT;
+  while (task_level_start < 4 * (npy_intp)num_threads && task_level_start < kd->nSplit)
+    task_level_start <<= 1;
+
+  // nodes in the top levels are only built if their parent was split; track which these are
+  std::vector<char> active(task_level_start << 1, 0);
+  active[ROOT] = 1;
+
+  for (level_start = ROOT; level_start < task_level_start; level_start <<= 1) {
+    kdParallelFor(level_start, level_start << 1, num_threads, [&](npy_intp i) {
+      if (!active[i])
+        return;
+      // share the threads between the nodes on this level, for their partitions
+      kdSplitNode<T>(kd, i, std::max(num_threads / (int)level_start, 1));
+      if (kd->kdNodes[i].iDim != -1)
+        active[LOWER(i)] = active[UPPER(i)] = 1;
+    });
+  }
 
-template <typename T>
-void kdBuildNode(KDContext* kd, npy_intp local_root, int num_threads) {
+  kdParallelFor(task_level_start, task_level_start << 1, num_threads, [&](npy_intp i) {
+    if (!active[i])
+      return;
+    kdBuildNode<T>(kd, i);
+    kdUpPass<T>(kd, i);
+  });
+
+  // Pass bounds up through the top levels
+  for (level_start = task_level_start >> 1; level_start >= ROOT; level_start >>= 1) {
+    for (i = level_start; i < level_start << 1; ++i) {
+      if (!active[i])
+        continue;
+      if (kd->kdNodes[i].iDim != -1)
+        kdCombine(&kd->kdNodes[LOWER(i)], &kd->kdNodes[UPPER(i)], &kd->kdNodes[i]);
+      else
+        kdUpPass<T>(kd, i);
+    }
+  }
+}
 
-  npy_intp i = local_root;
+template <typename T> void kdSplitNode(KDContext* kd, npy_intp i, int num_threads) {
+  // Split node i (whose particle range and bounds are already set) into its lower and upper children,
+  // or mark it as a leaf if it does not need splitting. Threads are only used for partitioning very
+  // large nodes.
   npy_intp d, j, m, diff;
   KDNode *nodes;
   nodes = kd->kdNodes;
 
-  while (1) {
-    assert(nodes[i].pUpper - nodes[i].pLower + 1 > 0);
-    if (i < kd->nSplit && (nodes[i].pUpper - nodes[i].pLower) > 0) {
-
-      // Select splitting dimensions on the basis of keeping things
-      // as square as possible
-      d = 0;
-      for (j = 1; j < 3; ++j) {
-        if (nodes[i].bnd.fMax[j] - nodes[i].bnd.fMin[j] >
-            nodes[i].bnd.fMax[d] - nodes[i].bnd.fMin[d])
-          d = j;
-      }
-      nodes[i].iDim = d;
+  assert(nodes[i].pUpper - nodes[i].pLower + 1 > 0);
+  if (i < kd->nSplit && (nodes[i].pUpper - nodes[i].pLower) > 0) {
 
-      // Find mid-point of particle list at which splitting will
-      // ultimately take place
-      m = (nodes[i].pLower + nodes[i].pUpper) / 2;
+    // Select splitting dimensions on the basis of keeping things
+    // as square as possible
+    d = 0;
+    for (j = 1; j < 3; ++j) {
+      if (nodes[i].bnd.fMax[j] - nodes[i].bnd.fMin[j] >
+          nodes[i].bnd.fMax[d] - nodes[i].bnd.fMin[d])
+        d = j;
+    }
+    nodes[i].iDim = d;
+
+    // Find mid-point of particle list at which splitting will
+    // ultimately take place
+    m = (nodes[i].pLower + nodes[i].pUpper) / 2;
 
-      // Sort list to ensure particles between lower and m are to
-      // the 'left' of particles between m and upper
+    // Sort list to ensure particles between lower and m are to
+    // the 'left' of particles between m and upper
+    if (nodes[i].pUpper - nodes[i].pLower + 1 > PARTITION_SELECT_MIN)
+      kdPartitionSelect<T>(kd, d, m, nodes[i].pLower, nodes[i].pUpper, num_threads);
+    else
       kdSelect<T>(kd, d, m, nodes[i].pLower, nodes[i].pUpper);
 
-      // Note split point based on median particle
-      nodes[i].fSplit = GET2<T>(kd->pNumpyPos, kd->particleOffsets[m], d);
-
-      // Set up lower cell
-      nodes[LOWER(i)].bnd = nodes[i].bnd;
-      nodes[LOWER(i)].bnd.fMax[d] = nodes[i].fSplit;
-      nodes[LOWER(i)].pLower = nodes[i].pLower;
-      nodes[LOWER(i)].pUpper = m;
-
-      // Set up upper cell
-      nodes[UPPER(i)].bnd = nodes[i].bnd;
-      nodes[UPPER(i)].bnd.fMin[d] = nodes[i].fSplit;
-      nodes[UPPER(i)].pLower = m + 1;
-      nodes[UPPER(i)].pUpper = nodes[i].pUpper;
-      diff = (m - nodes[i].pLower + 1) - (nodes[i].pUpper - m);
-      assert(diff == 0 || diff == 1);
-
-      if (i < num_threads) {
-        // Launch a thread to handle the lower part of the tree,
-        // handle the upper part on the current thread.
-        std::thread t1(kdBuildNode<T>, kd, LOWER(i), num_threads);
-
-        // do upper part locally
-        kdBuildNode<T>(kd, UPPER(i), num_threads);
-
-        t1.join();
-        // NB if we have a non-power-of-two num_threads, we are basically
-        // wasting threads because we will end up waiting at this join point.
-        // This could be optimised by using a different threading model, but
-        // this symmetric branching model is simple and works well for
-        // power-of-two num_threads.
-
-        // at this point, we've finished processing this node and all subnodes,
-        // so continue back up the tree
-        SETNEXT(i, local_root);
-
-      } else {
-        // Continue processing on these threads
-        // Next cell is the lower one. Upper one will be processed
-        // on the way up.
-        i = LOWER(i);
-      }
+    // Note split point based on median particle
+    nodes[i].fSplit = GET2<T>(kd->pNumpyPos, kd->particleOffsets[m], d);
+
+    // Set up lower cell
+    nodes[LOWER(i)].bnd = nodes[i].bnd;
+    nodes[LOWER(i)].bnd.fMax[d] = nodes[i].fSplit;
+    nodes[LOWER(i)].pLower = nodes[i].pLower;
+    nodes[LOWER(i)].pUpper = m;
+
+    // Set up upper cell
+    nodes[UPPER(i)].bnd = nodes[i].bnd;
+    nodes[UPPER(i)].bnd.fMin[d] = nodes[i].fSplit;
+    nodes[UPPER(i)].pLower = m + 1;
+    nodes[UPPER(i)].pUpper = nodes[i].pUpper;
+    diff = (m - nodes[i].pLower + 1) - (nodes[i].pUpper - m);
+    assert(diff == 0 || diff == 1);
+  } else {
+    // Cell does not need to be split. Mark as leaf
+    nodes[i].iDim = -1;
+  }
+}
 
-    } else {
-      // Cell does not need to be split. Mark as leaf
-      nodes[i].iDim = -1;
+template <typename T>
+void kdBuildNode(KDContext* kd, npy_intp local_root) {
+
+  npy_intp i = local_root;
 
+  while (1) {
+    kdSplitNode<T>(kd, i);
+    if (kd->kdNodes[i].iDim != -1) {
+      // Next cell is the lower one. Upper one will be processed
+      // on the way up.
+      i = LOWER(i);
+    } else {
       // Go back up the tree and process the UPPER cells where
       // necessary
       SETNEXT(i, local_root);
@@ -246,7 +434,9 @@ template void kdUpPass<double>(KDContext* kd, npy_intp iCell);
 
 template void kdBuildTree<double>(KDContext* kd, int num_threads);
 
-template void kdBuildNode<double>(KDContext* kd, npy_intp local_root, int num_threads);
+template void kdSplitNode<double>(KDContext* kd, npy_intp i, int num_threads);
+
+template void kdBuildNode<double>(KDContext* kd, npy_intp local_root);
 
 template void kdSelect<float>(KDContext* kd, npy_intp d, npy_intp k, npy_intp l,
                               npy_intp r);
@@ -255,4 +445,6 @@ template void kdUpPass<float>(KDContext* kd, npy_intp iCell);
 
 template void kdBuildTree<float>(KDContext* kd, int num_threads);
 
-template void kdBuildNode<float>(KDContext* kd, npy_intp local_root, int num_threads);
+template void kdSplitNode<float>(KDContext* kd, npy_intp i, int num_threads);
+
+template void kdBuildNode<float>(KDContext* kd, npy_intp local_root);
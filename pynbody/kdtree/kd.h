@@ -156,7 +156,8 @@ typedef struct KDContext {
 void kdCountNodes(KDContext *kd);
 
 template <typename T> void kdBuildTree(KDContext*, int num_threads);
-template <typename T> void kdBuildNode(KDContext*, npy_intp, int);
+template <typename T> void kdSplitNode(KDContext*, npy_intp, int num_threads = 1);
+template <typename T> void kdBuildNode(KDContext*, npy_intp);
 
 void kdCombine(KDNode *p1, KDNode *p2, KDNode *pOut);
 
@@ -4,6 +4,7 @@
 #undef NDEBUG
 #endif
 
+#include <algorithm>
 #include <functional>
 #include <iostream>
 #include <limits>
@@ -39,6 +40,7 @@ PyObject *nn_stop(PyObject *self, PyObject *args);
 PyObject *nn_rewind(PyObject *self, PyObject *args);
 
 PyObject *populate(PyObject *self, PyObject *args);
+PyObject *neighbour_lists(PyObject *self, PyObject *args);
 
 PyObject *domain_decomposition(PyObject *self, PyObject *args);
 PyObject *set_arrayref(PyObject *self, PyObject *args);
@@ -46,6 +48,8 @@ PyObject *get_arrayref(PyObject *self, PyObject *args);
 PyObject *get_node_count(PyObject *self, PyObject *args);
 
 PyObject *particles_in_sphere(PyObject *self, PyObject *args);
+PyObject *particles_in_spheres(PyObject *self, PyObject *args);
+PyObject *nearest_neighbours(PyObject *self, PyObject *args);
 
 int getBitDepth(PyObject *check);
 
@@ -58,6 +62,7 @@ int getBitDepth(PyObject *check);
 #define PROPID_QTYDISP_ND 6
 #define PROPID_QTYDIV 7
 #define PROPID_QTYCURL 8
+#define PROPID_QTYDISP_COLUMNS 9
 /*==========================================================================*/
 
 static PyMethodDef kdmain_methods[] = {
@@ -73,6 +78,10 @@ static PyMethodDef kdmain_methods[] = {
 
     {"particles_in_sphere", particles_in_sphere, METH_VARARGS,
      "particles_in_sphere"},
+    {"particles_in_spheres", particles_in_spheres, METH_VARARGS,
+     "particles_in_spheres"},
+    {"nearest_neighbours", nearest_neighbours, METH_VARARGS,
+     "nearest_neighbours"},
 
     {"set_arrayref", set_arrayref, METH_VARARGS, "set_arrayref"},
     {"get_arrayref", get_arrayref, METH_VARARGS, "get_arrayref"},
@@ -81,6 +90,7 @@ static PyMethodDef kdmain_methods[] = {
      "domain_decomposition"},
 
     {"populate", populate, METH_VARARGS, "populate"},
+    {"neighbour_lists", neighbour_lists, METH_VARARGS, "neighbour_lists"},
 
     {NULL, NULL, 0, NULL}};
 
@@ -132,6 +142,12 @@ template <> const char py_kind<double>() { return 'd'; }
 
 template <> const char py_kind<float>() { return 'f'; }
 
+template <typename T> int np_typenum() { return NPY_NOTYPE; }
+
+template <> int np_typenum<double>() { return NPY_DOUBLE; }
+
+template <> int np_typenum<float>() { return NPY_FLOAT; }
+
 
 template <typename T> int checkArray(PyObject *check, const char *name, npy_intp size=0, bool require_c_contiguous=false) {
   /* Checks that the passed object is a numpy array of the correct type, with the correct size (if specified), and is C-contiguous (if required)
@@ -509,6 +525,7 @@ PyObject *set_arrayref(PyObject *self, PyObject *args) {
   const char *name2 = "mass";
   const char *name3 = "qty";
   const char *name4 = "qty_sm";
+  const char *name5 = "pos";
 
   const char *name;
 
@@ -538,13 +555,17 @@ PyObject *set_arrayref(PyObject *self, PyObject *args) {
     existing = &(kd->pNumpyQtySmoothed);
     name = name4;
     break;
+  case 5:
+    existing = &(kd->pNumpyPos);
+    name = name5;
+    break;
   default:
     PyErr_SetString(PyExc_ValueError, "Unknown array to set for KD tree");
     return NULL;
   }
 
   int bitdepth = 0;
-  if (arid <= 2)
+  if (arid <= 2 || arid == 5)
     bitdepth = kd->nBitDepth;
   else if (arid == 3 || arid == 4)
     bitdepth = getBitDepth(arobj);
@@ -560,6 +581,11 @@ PyObject *set_arrayref(PyObject *self, PyObject *args) {
     return NULL;
   }
 
+  if (arid == 5 && PyArray_DIM((PyArrayObject *) arobj, 0) != kd->nParticles) {
+    PyErr_SetString(PyExc_ValueError, "Replacement pos array must have the same number of particles as the kdtree");
+    return NULL;
+  }
+
   Py_XDECREF(*existing);
   (*existing) = (PyArrayObject *) arobj;
   Py_INCREF(arobj);
@@ -595,6 +621,9 @@ PyObject *get_arrayref(PyObject *self, PyObject *args) {
   case 4:
     existing = &(kd->pNumpyQtySmoothed);
     break;
+  case 5:
+    existing = &(kd->pNumpyPos);
+    break;
   default:
     PyErr_SetString(PyExc_ValueError, "Unknown array to get from KD tree");
     return NULL;
@@ -668,6 +697,203 @@ template <typename Tf, typename Tq> struct typed_particles_in_sphere {
   }
 };
 
+template <typename Tf, typename Tq> struct typed_particles_in_spheres {
+  static PyObject *call(PyObject *self, PyObject *args) {
+    // Gather particles within each of a list of spheres. Returns a tuple (counts, indices) where counts[i]
+    // is the number of particles found in sphere i, and indices is the concatenation of all results.
+    SmoothingContext<Tf> * smx;
+    KDContext* kd;
+    Tf ri[3];
+    Tf r;
+
+    PyObject *kdobj = nullptr, *smxobj = nullptr, *centresobj = nullptr, *radiiobj = nullptr;
+
+    if (!PyArg_ParseTuple(args, "OOOO", &kdobj, &smxobj, &centresobj, &radiiobj))
+      return nullptr;
+
+    kd = static_cast<KDContext*>(PyCapsule_GetPointer(kdobj, NULL));
+    smx = (SmoothingContext<Tf> *)PyCapsule_GetPointer(smxobj, NULL);
+
+    if (checkArray<Tf>(centresobj, "centres"))
+      return nullptr;
+
+    npy_intp nSpheres = PyArray_DIM((PyArrayObject *) centresobj, 0);
+
+    if (checkArray<Tf>(radiiobj, "radii", nSpheres))
+      return nullptr;
+
+    if (PyArray_NDIM((PyArrayObject *) centresobj) != 2 || PyArray_DIM((PyArrayObject *) centresobj, 1) != 3) {
+      PyErr_SetString(PyExc_ValueError, "centres must be an Nx3 array");
+      return nullptr;
+    }
+
+    npy_intp dims[1] = {nSpheres};
+    PyObject *counts = PyArray_SimpleNew(1, dims, NPY_INTP);
+    npy_intp *countsPtr = static_cast<npy_intp*>(PyArray_DATA((PyArrayObject *) counts));
+
+    initParticleList(smx);
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (npy_intp i = 0; i < nSpheres; ++i) {
+      std::tie(ri[0], ri[1], ri[2]) = GET2<Tf>((PyArrayObject *) centresobj, i);
+      r = GET<Tf>((PyArrayObject *) radiiobj, i);
+      npy_intp nBefore = smx->result->size();
+      smBallGather<Tf, smBallGatherStoreResultInList>(smx, r * r, ri);
+      countsPtr[i] = smx->result->size() - nBefore;
+    }
+    Py_END_ALLOW_THREADS;
+
+    PyObject *indices = getReturnParticleList(smx);
+
+    return Py_BuildValue("NN", counts, indices);
+  }
+};
+
+template <typename T> struct typed_nearest_neighbours {
+  static PyObject *call(PyObject *self, PyObject *args) {
+    // Find the nSmooth nearest particles to each of a list of arbitrary points. The distances and
+    // particle indices are written into the Nxk output arrays, sorted by increasing distance.
+    SmoothingContext<T> * smx;
+    KDContext* kd;
+    T ri[3];
+
+    PyObject *kdobj = nullptr, *smxobj = nullptr, *pointsobj = nullptr, *distobj = nullptr, *indexobj = nullptr;
+
+    if (!PyArg_ParseTuple(args, "OOOOO", &kdobj, &smxobj, &pointsobj, &distobj, &indexobj))
+      return nullptr;
+
+    kd = static_cast<KDContext*>(PyCapsule_GetPointer(kdobj, NULL));
+    smx = static_cast<SmoothingContext<T>*>(PyCapsule_GetPointer(smxobj, NULL));
+    if(smx==nullptr) {
+      PyErr_SetString(PyExc_ValueError, "Invalid smoothing context object");
+      return nullptr;
+    }
+
+    if (checkArray<T>(pointsobj, "points"))
+      return nullptr;
+
+    npy_intp nPoints = PyArray_DIM((PyArrayObject *) pointsobj, 0);
+    npy_intp k = smx->nSmooth;
+
+    if (PyArray_NDIM((PyArrayObject *) pointsobj) != 2 || PyArray_DIM((PyArrayObject *) pointsobj, 1) != 3) {
+      PyErr_SetString(PyExc_ValueError, "points must be an Nx3 array");
+      return nullptr;
+    }
+
+    if (checkArray<T>(distobj, "distances", nPoints * k, true) ||
+        checkArray<npy_intp>(indexobj, "indices", nPoints * k, true))
+      return nullptr;
+
+    T *distPtr = static_cast<T*>(PyArray_DATA((PyArrayObject *) distobj));
+    npy_intp *indexPtr = static_cast<npy_intp*>(PyArray_DATA((PyArrayObject *) indexobj));
+
+    // points are mapped to the periodic image nearest the centre of the tree before searching
+    KDNode *root = &kd->kdNodes[ROOT];
+    T centre[3];
+    for (int j = 0; j < 3; ++j)
+      centre[j] = (root->bnd.fMin[j] + root->bnd.fMax[j]) / 2;
+
+    std::vector<std::pair<T, npy_intp>> neighbours;
+    neighbours.reserve(k);
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (npy_intp i = 0; i < nPoints; ++i) {
+      std::tie(ri[0], ri[1], ri[2]) = GET2<T>((PyArrayObject *) pointsobj, i);
+      for (int j = 0; j < 3; ++j) {
+        if (smx->fPeriod[j] < std::numeric_limits<T>::max())
+          ri[j] -= smx->fPeriod[j] * std::round((ri[j] - centre[j]) / smx->fPeriod[j]);
+      }
+
+      smx->priorityQueue->clear();
+      smBallSearch<T>(smx, ri, true);
+
+      neighbours.clear();
+      smx->priorityQueue->iterateHeapEntries([&](const PQEntry<T> &entry) {
+        neighbours.emplace_back(entry.distanceSquared, kd->particleOffsets[entry.getParticleIndex()]);
+      });
+      std::sort(neighbours.begin(), neighbours.end());
+
+      for (npy_intp j = 0; j < k; ++j) {
+        distPtr[i * k + j] = std::sqrt(neighbours[j].first);
+        indexPtr[i * k + j] = neighbours[j].second;
+      }
+    }
+    Py_END_ALLOW_THREADS;
+
+    Py_INCREF(Py_None);
+    return Py_None;
+  }
+};
+
+template <typename T> struct typed_neighbour_lists {
+  static PyObject *call(PyObject *self, PyObject *args) {
+    // Gather the neighbours within 2h of each particle in the tree-ordered range [start, stop), so that they can
+    // be cached and passed back into populate. Returns a tuple (counts, indices, distances_squared) where counts[i]
+    // is the number of neighbours of particle start+i. The indices are tree-ordered (i.e. not the snapshot
+    // particle indices), as used internally by the smoothing functions.
+    SmoothingContext<T> * smx;
+    KDContext* kd;
+    T ri[3];
+    T hsm;
+    npy_intp start, stop;
+
+    PyObject *kdobj = nullptr, *smxobj = nullptr;
+
+    if (!PyArg_ParseTuple(args, "OOnn", &kdobj, &smxobj, &start, &stop))
+      return nullptr;
+
+    kd = static_cast<KDContext*>(PyCapsule_GetPointer(kdobj, NULL));
+    smx = static_cast<SmoothingContext<T>*>(PyCapsule_GetPointer(smxobj, NULL));
+    if(smx==nullptr) {
+      PyErr_SetString(PyExc_ValueError, "Invalid smoothing context object");
+      return nullptr;
+    }
+
+    if (checkArray<T>((PyObject *) kd->pNumpySmooth, "smooth"))
+      return nullptr;
+
+    if (start < 0 || stop > kd->nActive || start > stop) {
+      PyErr_SetString(PyExc_ValueError, "Invalid particle range for neighbour lists");
+      return nullptr;
+    }
+
+    npy_intp dims[1] = {stop - start};
+    PyObject *counts = PyArray_SimpleNew(1, dims, NPY_INTP);
+    npy_intp *countsPtr = static_cast<npy_intp*>(PyArray_DATA((PyArrayObject *) counts));
+
+    smx->neighbourIndices.clear();
+    smx->neighbourDistances.clear();
+    smx->neighbourIndices.reserve((stop - start) * smx->nSmooth);
+    smx->neighbourDistances.reserve((stop - start) * smx->nSmooth);
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (npy_intp i = start; i < stop; ++i) {
+      for (int j = 0; j < 3; ++j) {
+        ri[j] = GET2<T>(kd->pNumpyPos, kd->particleOffsets[i], j);
+      }
+      hsm = GETSMOOTH(T, i);
+      npy_intp nBefore = smx->neighbourIndices.size();
+      smBallGather<T, smBallGatherStoreResultInNeighbourList>(smx, 4 * hsm * hsm, ri);
+      countsPtr[i - start] = smx->neighbourIndices.size() - nBefore;
+    }
+    Py_END_ALLOW_THREADS;
+
+    dims[0] = smx->neighbourIndices.size();
+    PyObject *indices = PyArray_SimpleNew(1, dims, NPY_INTP);
+    PyObject *distances = PyArray_SimpleNew(1, dims, np_typenum<T>());
+    std::copy(smx->neighbourIndices.begin(), smx->neighbourIndices.end(),
+              static_cast<npy_intp*>(PyArray_DATA((PyArrayObject *) indices)));
+    std::copy(smx->neighbourDistances.begin(), smx->neighbourDistances.end(),
+              static_cast<T*>(PyArray_DATA((PyArrayObject *) distances)));
+
+    // release the memory, rather than keeping it until the smoothing context is freed
+    std::vector<npy_intp>().swap(smx->neighbourIndices);
+    std::vector<T>().swap(smx->neighbourDistances);
+
+    return Py_BuildValue("NNN", counts, indices, distances);
+  }
+};
+
 template <typename Tf, typename Tq> struct typed_populate {
   static PyObject *call(PyObject *self, PyObject *args) {
 
@@ -684,11 +910,29 @@ template <typename Tf, typename Tq> struct typed_populate {
 
     PyObject *kdobj, *smxobj;
 
-    PyArg_ParseTuple(args, "OOiii", &kdobj, &smxobj, &propid, &procid,
-                     &kernel_id);
+    // optional cached neighbour lists in CSR form, as returned (and concatenated) from neighbour_lists
+    PyObject *offsetsobj = nullptr, *indicesobj = nullptr, *distancesobj = nullptr;
+    npy_intp *cachedOffsets = nullptr, *cachedIndices = nullptr;
+    Tf *cachedDistances = nullptr;
+
+    if (!PyArg_ParseTuple(args, "OOiii|OOO", &kdobj, &smxobj, &propid, &procid,
+                          &kernel_id, &offsetsobj, &indicesobj, &distancesobj))
+      return NULL;
     kd = static_cast<KDContext*>(PyCapsule_GetPointer(kdobj, NULL));
     smx_global = (SmoothingContext<Tf> *)PyCapsule_GetPointer(smxobj, NULL);
 
+    if (offsetsobj != nullptr && offsetsobj != Py_None) {
+      if (checkArray<npy_intp>(offsetsobj, "offsets", kd->nActive + 1, true))
+        return NULL;
+      cachedOffsets = static_cast<npy_intp*>(PyArray_DATA((PyArrayObject *) offsetsobj));
+      npy_intp nEntries = cachedOffsets[kd->nActive];
+      if (checkArray<npy_intp>(indicesobj, "indices", nEntries, true) ||
+          checkArray<Tf>(distancesobj, "distances", nEntries, true))
+        return NULL;
+      cachedIndices = static_cast<npy_intp*>(PyArray_DATA((PyArrayObject *) indicesobj));
+      cachedDistances = static_cast<Tf*>(PyArray_DATA((PyArrayObject *) distancesobj));
+    }
+
     smx_global->setupKernel(kernel_id);
 
     long nbodies = PyArray_DIM(kd->pNumpyPos, 0);
@@ -739,6 +983,9 @@ template <typename Tf, typename Tq> struct typed_populate {
     case PROPID_QTYCURL:
       pSmFn = &smCurlQty<Tf, Tq>;
       break;
+    case PROPID_QTYDISP_COLUMNS:
+      pSmFn = &smDispQtyColumns<Tf, Tq>;
+      break;
     }
 
     if (propid == PROPID_HSM) {
@@ -765,8 +1012,21 @@ template <typename Tf, typename Tq> struct typed_populate {
         // retrieve the existing smoothing length
         hsm = GETSMOOTH(Tf, i);
 
-        // use it to get nearest neighbours
-        nCnt = smBallGather<Tf, smBallGatherStoreResultInSmx>(smx_local, 4 * hsm * hsm, ri);
+        if (cachedOffsets != nullptr) {
+          // copy the cached neighbours, rather than searching the tree again
+          npy_intp first = cachedOffsets[i];
+          nCnt = cachedOffsets[i + 1] - first;
+          if (nCnt > smx_local->nListSize) {
+            // same condition as smBallGatherStoreResultInSmx
+            smx_local->warnings = true;
+            break;
+          }
+          std::copy(cachedIndices + first, cachedIndices + first + nCnt, smx_local->pList.begin());
+          std::copy(cachedDistances + first, cachedDistances + first + nCnt, smx_local->fList.begin());
+        } else {
+          // use it to get nearest neighbours
+          nCnt = smBallGather<Tf, smBallGatherStoreResultInSmx>(smx_local, 4 * hsm * hsm, ri);
+        }
 
         // calculate the density
         (*pSmFn)(smx_local, i, nCnt);
@@ -867,6 +1127,18 @@ PyObject *populate(PyObject *self, PyObject *args) {
   return type_dispatcher_2<typed_populate>(self, args);
 }
 
+PyObject *neighbour_lists(PyObject *self, PyObject *args) {
+  return type_dispatcher_1<typed_neighbour_lists>(self, args);
+}
+
 PyObject *particles_in_sphere(PyObject *self, PyObject *args) {
   return type_dispatcher_2<typed_particles_in_sphere>(self, args);
 }
+
+PyObject *particles_in_spheres(PyObject *self, PyObject *args) {
+  return type_dispatcher_2<typed_particles_in_spheres>(self, args);
+}
+
+PyObject *nearest_neighbours(PyObject *self, PyObject *args) {
+  return type_dispatcher_1<typed_nearest_neighbours>(self, args);
+}
@@ -44,6 +44,9 @@ public:
   bool warnings; //  keep track of whether a warning has been issued
 
   std::unique_ptr<std::vector<npy_intp>> result;
+  std::vector<npy_intp> neighbourIndices; // used when gathering neighbour lists to be cached (see kdmain::neighbour_lists)
+  std::vector<T> neighbourDistances;
+  std::vector<double> qtyWorkspace; // per-column accumulators for smoothing of multi-column quantities
   std::unique_ptr<PriorityQueue<T>> priorityQueue;
   std::shared_ptr<kernels::Kernel<T>> pKernel;
 
@@ -165,10 +168,14 @@ npy_intp smGetNext(SmoothingContext<T> * smx_local) {
 
 
 template <typename T>
-void smBallSearch(SmoothingContext<T> *smx, T *ri) {
+void smBallSearch(SmoothingContext<T> *smx, T *ri, bool minimumImage = false) {
   // Search for the nearest neighbors to the particle at ri[3].
   // The priority queue must already be fully populated with some candidate particles. The better candidates the
   // faster the search will perform.
+  //
+  // If minimumImage is true, distances to particles in the local bucket are calculated to their nearest
+  // periodic image. This is only needed when ri is an arbitrary point rather than a particle in the tree,
+  // since then the local bucket may span more than half the box.
   KDNode *c;
   npy_intp *p;
   KDContext* kd;
@@ -203,6 +210,13 @@ void smBallSearch(SmoothingContext<T> *smx, T *ri) {
     dy = y-dy;
     dz = z-dz;
 
+    if (minimumImage) {
+      // non-periodic dimensions have an infinite or maximal period, and are left alone
+      if (lx < std::numeric_limits<T>::max()) dx -= lx * std::round(dx / lx);
+      if (ly < std::numeric_limits<T>::max()) dy -= ly * std::round(dy / ly);
+      if (lz < std::numeric_limits<T>::max()) dz -= lz * std::round(dz / lz);
+    }
+
     fDist2 = dx * dx + dy * dy + dz * dz;
     priorityQueue->push(fDist2, pj);
   }
@@ -266,6 +280,16 @@ inline npy_intp smBallGatherStoreResultInSmx(SmoothingContext<T>* smx, T fDist2,
   return foundIndex + 1;
 }
 
+template<typename T>
+inline npy_intp smBallGatherStoreResultInNeighbourList(SmoothingContext<T>* smx, T fDist2,
+                                                       npy_intp particleIndex,
+                                                       npy_intp foundIndex) {
+  // the count is taken from the length of the lists, so foundIndex is left unchanged
+  smx->neighbourIndices.push_back(particleIndex);
+  smx->neighbourDistances.push_back(fDist2);
+  return foundIndex;
+}
+
 
 template <typename T,
           npy_intp (*storeResultFunction)(SmoothingContext<T> *, T, npy_intp, npy_intp)>
@@ -498,6 +522,8 @@ void smMeanQty1D(SmoothingContext<Tf> *, npy_intp, int, bool);
 template <typename Tf, typename Tq>
 void smDispQty1D(SmoothingContext<Tf> *, npy_intp, int, bool);
 template <typename Tf, typename Tq>
+void smDispQtyColumns(SmoothingContext<Tf> *, npy_intp, int, bool);
+template <typename Tf, typename Tq>
 void smDivQty(SmoothingContext<Tf> *, npy_intp, int, bool);
 template <typename Tf, typename Tq>
 void smCurlQty(SmoothingContext<Tf> *, npy_intp, int, bool);
@@ -680,6 +706,7 @@ void smMeanQtyND(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
   Tf fNorm, ih2, r2, rs, ih, mass, rho;
   npy_intp j, k, pj, pi_iord;
   KDContext* kd = smx->kd;
+  npy_intp nDim = PyArray_DIM(kd->pNumpyQty, 1);
 
   auto & kernel = *(smx->pKernel);
 
@@ -688,7 +715,7 @@ void smMeanQtyND(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
   ih2 = ih * ih;
   fNorm = M_1_PI * ih * ih2;
 
-  for (k = 0; k < 3; ++k)
+  for (k = 0; k < nDim; ++k)
     SET2<Tq>(kd->pNumpyQtySmoothed, pi_iord, k, 0.0);
 
   for (j = 0; j < nSmooth; ++j) {
@@ -698,7 +725,7 @@ void smMeanQtyND(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
     rs *= fNorm;
     mass = GET<Tf>(kd->pNumpyMass, kd->particleOffsets[pj]);
     rho = GET<Tf>(kd->pNumpyDen, kd->particleOffsets[pj]);
-    for (k = 0; k < 3; ++k) {
+    for (k = 0; k < nDim; ++k) {
       ACCUM2<Tq>(kd->pNumpyQtySmoothed, pi_iord, k,
                  rs * mass * GET2<Tq>(kd->pNumpyQty, kd->particleOffsets[pj], k) /
                      rho);
@@ -816,7 +843,8 @@ void smDispQtyND(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
   Tf fNorm, ih2, r2, rs, ih, mass, rho;
   npy_intp j, k, pj, pi_iord;
   KDContext* kd = smx->kd;
-  Tq mean[3], tdiff;
+  npy_intp nDim = PyArray_DIM(kd->pNumpyQty, 1);
+  Tq tdiff;
 
   auto & kernel = *(smx->pKernel);
 
@@ -827,10 +855,8 @@ void smDispQtyND(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
 
   SET<Tq>(kd->pNumpyQtySmoothed, pi_iord, 0.0);
 
-  for (k = 0; k < 3; ++k) {
-
-    mean[k] = 0;
-  }
+  auto & mean = smx->qtyWorkspace;
+  mean.assign(nDim, 0.0);
 
   // pass 1: find mean
 
@@ -841,7 +867,7 @@ void smDispQtyND(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
     rs *= fNorm;
     mass = GET<Tf>(kd->pNumpyMass, kd->particleOffsets[pj]);
     rho = GET<Tf>(kd->pNumpyDen, kd->particleOffsets[pj]);
-    for (k = 0; k < 3; ++k)
+    for (k = 0; k < nDim; ++k)
       mean[k] += rs * mass * GET2<Tq>(kd->pNumpyQty, kd->particleOffsets[pj], k) / rho;
   }
 
@@ -854,7 +880,7 @@ void smDispQtyND(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
     rs *= fNorm;
     mass = GET<Tf>(kd->pNumpyMass, kd->particleOffsets[pj]);
     rho = GET<Tf>(kd->pNumpyDen, kd->particleOffsets[pj]);
-    for (k = 0; k < 3; ++k) {
+    for (k = 0; k < nDim; ++k) {
       tdiff = mean[k] - GET2<Tq>(kd->pNumpyQty, kd->particleOffsets[pj], k);
       ACCUM<Tq>(kd->pNumpyQtySmoothed, pi_iord,
                 rs * mass * tdiff * tdiff / rho);
@@ -867,6 +893,63 @@ void smDispQtyND(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
           sqrt(GET<Tq>(kd->pNumpyQtySmoothed, pi_iord)));
 }
 
+template <typename Tf, typename Tq>
+void smDispQtyColumns(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
+  // As smDispQtyND, but returns the dispersion of each column separately rather than combining them
+  Tf fNorm, ih2, r2, rs, ih, mass, rho;
+  npy_intp j, k, pj, pi_iord;
+  KDContext* kd = smx->kd;
+  npy_intp nDim = PyArray_DIM(kd->pNumpyQty, 1);
+  Tq tdiff;
+
+  auto & kernel = *(smx->pKernel);
+
+  pi_iord = kd->particleOffsets[pi];
+  ih = 1.0 / GET<Tf>(kd->pNumpySmooth, pi_iord);
+  ih2 = ih * ih;
+  fNorm = M_1_PI * ih * ih2;
+
+  auto & mean = smx->qtyWorkspace;
+  mean.assign(nDim, 0.0);
+
+  // pass 1: find mean
+
+  for (j = 0; j < nSmooth; ++j) {
+    pj = smx->pList[j];
+    r2 = smx->fList[j] * ih2;
+    rs = kernel(r2);
+    rs *= fNorm;
+    mass = GET<Tf>(kd->pNumpyMass, kd->particleOffsets[pj]);
+    rho = GET<Tf>(kd->pNumpyDen, kd->particleOffsets[pj]);
+    for (k = 0; k < nDim; ++k)
+      mean[k] += rs * mass * GET2<Tq>(kd->pNumpyQty, kd->particleOffsets[pj], k) / rho;
+  }
+
+  // pass 2: get variance
+
+  for (k = 0; k < nDim; ++k)
+    SET2<Tq>(kd->pNumpyQtySmoothed, pi_iord, k, 0.0);
+
+  for (j = 0; j < nSmooth; ++j) {
+    pj = smx->pList[j];
+    r2 = smx->fList[j] * ih2;
+    rs = kernel(r2);
+    rs *= fNorm;
+    mass = GET<Tf>(kd->pNumpyMass, kd->particleOffsets[pj]);
+    rho = GET<Tf>(kd->pNumpyDen, kd->particleOffsets[pj]);
+    for (k = 0; k < nDim; ++k) {
+      tdiff = mean[k] - GET2<Tq>(kd->pNumpyQty, kd->particleOffsets[pj], k);
+      ACCUM2<Tq>(kd->pNumpyQtySmoothed, pi_iord, k, rs * mass * tdiff * tdiff / rho);
+    }
+  }
+
+  // finally: take square root to get dispersion
+
+  for (k = 0; k < nDim; ++k)
+    SET2<Tq>(kd->pNumpyQtySmoothed, pi_iord, k,
+             sqrt(GET2<Tq>(kd->pNumpyQtySmoothed, pi_iord, k)));
+}
+
 template <typename Tf, typename Tq>
 void smDispQty1D(SmoothingContext<Tf> * smx, npy_intp pi, int nSmooth) {
   Tf fNorm, ih2, r2, rs, ih, mass, rho;
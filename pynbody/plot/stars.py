@@ -68,6 +68,10 @@ def _combine(r, g, b, magnitude_range, brightest_mag=None, masked=False):
 					   for channel in (r, g, b)], axis=-1)
 	return rgbim, -brightest_mag
 
+def _derive_mags_for_lum_den(stars, bands):
+	"""Derive the magnitudes needed for the ``<band>_lum_den`` arrays of several bands, sharing one SSP interpolation"""
+	pynbody.analysis.luminosity.derive_mags(stars, [b for b in bands if b + '_lum_den' not in stars])
+
 def _convert_to_mag_arcsec2(image, angular=False):
 	if not angular:
 		assert image.units=="pc^-2"
@@ -221,6 +225,8 @@ def render(sim,
 
 	'''
 
+	_derive_mags_for_lum_den(sim.s, [r_band, g_band, b_band])
+
 	renderer = renderers.make_render_pipeline(sim.s, quantity=r_band + '_lum_den', width=width,
 											  out_units="pc^-2", resolution=resolution)
 
@@ -418,6 +424,8 @@ def render_mollweide(sim,
 	'''
 
 
+	_derive_mags_for_lum_den(sim.s, [r_band, g_band, b_band])
+
 	def _get_channel(band, scale):
 		renderer = renderers.make_render_pipeline(sim.s, quantity=sim.s[band + '_lum_den']/sim.s['r']**2,
 												  nside=nside, target='healpix', out_units="pc^-2 sr^-1")
@@ -18,11 +18,14 @@ import configparser
 import functools
 import itertools
 import logging
+import multiprocessing
+import time
 import warnings
 
 import numpy as np
 
-from .. import config_parser, family, units, util
+from .. import chunk, config_parser, family, units, util
+from ..array import shared
 from . import SimSnap, namemapper
 
 logger = logging.getLogger('pynbody.snapshot.gadgethdf')
@@ -48,6 +51,15 @@ for hdf_groups in _default_type_map.values():
 
 
 
+@shared.shared_array_remote
+def _read_hdf_datasets_remote(filename, dataset_names, target, starts, stops):
+    """Read the named datasets from one HDF file into slices of a shared-memory target array"""
+    with h5py.File(filename, 'r') as f:
+        for dataset_name, i0, i1 in zip(dataset_names, starts, stops):
+            dataset = f[dataset_name]
+            dataset.read_direct(target[i0:i1].reshape(dataset.shape))
+
+
 class _DummyHDFData:
 
     """A stupid class to allow emulation of mass arrays for particles
@@ -63,9 +75,12 @@ class _DummyHDFData:
     def __len__(self):
         return self.length
 
-    def read_direct(self, target):
+    def read_direct(self, target, source_sel=None):
         target[:] = self.value
 
+    def __getitem__(self, item):
+        return np.full(len(range(*item.indices(self.length))), self.value, dtype=self.dtype)
+
 
 class _GadgetHdfMultiFileManager:
     _nfiles_groupname = "Header"
@@ -172,19 +187,49 @@ class GadgetHDFSnap(SimSnap):
     _mass_pynbody_name = "mass"
     _eps_pynbody_name = "eps"
 
-    def __init__(self, filename):
+    _reader_pool = None
+    _reader_pool_size = None
+
+    def __init__(self, filename, take=None, take_region=None):
         """Initialise a Gadget HDF snapshot.
 
         Spanned files are supported. To load a range of files ``snap.0.hdf5``, ``snap.1.hdf5``, ... ``snap.n.hdf5``,
         pass the filename ``snap``. If you pass e.g. ``snap.2.hdf5``, only file 2 will be loaded.
+
+        If *take* is specified, it gives the indices of the particles to load (in the order of the full snapshot),
+        and only the hyperslabs of each file spanning those particles are read from disk. This is used, for example,
+        by :meth:`~pynbody.halo.HaloCatalogue.load_copy` to load single halos from SubFind catalogues.
+
+        If *take_region* is specified instead, it is a filter selecting the region to load, using a spatial index
+        previously created with :func:`pynbody.chunk.spatial_index.build_spatial_index`. The particles in cells of
+        the index that intersect the region are then loaded through the same mechanism as *take*.
+
+        Spanned files are read in parallel by the number of reader processes given by the ``parallel-read`` option
+        in the ``[gadgethdf]`` section of the configuration. The time taken to read each array is recorded in
+        :attr:`hdf_read_timings`, to help with choosing the number of readers.
         """
 
         super().__init__()
 
         self._filename = filename
 
+        if take is not None and take_region is not None:
+            raise ValueError("Either take or take_region may be specified, not both")
+
+        self._take = None if take is None else np.unique(np.asarray(take, dtype=np.int64))
+
+        #: Dictionary mapping each array name to information about how it was read (time taken, number of bytes,
+        #: number of files and number of reader processes)
+        self.hdf_read_timings = {}
+
         self._init_hdf_filemanager(filename)
 
+        if take_region is not None:
+            self._take = chunk.spatial_index.SpatialIndex.load(
+                filename, self._spatial_index_files()).particles_in_region(take_region)
+
+        self.partial_load = self._take is not None
+
         self._translate_array_name = namemapper.AdaptiveNameMapper(self._namemapper_config_section,
                                                                    return_all_format_names=True) # required for swift
         self._init_unit_information()
@@ -195,6 +240,9 @@ class GadgetHDFSnap(SimSnap):
         self._init_properties()
         self._decorate()
 
+    def _spatial_index_files(self):
+        return self._hdf_files._filenames
+
     def _have_softening_for_particle_type(self, particle_type):
         attrs = self._get_hdf_parameter_attrs()
         class_name = self._softening_class_key + str(particle_type)
@@ -279,6 +327,11 @@ class GadgetHDFSnap(SimSnap):
 
         self._gadget_ptype_slice = {} # will map from gadget particle type to location in pynbody logical file map
 
+        # when partially loading, maps from gadget particle type to the indices (relative to the start of that
+        # particle type on disk) of the particles to be taken
+        self._gadget_ptype_take = {}
+        disk_ptype_start = 0
+
         for fam in all_families_sorted:
             family_length = 0
 
@@ -299,6 +352,14 @@ class GadgetHDFSnap(SimSnap):
                 ptype_slice_len = 0
                 for hdf_group in self._hdf_files.iter_particle_groups_with_name(particle_type):
                     ptype_slice_len += hdf_group[self._size_from_hdf5_key].size
+
+                if self._take is not None:
+                    disk_ptype_end = disk_ptype_start + ptype_slice_len
+                    take_start, take_end = np.searchsorted(self._take, [disk_ptype_start, disk_ptype_end])
+                    self._gadget_ptype_take[particle_type] = self._take[take_start:take_end] - disk_ptype_start
+                    disk_ptype_start = disk_ptype_end
+                    ptype_slice_len = take_end - take_start
+
                 self._gadget_ptype_slice[particle_type] = slice(ptype_slice_start, ptype_slice_start + ptype_slice_len)
                 family_length += ptype_slice_len
                 ptype_slice_start += ptype_slice_len
@@ -366,6 +427,9 @@ class GadgetHDFSnap(SimSnap):
         raise RuntimeError("Not implemented")
 
     def write_array(self, array_name, fam=None, overwrite=False):
+        if self.partial_load:
+            raise RuntimeError("Writing back to partially loaded files not yet supported")
+
         translated_name = self._translate_array_name(array_name)[0]
 
         self._hdf_files.reopen_in_mode('r+')
@@ -540,32 +604,110 @@ class GadgetHDFSnap(SimSnap):
                 target = self[fam]
                 all_fams_to_load = [fam]
 
-            target._create_array(array_name, dy, dtype=dtype)
+            # work out up front where each dataset goes in the target array, so that reads can be farmed out
+            read_tasks = []
+            for loading_fam in all_fams_to_load:
+                i0 = 0 if fam is not None else self._get_family_slice(loading_fam).start
+                for particle_type in self._family_to_group_map[loading_fam]:
+                    disk_i0 = 0
+                    for hdf in self._hdf_files.iter_particle_groups_with_name(particle_type):
+                        npart = hdf['ParticleIDs'].size
+                        disk_i1 = disk_i0 + npart
+                        selection = None
+                        if self._take is not None:
+                            ptype_take = self._gadget_ptype_take[particle_type]
+                            take_start, take_end = np.searchsorted(ptype_take, [disk_i0, disk_i1])
+                            selection = ptype_take[take_start:take_end] - disk_i0
+                            npart = len(selection)
+                        disk_i0 = disk_i1
+
+                        if npart == 0:
+                            continue
+                        i1 = i0+npart
+
+                        for translated_name in translated_names:
+                            try:
+                                dataset = self._get_hdf_dataset(hdf, translated_name)
+                            except KeyError:
+                                continue
+                        read_tasks.append((dataset, selection, i0, i1))
+
+                        i0 = i1
+
+            num_readers = int(config_parser.get('gadgethdf', 'parallel-read'))
+            num_files = len({dataset.file.filename for dataset, _, _, _ in read_tasks
+                             if isinstance(dataset, h5py.Dataset)})
+            # partial loads read only small hyperslabs, so are always performed on the main process
+            parallel = num_readers > 1 and num_files > 1 and self._take is None
+
+            target._create_array(array_name, dy, dtype=dtype, shared=parallel)
 
             if units is not None:
                 target[array_name].units = units
             else:
                 target[array_name].set_default_units()
 
-            for loading_fam in all_fams_to_load:
-                i0 = 0
-                for hdf in self._all_hdf_groups_in_family(loading_fam):
-                    npart = hdf['ParticleIDs'].size
-                    if npart == 0:
-                        continue
-                    i1 = i0+npart
-
-                    for translated_name in translated_names:
-                        try:
-                            dataset = self._get_hdf_dataset(hdf, translated_name)
-                        except KeyError:
-                            continue
-                    target_array = self[loading_fam][array_name][i0:i1]
-                    assert target_array.size == dataset.size
+            start = time.time()
+            target_array = target[array_name]
+            if parallel:
+                self._read_hdf_datasets_in_parallel(read_tasks, target_array, num_readers)
+            else:
+                for dataset, selection, i0, i1 in read_tasks:
+                    self._read_hdf_dataset(dataset, selection, target_array[i0:i1])
+            end = time.time()
+
+            self.hdf_read_timings[array_name] = {'time': end - start, 'bytes': target_array.nbytes,
+                                                 'files': num_files, 'readers': num_readers if parallel else 1}
+            logger.info("Read %s from %d files with %d reader(s) in %.2fs",
+                        array_name, num_files, num_readers if parallel else 1, end - start)
+
+    @staticmethod
+    def _read_hdf_dataset(dataset, selection, target_array):
+        """Read the particles with the specified indices (or all particles, if selection is None) from a dataset"""
+        if selection is None:
+            assert target_array.size == dataset.size
+            dataset.read_direct(target_array.reshape(dataset.shape))
+            return
+
+        # some versions of gadget fold 3D arrays into 1D, in which case each particle spans several rows
+        rows_per_particle = target_array.size // len(selection) // int(np.prod(dataset.shape[1:]))
+        start, stop = selection[0] * rows_per_particle, (selection[-1] + 1) * rows_per_particle
+
+        if selection[-1] - selection[0] + 1 == len(selection):
+            # contiguous, e.g. a halo from a SubFind catalogue, so can read the hyperslab straight into the target
+            target_shape = (stop - start,) + dataset.shape[1:]
+            dataset.read_direct(target_array.reshape(target_shape), source_sel=np.s_[start:stop])
+        else:
+            # read the hyperslab spanning the selection, then pick out the required particles
+            hyperslab = dataset[start:stop].reshape((stop - start) // rows_per_particle, -1)
+            target_array[:] = hyperslab[selection - selection[0]].reshape(target_array.shape)
+
+    @staticmethod
+    def _get_reader_pool(num_readers):
+        if GadgetHDFSnap._reader_pool is None or GadgetHDFSnap._reader_pool_size != num_readers:
+            if GadgetHDFSnap._reader_pool is not None:
+                GadgetHDFSnap._reader_pool.close()
+            GadgetHDFSnap._reader_pool = multiprocessing.Pool(num_readers)
+            GadgetHDFSnap._reader_pool_size = num_readers
+        return GadgetHDFSnap._reader_pool
+
+    def _read_hdf_datasets_in_parallel(self, read_tasks, target_array, num_readers):
+        """Read the specified (dataset, start, stop) tasks into the shared-memory target array, one file per job"""
+        tasks_by_file = {}
+        for dataset, _, i0, i1 in read_tasks:
+            if isinstance(dataset, h5py.Dataset):
+                tasks_by_file.setdefault(dataset.file.filename, []).append((dataset.name, i0, i1))
+            else:
+                # emulated datasets (e.g. masses from the header) are cheap to fill in locally
+                dataset.read_direct(target_array[i0:i1].reshape(dataset.shape))
 
-                    dataset.read_direct(target_array.reshape(dataset.shape))
+        filenames = list(tasks_by_file.keys())
+        dataset_names = [[name for name, _, _ in tasks_by_file[f]] for f in filenames]
+        starts = [[i0 for _, i0, _ in tasks_by_file[f]] for f in filenames]
+        stops = [[i1 for _, _, i1 in tasks_by_file[f]] for f in filenames]
 
-                    i0 = i1
+        shared.remote_map(self._get_reader_pool(num_readers), _read_hdf_datasets_remote,
+                          filenames, dataset_names, [target_array] * len(filenames), starts, stops)
 
     def __get_dtype_dims_and_units(self, fam, translated_names):
         if fam is None:
@@ -86,12 +86,21 @@ class NchiladaSnap(SimSnap):
             file and a number of binary files.
         take : np.ndarray, optional
             The array of particles to load. If not specified, all particles are loaded.
+        take_region : pynbody.filt.Filter, optional
+            If specified, load only particles in the given region, using a spatial index previously created with
+            :func:`pynbody.chunk.spatial_index.build_spatial_index`.
         """
 
         super().__init__()
 
         must_have_paramfile = kwargs.get('must_have_paramfile', False)
         take = kwargs.get('take', None)
+        take_region = kwargs.get('take_region', None)
+
+        if take_region is not None:
+            if take is not None:
+                raise ValueError("Either take or take_region may be specified, not both")
+            take = chunk.spatial_index.SpatialIndex.load(filename).particles_in_region(take_region)
 
         self._dom_sim = xml.dom.minidom.parse(
             os.path.join(filename, "description.xml")).getElementsByTagName('simulation')[0]
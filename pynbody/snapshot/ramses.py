@@ -44,6 +44,11 @@ else:
 _float_type = 'd'
 _int_type = 'i'
 
+_AMR_CACHE_FORMAT_VERSION = 1
+
+# level of the regular grid used to map a take_region onto CPU domains and AMR octs (i.e. 2**7 cells on a side)
+_REGION_SELECTION_LEVEL = 7
+
 def _timestep_id(basename):
     try:
         return re.findall("output_([0-9]*)/*$", str(basename))[0]
@@ -182,16 +187,164 @@ def _cpui_level_iterator(cpu, amr_filename, bisection_order, maxlevel, ndim):
                     f.skip(3 + ndim + 1 + 2 * ndim + 3 * 2 ** ndim)
 
 
+class _AMRStructure:
+    """Compact summary of the grids belonging to one CPU, extracted from its AMR file in a single pass.
+
+    Walking an AMR file involves parsing every Fortran record and skipping over the ghost and boundary grids that
+    belong to other CPUs. However, the only information needed to place gas cells and to locate them in the hydro,
+    gravity and RT files is the coordinates and refinement map of this CPU's own octs. These are therefore extracted
+    once, when the gas cells are counted, and kept in memory (and optionally on disk; see the ``amr-cache`` option
+    in the ``[ramses]`` section of the configuration).
+
+    Iterating over the structure yields the same ``(coords, refine, cpu, level)`` tuples as
+    :func:`_cpui_level_iterator`, without touching the disk.
+    """
+
+    def __init__(self, cpu, levels, offsets, coords, refined):
+        self.cpu = cpu
+        self.levels = levels  # level of each block of octs, in file order
+        self.offsets = offsets  # index of the first oct in each block, followed by the total number of octs
+        self.coords = coords  # (3, noct) coordinates of the octs
+        self.refined = refined  # (2**ndim, noct) True for cells that are refined, i.e. are not leaf cells
+
+    @classmethod
+    def from_amr_file(cls, cpu, amr_filename, bisection_order, maxlevel, ndim):
+        levels = []
+        coords = [np.zeros((3, 0), dtype=_float_type)]
+        refined = [np.zeros((2 ** ndim, 0), dtype=bool)]
+        for block_coords, refine, _, level in _cpui_level_iterator(cpu, amr_filename, bisection_order, maxlevel, ndim):
+            levels.append(level)
+            coords.append(np.array(block_coords))
+            refined.append(refine != 0)
+        offsets = np.cumsum([0] + [c.shape[1] for c in coords[1:]])
+        return cls(cpu, np.array(levels, dtype=np.int32), offsets,
+                   np.concatenate(coords, axis=1), np.concatenate(refined, axis=1))
+
+    @classmethod
+    def from_cache_or_amr_file(cls, level_iterator_args, cache_filename=None):
+        """Load the structure from *cache_filename* if it is up to date; otherwise parse the AMR file (and write
+        the cache, if a filename is given)"""
+        if cache_filename is None:
+            return cls.from_amr_file(*level_iterator_args)
+
+        cpu = level_iterator_args[0]
+        metadata = cls._cache_metadata(*level_iterator_args)
+        try:
+            with np.load(cache_filename, allow_pickle=False) as f:
+                if np.array_equal(f['metadata'], metadata):
+                    logger.info("Loaded AMR structure for CPU %d from %s", cpu, cache_filename)
+                    return cls(cpu, f['levels'], f['offsets'], f['coords'], f['refined'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        structure = cls.from_amr_file(*level_iterator_args)
+        try:
+            structure._save(cache_filename, metadata)
+        except OSError as e:
+            logger.warning("Unable to write AMR structure cache %s: %s", cache_filename, e)
+        return structure
+
+    @staticmethod
+    def _cache_metadata(cpu, amr_filename, bisection_order, maxlevel, ndim):
+        stat = os.stat(amr_filename)
+        return np.array([_AMR_CACHE_FORMAT_VERSION, stat.st_size, stat.st_mtime_ns,
+                         bisection_order, maxlevel or 0, ndim], dtype=np.int64)
+
+    def _save(self, filename, metadata):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # write to a temporary file then rename, so that a half-written cache is never seen by another process
+        temp_filename = filename + f".tmp{os.getpid()}"
+        with open(temp_filename, "wb") as f:
+            np.savez(f, metadata=metadata, levels=self.levels, offsets=self.offsets,
+                     coords=self.coords, refined=self.refined)
+        os.replace(temp_filename, filename)
+
+    @property
+    def ncells(self):
+        """The number of leaf cells, i.e. the number of gas cells that will be loaded from this CPU"""
+        return int(self.refined.size - np.count_nonzero(self.refined))
+
+    def __iter__(self):
+        for level, start, end in zip(self.levels, self.offsets[:-1], self.offsets[1:]):
+            yield list(self.coords[:, start:end]), self.refined[:, start:end], self.cpu, level
+
+
+    def restricted_to_cells(self, cell_mask):
+        """Return a copy of the structure in which only leaf cells lying in the selected cells of a regular grid remain
+
+        Cells outside the selection are marked as refined, so that they are skipped when loading gas. Cells that are
+        coarser than the grid are retained in their entirety.
+
+        Parameters
+        ----------
+        cell_mask : np.ndarray
+            A boolean array of shape ``(n, n, n)`` covering the unit box, where ``n`` is a power of two, indexed by
+            ``(x, y, z)`` cell index.
+        """
+        nside = cell_mask.shape[0]
+        ncell_per_oct = self.refined.shape[0]
+        oct_levels = np.repeat(self.levels, np.diff(self.offsets))
+
+        subgrid_index = np.arange(ncell_per_oct)[:, np.newaxis]
+        subgrid_offset = [(subgrid_index >> i) % 2 - 0.5 for i in range(3)]
+        dx = 0.5 ** (oct_levels + 1)
+
+        grid_index = [np.clip(np.floor((x0 + dx * offset) * nside).astype(np.intp), 0, nside - 1)
+                      for x0, offset in zip(self.coords, subgrid_offset)]
+        selected = cell_mask[tuple(grid_index)]
+        selected |= (dx > 1.0 / nside)
+
+        return _AMRStructure(self.cpu, self.levels, self.offsets, self.coords, self.refined | ~selected)
+
+
+def _hilbert3d(x, y, z, bit_length):
+    """Return the Hilbert keys of the integer cell coordinates x, y, z at the specified bit length.
+
+    This follows the state-diagram implementation in RAMSES (``hilbert3d`` in ``amr/hilbert.f90``), so that the keys
+    can be compared directly with the domain boundaries written in the ``info_XXXXX.txt`` file."""
+    state_diagram = np.array([1, 2, 3, 2, 4, 5, 3, 5,
+                              0, 1, 3, 2, 7, 6, 4, 5,
+                              2, 6, 0, 7, 8, 8, 0, 7,
+                              0, 7, 1, 6, 3, 4, 2, 5,
+                              0, 9, 10, 9, 1, 1, 11, 11,
+                              0, 3, 7, 4, 1, 2, 6, 5,
+                              6, 0, 6, 11, 9, 0, 9, 8,
+                              2, 3, 1, 0, 5, 4, 6, 7,
+                              11, 11, 0, 7, 5, 9, 0, 7,
+                              4, 3, 5, 2, 7, 0, 6, 1,
+                              4, 4, 8, 8, 0, 6, 10, 6,
+                              6, 5, 1, 2, 7, 4, 0, 3,
+                              5, 7, 5, 3, 1, 1, 11, 11,
+                              4, 7, 3, 0, 5, 6, 2, 1,
+                              6, 1, 6, 10, 9, 4, 9, 10,
+                              6, 7, 5, 4, 1, 0, 2, 3,
+                              10, 3, 1, 1, 10, 3, 5, 9,
+                              2, 5, 3, 4, 1, 6, 0, 7,
+                              4, 4, 8, 8, 2, 7, 2, 3,
+                              2, 1, 5, 6, 3, 0, 4, 7,
+                              7, 2, 11, 2, 7, 5, 8, 5,
+                              4, 5, 7, 6, 3, 2, 0, 1,
+                              10, 3, 2, 6, 10, 3, 4, 4,
+                              6, 1, 7, 0, 5, 2, 4, 3]).reshape((12, 2, 8))
+
+    x, y, z = (np.asarray(q, dtype=np.int64) for q in (x, y, z))
+    order = np.zeros(x.shape, dtype=np.int64)
+    state = np.zeros(x.shape, dtype=np.intp)
+    for i in range(bit_length - 1, -1, -1):
+        sdigit = ((x >> i) & 1) * 4 + ((y >> i) & 1) * 2 + ((z >> i) & 1)
+        hdigit = state_diagram[state, 1, sdigit]
+        state = state_diagram[state, 0, sdigit]
+        order = (order << 3) | hdigit
+    return order
+
+
 @remote_exec
-def _cpui_count_gas_cells(level_iterator_args):
-    ncell = 0
-    for coords, refine, cpu, level in _cpui_level_iterator(*level_iterator_args):
-        ncell += (refine == 0).sum()
-    return ncell
+def _cpui_amr_structure(level_iterator_args, cache_filename):
+    return _AMRStructure.from_cache_or_amr_file(level_iterator_args, cache_filename)
 
 
 @remote_exec
-def _cpui_load_gas_pos(pos_array, smooth_array, ndim, boxlen, i0, level_iterator_args):
+def _cpui_load_gas_pos(pos_array, smooth_array, ndim, boxlen, i0, amr_structure):
     dims = [pos_array[:, i] for i in range(ndim)]
     subgrid_index = np.arange(2 ** ndim)[:, np.newaxis]
     subgrid_z = np.floor((subgrid_index) / 4)
@@ -201,7 +354,7 @@ def _cpui_load_gas_pos(pos_array, smooth_array, ndim, boxlen, i0, level_iterator
     subgrid_y -= 0.5
     subgrid_z -= 0.5
 
-    for (x0, y0, z0), refine, cpu, level in _cpui_level_iterator(*level_iterator_args):
+    for (x0, y0, z0), refine, cpu, level in amr_structure:
         dx = boxlen * 0.5 ** (level + 1)
 
         x0 = boxlen * x0 + dx * subgrid_x
@@ -223,13 +376,13 @@ _gv_load_rt = 2
 
 
 @remote_exec
-def _cpui_load_gas_vars(dims, maxlevel, ndim, filename, cpu, lia, i1,
+def _cpui_load_gas_vars(dims, maxlevel, ndim, filename, cpu, amr_structure, i1,
                         mode=_gv_load_hydro):
 
     logger.info("Loading data from CPU %d", cpu)
 
     nvar = len(dims)
-    grid_info_iter = _cpui_level_iterator(*lia)
+    grid_info_iter = iter(amr_structure)
 
     with FortranFile(filename) as f:
         exact_nvar = False
@@ -350,6 +503,7 @@ particle_format = [TYPE_MAP[str.strip(e)] for e in config_parser.get('ramses', "
 
 hydro_blocks = [_.strip() for _ in config_parser.get('ramses', "hydro-blocks").split(",")]
 grav_blocks = [_.strip() for _ in config_parser.get('ramses', "gravity-blocks").split(",")]
+amr_cache_by_default = config_parser.getboolean('ramses', 'amr-cache')
 rt_blocks = [_.strip() for _ in config_parser.get('ramses', 'rt-blocks', raw=True).split(",")]
 
 particle_distinguisher = [_.strip() for _ in config_parser.get('ramses', 'particle-distinguisher').split(",")]
@@ -381,7 +535,8 @@ class RamsesSnap(SimSnap):
     """
     reader_pool = None
 
-    def __init__(self, dirname, cpus=None, maxlevel=None, with_gas=True, force_gas=False, times_are_proper=None):
+    def __init__(self, dirname, cpus=None, maxlevel=None, with_gas=True, force_gas=False, times_are_proper=None,
+                 amr_cache=None, take_region=None):
         """
         Initialize a RamsesSnap.
 
@@ -407,6 +562,17 @@ class RamsesSnap(SimSnap):
             times. If False, they are assumed to be conformal. If
             None (default), assume proper for non-cosmological simulations
             and conformal for cosmological ones.
+        amr_cache : bool, optional
+            If True, the AMR structure (the positions and refinement maps of the octs) is stored on disk in a
+            directory alongside the output the first time it is read, and re-used in later sessions. If None
+            (default), use the ``amr-cache`` option in the ``[ramses]`` section of the configuration.
+        take_region : pynbody.filt.Filter, optional
+            If specified, load only the CPU domains that intersect this region, and within them only the gas cells
+            near the region. The filter must implement ``cubic_cell_intersection`` (e.g. a
+            :class:`~pynbody.filt.Sphere` or :class:`~pynbody.filt.Cuboid`) and is specified in the units used on
+            disk, i.e. such that the box spans 0 to ``boxlen``. The selection is made on a regular grid of up to
+            128 cells on a side, and all particles in the selected CPU domains are loaded, so apply the same filter
+            to the loaded snapshot to get the exact selection. Cannot be combined with *cpus*.
         """
 
         global config
@@ -437,11 +603,18 @@ class RamsesSnap(SimSnap):
 
         self._ndim = self._info['ndim']
         self.ncpu = self._info['ncpu']
-        if cpus is not None:
+        self._region_cell_mask = None
+        if take_region is not None:
+            if cpus is not None:
+                raise ValueError("Either cpus or take_region may be specified, not both")
+            self._cpus = self._cpus_in_region(take_region)
+        elif cpus is not None:
             self._cpus = cpus
         else:
             self._cpus = list(range(1, self.ncpu + 1))
         self._maxlevel = maxlevel
+        self._amr_cache = amr_cache_by_default if amr_cache is None else amr_cache
+        self._amr_structures = []
 
         type_map = self._count_particles()
 
@@ -844,11 +1017,84 @@ class RamsesSnap(SimSnap):
         return npart - nstar, nstar
 
     def _count_gas_cells(self):
-        ncells = remote_map(self.reader_pool, _cpui_count_gas_cells,
-                            [self._cpui_level_iterator_args(xcpu) for xcpu in self._cpus])
+        self._amr_structures = remote_map(self.reader_pool, _cpui_amr_structure,
+                                          self._cpui_level_iterator_args(),
+                                          [self._amr_cache_filename(xcpu) for xcpu in self._cpus])
+        if self._region_cell_mask is not None:
+            self._amr_structures = [structure.restricted_to_cells(self._region_cell_mask)
+                                    for structure in self._amr_structures]
+        ncells = [structure.ncells for structure in self._amr_structures]
         self._gas_i0 = np.cumsum([0] + ncells)[:-1]
         return np.sum(ncells)
 
+    def _cpus_in_region(self, take_region):
+        """Return the CPUs whose domains intersect the specified region.
+
+        As a side effect, stores the regular grid of cells intersecting the region, which is later used to skip AMR
+        octs outside the region."""
+        if self._ndim != 3:
+            raise ValueError("take_region is only supported for three-dimensional RAMSES snapshots")
+
+        level = min(_REGION_SELECTION_LEVEL, self._info['levelmax'])
+        nside = 2 ** level
+        centres_1d = (np.arange(nside) + 0.5) * (self._info['boxlen'] / nside)
+        centroids = np.stack(np.meshgrid(centres_1d, centres_1d, centres_1d, indexing='ij'), axis=-1).reshape(-1, 3)
+        self._region_cell_mask = take_region.cubic_cell_intersection(centroids).astype(bool).reshape((nside,) * 3)
+
+        if self._info['ordering type'] != 'hilbert':
+            warnings.warn("Domain boundaries are only available for Hilbert-ordered RAMSES outputs; all CPU domains "
+                          "will be read, skipping only the AMR cells outside the region", RuntimeWarning)
+            return list(range(1, self.ncpu + 1))
+
+        bound_key = self._load_hilbert_domain_boundaries()
+
+        # each grid cell spans a contiguous range of keys at the resolution of the finest level
+        order = _hilbert3d(*np.nonzero(self._region_cell_mask), level).astype(np.float64)
+        dkey = float(2 ** (self._info['levelmax'] + 1 - level)) ** 3
+        cpu_min = np.searchsorted(bound_key, order * dkey, side='right')
+        cpu_max = np.searchsorted(bound_key, (order + 1) * dkey, side='left')
+
+        # mark every domain between cpu_min and cpu_max (inclusive) for each cell
+        domain_count = np.zeros(self.ncpu + 2, dtype=np.intp)
+        np.add.at(domain_count, np.clip(cpu_min, 1, self.ncpu), 1)
+        np.add.at(domain_count, np.clip(cpu_max, 1, self.ncpu) + 1, -1)
+        cpus = np.nonzero(np.cumsum(domain_count)[:-1])[0]
+
+        logger.info("Region intersects %d of %d CPU domains", len(cpus), self.ncpu)
+        return [int(cpu) for cpu in cpus]
+
+    def _load_hilbert_domain_boundaries(self):
+        """Read the Hilbert key boundaries of the CPU domains from the info file.
+
+        Returns an array of length ncpu+1, such that CPU i (1-based) holds the keys from element i-1 to element i."""
+        info_fname = os.path.join(self._filename, f"info_{self._timestep_id}.txt")
+        bound_key = []
+        with open(info_fname) as f:
+            for line in f:
+                if line.split()[:1] == ['DOMAIN']:
+                    break
+            for line in f:
+                fields = line.split()
+                if len(fields) != 3:
+                    break
+                if not bound_key:
+                    bound_key.append(float(fields[1]))
+                bound_key.append(float(fields[2]))
+
+        if len(bound_key) != self.ncpu + 1:
+            raise OSError("Unable to read the CPU domain boundaries from %s" % info_fname)
+
+        return np.array(bound_key)
+
+    def _amr_cache_filename(self, cpu):
+        """Return the filename for the cached AMR structure of the given CPU, or None if caching is disabled"""
+        if not self._amr_cache:
+            return None
+        basename = os.path.basename(self._amr_filename(cpu))
+        if self._maxlevel:
+            basename += f"-maxlevel{self._maxlevel}"
+        return os.path.join(os.path.abspath(self._filename).rstrip(os.sep) + ".amr-cache", basename + ".npz")
+
     def _cpui_level_iterator_args(self, cpu=None):
         if cpu:
             return cpu, self._amr_filename(cpu), self._info['ordering type'] == 'bisection', self._maxlevel, self._ndim
@@ -856,11 +1102,11 @@ class RamsesSnap(SimSnap):
             return [self._cpui_level_iterator_args(x) for x in self._cpus]
 
     def _level_iterator(self):
-        """Walks the AMR grid levels on disk, yielding a tuplet of coordinates and
+        """Walks the AMR grid levels, yielding a tuplet of coordinates and
         refinement maps and levels working through the available CPUs and levels."""
 
-        for cpu in self._cpus:
-            yield from _cpui_level_iterator(*self._cpui_level_iterator_args(cpu))
+        for structure in self._amr_structures:
+            yield from structure
 
     def _load_gas_pos(self):
         self.gas['pos'].set_default_units()
@@ -876,7 +1122,7 @@ class RamsesSnap(SimSnap):
                    [self._ndim] * len(self._cpus),
                    [boxlen] * len(self._cpus),
                    self._gas_i0,
-                   self._cpui_level_iterator_args())
+                   self._amr_structures)
 
     def _load_gas_vars(self, mode=_gv_load_hydro):
         dims = []
@@ -900,8 +1146,6 @@ class RamsesSnap(SimSnap):
             self.gas['rho'].set_default_units()
 
 
-        _grid_info_iter = self._level_iterator()
-
         logger.info("Loading %s files", ['hydro', 'grav', 'rt'][mode])
 
         filenamer = [self._hydro_filename, self._grav_filename, self._rt_filename][mode]
@@ -913,7 +1157,7 @@ class RamsesSnap(SimSnap):
                    [self._ndim] * len(self._cpus),
                    [filenamer(i) for i in self._cpus],
                    self._cpus,
-                   self._cpui_level_iterator_args(),
+                   self._amr_structures,
                    self._gas_i0,
                    [mode] * len(self._cpus))
 
@@ -987,12 +1231,8 @@ class RamsesSnap(SimSnap):
 
     def _load_gas_cpuid(self):
         gas_cpu_ar = self.gas['cpu']
-        i1 = 0
-        for coords, refine, cpu, level in self._level_iterator():
-            for cell in range(2 ** self._ndim):
-                i0 = i1
-                i1 = i0 + (refine[cell] == 0).sum()
-                gas_cpu_ar[i0:i1] = cpu
+        for structure, i0 in zip(self._amr_structures, self._gas_i0):
+            gas_cpu_ar[i0:i0 + structure.ncells] = structure.cpu
 
     def loadable_keys(self, fam=None):
 
@@ -7,6 +7,7 @@ For an introduction, see :doc:`/tutorials/data_access`."""
 
 from __future__ import annotations
 
+import contextlib
 import copy
 import gc
 import hashlib
@@ -71,6 +72,9 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
     _loadable_keys_registry = {}
     _persistent = ["kdtree", "_immediate_cache", "_kdtree_derived_smoothing"]
 
+    # kdtrees that have been informed of an ongoing rigid transformation, and so survive changes to 'pos'
+    _kdtrees_surviving_position_change = ()
+
     # These 3D arrays get four views automatically created, one reflecting the
     # full Nx3 data, the others reflecting Nx1 slices of it
     #
@@ -161,6 +165,9 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
 
         self._persistent_objects = {}
 
+        # rotations recorded but not yet applied, keyed by (array name, family or None); see _defer_rotation
+        self._pending_rotations = {}
+
         self._unifamily = None
 
         # If True, when new arrays are created they are in shared memory by
@@ -307,6 +314,9 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
         self._set_array(name, ax, index)
 
     def __delitem__(self, name):
+        for key in [key for key in self._pending_rotations if key[0] == name]:
+            del self._pending_rotations[key]
+
         if name in self._family_arrays:
             # mustn't have simulation-level array of this name
             assert name not in self._arrays
@@ -967,6 +977,8 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
             raise RuntimeError(
                 'Cannot infer a filename; please provide one (use obj.write(filename="filename"))')
 
+        self.ancestor._apply_all_pending_rotations()
+
         if fmt is None:
             if not hasattr(self, "_write"):
                 raise RuntimeError(
@@ -1217,6 +1229,7 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
 
     def _del_family_array(self, array_name, family):
         """Delete the array with the specified name for the specified family"""
+        self._pending_rotations.pop((array_name, family), None)
         del self._family_arrays[array_name][family]
         if len(self._family_arrays[array_name]) == 0:
             del self._family_arrays[array_name]
@@ -1251,6 +1264,9 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
         _get_array_with_lazy_actions.
         """
 
+        if self._pending_rotations:
+            self._apply_pending_rotation(self._array_name_1D_to_ND(name) or name)
+
         x = self._arrays[name]
         if x.derived and not always_writable:
             x = x.view()
@@ -1281,6 +1297,9 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
         _get_array_with_lazy_actions on the FamilySubSnap returned by self[fam].
         """
 
+        if self._pending_rotations:
+            self._apply_pending_rotation(self._array_name_1D_to_ND(name) or name, fam)
+
         try:
             x = self._family_arrays[name][fam]
         except KeyError:
@@ -1305,15 +1324,61 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
         """Update the contents of the snapshot-level array to that
         specified by *value*. If *index* is not None, update only that
         subarray specified."""
+        if self._pending_rotations:
+            self._apply_pending_rotation(self._array_name_1D_to_ND(name) or name)
         util.set_array_if_not_same(self._arrays[name], value, index)
 
     def _set_family_array(self, name, family, value, index=None):
         """Update the contents of the family-level array to that
         specified by *value*. If *index* is not None, update only that
         subarray specified."""
+        if self._pending_rotations:
+            self._apply_pending_rotation(self._array_name_1D_to_ND(name) or name, family)
         util.set_array_if_not_same(self._family_arrays[name][family],
                                    value, index)
 
+    def _defer_rotation(self, matrix):
+        """Rotate all non-derived 3D arrays by *matrix*, deferring the work until each array is next accessed.
+
+        This is used by :class:`pynbody.transformation.Rotation` and may only be called on the ancestor snapshot.
+        Any quantities depending on the rotated arrays are invalidated immediately."""
+        assert self is self.ancestor, "Rotations can only be deferred for an entire snapshot"
+
+        targets = [(name, None) for name in self.keys()]
+        for name in self.family_keys():
+            targets += [(name, fam) for fam in self._family_arrays[name]]
+
+        with self._get_array_lock:
+            for name, fam in targets:
+                # earlier iterations may have deleted derived arrays
+                ar = self._arrays.get(name) if fam is None else self._family_arrays.get(name, {}).get(fam)
+                if ar is None or self.is_derived_array(name, fam) or len(ar.shape) != 2 or ar.shape[1] != 3:
+                    continue
+
+                previous = self._pending_rotations.get((name, fam))
+                composed = np.asarray(matrix) if previous is None else np.dot(matrix, previous)
+
+                if np.allclose(composed, np.eye(3), rtol=0, atol=1e-14):
+                    # e.g. a rotation that is reverted before the array has been accessed
+                    self._pending_rotations.pop((name, fam), None)
+                else:
+                    self._pending_rotations[(name, fam)] = composed
+
+                self._dirty(name)
+
+    def _apply_pending_rotation(self, name, fam=None):
+        """Apply any deferred rotation to the named array (see :meth:`_defer_rotation`)"""
+        with self._get_array_lock:
+            matrix = self._pending_rotations.pop((name, fam), None)
+            if matrix is not None:
+                ar = self._arrays[name] if fam is None else self._family_arrays[name][fam]
+                transformation._rotate_in_place(ar, matrix)
+
+    def _apply_all_pending_rotations(self):
+        """Apply all deferred rotations, e.g. before the arrays are accessed in bulk"""
+        for name, fam in list(self._pending_rotations.keys()):
+            self._apply_pending_rotation(name, fam)
+
     def _create_arrays(self, array_list, ndim=1, dtype=None, zeros=True):
         """Create a set of arrays *array_list* of dimension len(self) x ndim, with
         a given numpy dtype."""
@@ -1371,6 +1436,9 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
                     [name, ndim, dtype, derived, shared])
             return None
 
+        for fam in self._family_arrays.get(name, {}):
+            self._apply_pending_rotation(name, fam)
+
         if dtype is None:
             try:
                 x = list(self._family_arrays[name].keys())[0]
@@ -1613,9 +1681,15 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
 
         name = self._array_name_1D_to_ND(name) or name
         if name=='pos':
+            surviving = self.ancestor._kdtrees_surviving_position_change
             for v in self.ancestor._persistent_objects.values():
-                if 'kdtree' in v:
+                if 'kdtree' in v and not any(v['kdtree'] is tree for tree in surviving):
                     del v['kdtree']
+        elif name=='smooth':
+            # neighbour lists cached by a tree were found using the old smoothing lengths
+            for v in self.ancestor._persistent_objects.values():
+                if 'kdtree' in v:
+                    v['kdtree'].clear_neighbour_cache()
 
         if not self.auto_propagate_off:
             for d_ar in self._dependency_tracker.get_dependents(name):
@@ -1701,7 +1775,7 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
     # KD-Tree
     ############################################
 
-    def build_tree(self, num_threads=None, shared_mem=None) -> None:
+    def build_tree(self, num_threads=None, shared_mem=None, cache=None) -> None:
         """Build a kdtree for SPH operations and for accelerating geometrical filters
 
         Parameters
@@ -1714,16 +1788,47 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
             Whether to use shared memory for the tree. This is used by the tangos library to
             share a kdtree between different processes. It is not recommended for general use,
             and defaults to False.
+        cache : bool, optional
+            Whether to store the tree on disk alongside the snapshot, and to re-use a previously stored tree
+            where one is available. See :mod:`pynbody.kdtree.cache` for details. If None, the ``tree-cache``
+            option in the ``[sph]`` section of the configuration is used. Caching is not used in combination with
+            ``shared_mem``.
+
+        Translating or rotating the snapshot normally discards the tree. If the ``tree-survives-transformation``
+        option in the ``[sph]`` section of the configuration is True, the tree is kept instead, at the cost of a
+        private copy of the positions held by the tree (see :meth:`pynbody.kdtree.KDTree.apply_rigid_transformation`).
         """
         if not hasattr(self, 'kdtree'):
             from .. import kdtree
             from ..configuration import config
             boxsize = self._get_boxsize_for_kdtree()
+            leafsize = config['sph']['tree-leafsize']
+
+            if cache is None:
+                cache = config['sph']['tree-cache']
+
+            tree_cache = None
+            if cache and not shared_mem:
+                tree_cache = kdtree.cache.KDTreeCache(self, leafsize, boxsize)
+                cached = tree_cache.load_tree()
+                if cached is not None:
+                    kdnodes, particle_offsets = cached
+                    self.kdtree = kdtree.KDTree.deserialize(self['pos'], self['mass'],
+                                                            (leafsize, boxsize, kdnodes, particle_offsets, None),
+                                                            boxsize=boxsize, num_threads=num_threads)
+                    self.kdtree.set_kernel(config['sph']['kernel'])
+                    self.kdtree.disk_cache = tree_cache
+                    return
+
             self.kdtree = kdtree.KDTree(self['pos'], self['mass'],
-                                        leafsize=config['sph']['tree-leafsize'],
+                                        leafsize=leafsize,
                                         boxsize=boxsize, num_threads=num_threads,
                                         shared_mem=shared_mem)
 
+            if tree_cache is not None:
+                tree_cache.save_tree(self.kdtree)
+                self.kdtree.disk_cache = tree_cache
+
     def import_tree(self, serialized_tree, num_threads=None) -> None:
         """Import a precomputed kdtree from a serialized form.
 
@@ -1734,6 +1839,46 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
                                          serialized_tree,
                                          boxsize=self._get_boxsize_for_kdtree(),
                                          num_threads=num_threads)
+
+    @contextlib.contextmanager
+    def _rigid_transformation_of_positions(self, matrix=None, offset=None):
+        """Context manager for code that rigidly transforms the positions of all particles in this snapshot
+
+        Within the context, the positions are expected to be mapped from ``x`` to ``matrix @ x + offset``. Any
+        kdtree built for exactly the transformed particles (or for any subset of them, if this is the ancestor
+        snapshot) is informed of the transformation via :meth:`pynbody.kdtree.KDTree.apply_rigid_transformation`,
+        and is retained rather than discarded when the positions change. All other kdtrees are discarded as usual.
+
+        This only happens if the ``tree-survives-transformation`` option in the ``[sph]`` section of the
+        configuration is True; otherwise all kdtrees are discarded when the positions change.
+        """
+        from ..configuration import config
+        if not config['sph']['tree-survives-transformation']:
+            yield
+            return
+
+        ancestor = self.ancestor
+        trees = [v['kdtree'] for v in ancestor._persistent_objects.values() if v.get('kdtree') is not None]
+        if len(trees) > 0 and self is not ancestor:
+            tree = ancestor._get_persist(self._inclusion_hash, 'kdtree')
+            trees = [tree] if tree is not None else []
+
+        for tree in trees:
+            tree.apply_rigid_transformation(matrix, offset)
+
+        previously_surviving = ancestor._kdtrees_surviving_position_change
+        ancestor._kdtrees_surviving_position_change = previously_surviving + tuple(trees)
+        try:
+            yield
+        except BaseException:
+            # the trees' frames may no longer correspond to the positions
+            for v in ancestor._persistent_objects.values():
+                if any(v.get('kdtree') is tree for tree in trees):
+                    del v['kdtree']
+            raise
+        finally:
+            ancestor._kdtrees_surviving_position_change = previously_surviving
+
     def _get_boxsize_for_kdtree(self):
         boxsize = self.properties.get('boxsize', None)
         if boxsize:
@@ -1743,6 +1888,10 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
             boxsize = -1.0  # represents infinite box
         return boxsize
 
+    def _spatial_index_files(self):
+        """Return the files on disk making up this snapshot, whose identity is recorded in a spatial index"""
+        return [self.filename]
+
 
     ############################################
     # HASHING AND EQUALITY TESTING
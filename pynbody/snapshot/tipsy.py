@@ -46,6 +46,28 @@ class TipsySnap(SimSnap):
                             None: {'phi', 'pos', 'eps', 'mass', 'vel'}}
 
     def __init__(self, filename, **kwargs):
+        """Load a tipsy file.
+
+        Parameters
+        ----------
+
+        filename : str
+            The path to the tipsy file to load.
+        take : np.ndarray, optional
+            The array of particles to load. If not specified, all particles are loaded.
+        take_region : pynbody.filt.Filter, optional
+            If specified, load only particles in the given region, using a spatial index previously created with
+            :func:`pynbody.chunk.spatial_index.build_spatial_index`.
+        memmap : bool | str, optional
+            If True or ``'c'``, memory-map the file rather than reading it, so that only the parts of the file that
+            are actually accessed are read from disk. Arrays are copy-on-write, i.e. they can be modified in memory
+            but changes are never written back to the file. If ``'r'``, arrays are read-only instead. Memory mapping
+            is only possible for uncompressed files in the native byte order, and when all particles are loaded;
+            otherwise the file is read in the normal way. For files with more than one family, the ``pos``, ``vel``,
+            ``mass``, ``eps`` and ``phi`` arrays must still be copied into memory when first accessed, because the
+            families are stored in separate blocks of the file; all other arrays, including binary auxiliary
+            arrays, are mapped directly. Default is False.
+        """
 
         global config
 
@@ -58,10 +80,21 @@ class TipsySnap(SimSnap):
 
         must_have_paramfile = kwargs.get('must_have_paramfile', False)
         take = kwargs.get('take', None)
+        take_region = kwargs.get('take_region', None)
+
+        self._filename = str(util.cutgz(filename))
+
+        if take_region is not None:
+            if take is not None:
+                raise ValueError("Either take or take_region may be specified, not both")
+            take = chunk.spatial_index.SpatialIndex.load(self._filename).particles_in_region(take_region)
 
         self.partial_load = take is not None
 
-        self._filename = str(util.cutgz(filename))
+        memmap = kwargs.get('memmap', False)
+        if memmap not in (False, True, 'c', 'r'):
+            raise ValueError("memmap must be True, False, 'c' or 'r'")
+        self._memmap_mode = 'c' if memmap is True else (memmap or None)
 
         if not only_header:
             logger.info("Loading %s", filename)
@@ -84,6 +117,11 @@ class TipsySnap(SimSnap):
 
             self._header_t = t
 
+        if self._memmap_mode is not None and (self._byteswap or self.partial_load
+                                              or not os.path.isfile(self._filename)):
+            logger.info("Unable to memory-map %s; it will be read normally", self._filename)
+            self._memmap_mode = None
+
 
         disk_family_slice = dict({family.gas: slice(0, ng),
                                   family.dm: slice(ng, nd + ng),
@@ -137,32 +175,66 @@ class TipsySnap(SimSnap):
         if time_unit is not None:
             self.properties['time'] *= time_unit
 
+    def _memmap_main_file(self):
+        """Return a dictionary mapping each family to a memory-mapped record array of its particles in the main file
+
+        The records have fields ``pos`` and ``vel`` in place of the individual x, y, z, vx, vy, vz components, so that
+        3D arrays can be obtained as views."""
+        records = {}
+        offset = 32
+        for fam, dtype in (family.gas, self._g_dtype), (family.dm, self._d_dtype), (family.star, self._s_dtype):
+            num_particles = len(self[fam])
+            vector_dtype = np.dtype({'names': ('mass', 'pos', 'vel') + dtype.names[7:],
+                                     'formats': (dtype['mass'], (dtype['x'], 3), (dtype['vx'], 3))
+                                                + tuple(dtype[n] for n in dtype.names[7:])})
+            assert vector_dtype.itemsize == dtype.itemsize
+            if num_particles > 0:
+                records[fam] = np.memmap(self._filename, dtype=vector_dtype, mode=self._memmap_mode,
+                                         offset=offset, shape=(num_particles,))
+            offset += num_particles * dtype.itemsize
+        return records
+
     def _load_main_file(self):
 
         logger.info("Loading data from main file %s", self._filename)
 
-        f = util.open_(self._filename, 'rb')
-        f.seek(32)
+        if self._memmap_mode is not None:
+            records = self._memmap_main_file()
+        else:
+            records = None
+
+        def memmapped_view(name, fam):
+            """Return a view of the memory-mapped file for the named array, or None if this is not possible"""
+            if records is None:
+                return None
+            if fam is None:
+                # a snapshot-level array can only be a view if all particles are in a single block of the file
+                if len(records) != 1:
+                    return None
+                fam = next(iter(records))
+            if fam not in records or name not in records[fam].dtype.names:
+                return None
+            return records[fam][name].view(array.SimArray)
 
         write = []
 
         for w, ndim in ("pos", 3), ("vel", 3), ("mass", 1), ("eps", 1), ("phi", 1):
             if w not in list(self.keys()):
-                self._create_array(w, ndim, zeros=False)
+                self._create_array(w, ndim, zeros=False, source_array=memmapped_view(w, None))
                 write.append(w)
 
         for w in "rho", "temp":
             if w not in list(self.gas.keys()):
-                self.gas._create_array(w, zeros=False)
+                self._create_family_array(w, family.gas, source_array=memmapped_view(w, family.gas))
                 write.append(w)
 
         if ("metals" not in list(self.gas.keys())) and ("metals" not in list(self.star.keys())):
-            self.gas._create_array("metals", zeros=False)
-            self.star._create_array("metals", zeros=False)
+            self._create_family_array("metals", family.gas, source_array=memmapped_view("metals", family.gas))
+            self._create_family_array("metals", family.star, source_array=memmapped_view("metals", family.star))
             write.append("metals")
 
         if "tform" not in list(self.star.keys()):
-            self.star._create_array("tform", zeros=False)
+            self._create_family_array("tform", family.star, source_array=memmapped_view("tform", family.star))
             write.append("tform")
 
         if "temp" in write:
@@ -184,6 +256,15 @@ class TipsySnap(SimSnap):
             if k in write:
                 self.star[k].set_default_units(quiet=True)
 
+        if records is not None:
+            # copy anything that could not be created as a view of the memory-mapped file
+            for fam, fam_records in records.items():
+                self_fam = self[fam]
+                for name in fam_records.dtype.names:
+                    if name in write and not util.arrays_are_same(self_fam[name], fam_records[name]):
+                        self_fam[name][:] = fam_records[name]
+            return
+
         if "pos" in write:
             write += ['x', 'y', 'z']
 
@@ -194,6 +275,9 @@ class TipsySnap(SimSnap):
             q.itemsize for q in (self._g_dtype, self._d_dtype, self._s_dtype))
         tbuf = bytearray(max_item_size * 10240)
 
+        f = util.open_(self._filename, 'rb')
+        f.seek(32)
+
         for fam, dtype in ((family.gas, self._g_dtype), (family.dm, self._d_dtype), (family.star, self._s_dtype)):
             self_fam = self[fam]
             st_len = dtype.itemsize
@@ -784,7 +868,13 @@ class TipsySnap(SimSnap):
                                            filename=filename,
                                            packed_vector=packed_vector)
 
-        if fam is None:
+        if isinstance(data.base, np.memmap) and self._array_name_1D_to_ND(array_name) is None:
+            # take ownership of the memory-mapped array, rather than copying it
+            if fam is None:
+                self._create_array(array_name, source_array=data)
+            else:
+                self._create_family_array(array_name, fam, source_array=data)
+        elif fam is None:
             self[array_name] = data
         else:
             self[fam][array_name] = data
@@ -901,6 +991,18 @@ class TipsySnap(SimSnap):
 
         self.ancestor._tipsy_arrays_binary = binary
 
+        if binary and self._memmap_mode is not None and os.path.isfile(filename) and \
+                os.path.getsize(filename) >= 4 + np.dtype(dtype).itemsize * self._load_control.disk_num_particles:
+            f.close()
+            r = np.memmap(filename, dtype=dtype, mode=self._memmap_mode, offset=4,
+                          shape=(self._load_control.disk_num_particles,))
+            if fam is not None:
+                r = r[self._get_family_slice(fam)]
+            r = r.view(array.SimArray)
+            if units is not None:
+                r.units = units
+            return r
+
         all_fam = [family.dm, family.gas, family.star]
         if fam is None:
             fam = all_fam
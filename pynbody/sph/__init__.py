@@ -37,23 +37,38 @@ from .. import array, config, config_parser, kdtree, snapshot, units, util
 from . import kernels, renderers
 
 
+def _get_tree_disk_cache(sim):
+    """Return the on-disk cache associated with the snapshot's KDTree, if any (see :mod:`pynbody.kdtree.cache`)"""
+    return getattr(sim.kdtree, 'disk_cache', None)
+
 @snapshot.simsnap.SimSnap.stable_derived_array
 def smooth(sim):
     """Return the smoothing length array for the simulation, using the configured number of neighbours"""
     sim.build_tree()
 
-    logger.info('Smoothing with %d nearest neighbours' %
-                config['sph']['smooth-particles'])
+    nsmooth = config['sph']['smooth-particles']
+    tree_cache = _get_tree_disk_cache(sim)
+    if tree_cache is not None:
+        sm = tree_cache.load_array('smooth', nsmooth)
+        if sm is not None:
+            sim._kdtree_derived_smoothing = True
+            return array.SimArray(sm, sim['pos'].units)
+
+    logger.info('Smoothing with %d nearest neighbours' % nsmooth)
 
     sm = array.SimArray(np.empty(len(sim['pos']), dtype=sim['pos'].dtype), sim['pos'].units)
 
     start = time.time()
     sim.kdtree.set_array_ref('smooth', sm)
-    sim.kdtree.populate('hsm', config['sph']['smooth-particles'])
+    sim.kdtree.populate('hsm', nsmooth)
     end = time.time()
 
     logger.info('Smoothing done in %5.3gs' % (end - start))
     sim._kdtree_derived_smoothing = True
+
+    if tree_cache is not None:
+        tree_cache.save_array('smooth', nsmooth, sm)
+
     return sm
 
 def _get_smooth_array_ensuring_compatibility(sim):
@@ -73,6 +88,14 @@ def rho(sim):
     """Return the SPH density array for the simulation, using the configured number of neighbours"""
     sim.build_tree()
 
+    nsmooth = config['sph']['smooth-particles']
+    kernel = config['sph']['kernel']
+    tree_cache = _get_tree_disk_cache(sim)
+    if tree_cache is not None:
+        cached_rho = tree_cache.load_array('rho', nsmooth, kernel)
+        if cached_rho is not None:
+            return array.SimArray(cached_rho, sim['mass'].units / sim['pos'].units ** 3)
+
     logger.info('Calculating SPH density')
     rho = array.SimArray(
         np.empty(len(sim['pos'])), sim['mass'].units / sim['pos'].units ** 3,
@@ -86,13 +109,93 @@ def rho(sim):
     sim.kdtree.set_array_ref('mass', sim['mass'])
     sim.kdtree.set_array_ref('rho', rho)
 
-    sim.kdtree.populate('rho', config['sph']['smooth-particles'])
+    sim.kdtree.populate('rho', nsmooth)
 
     end = time.time()
     logger.info('Density calculation done in %5.3g s' % (end - start))
 
+    if tree_cache is not None:
+        tree_cache.save_array('rho', nsmooth, rho, kernel)
+
     return rho
 
+def smooth_arrays(sim, arrays, operation='mean', nsmooth=None):
+    """Calculate the SPH mean or dispersion of several arrays in a single pass over the neighbours.
+
+    Smoothing each array separately (e.g. one call per chemical species) walks the neighbour lists once per array.
+    This function instead stacks the arrays into the columns of one NxK array, so that the cost is close to that
+    of smoothing a single array. It is intended for use in derived arrays, e.g.
+
+    >>> @pynbody.derived_array
+    ... def HI_smoothed(sim):
+    ...     return pynbody.sph.smooth_arrays(sim, ['HI', 'HeI', 'HeII'])[0]
+
+    though note that in such a case all the smoothed arrays are calculated, and all but one discarded. To keep all
+    of them, call this function directly and store the results.
+
+    Parameters
+    ----------
+
+    sim : snapshot.simsnap.SimSnap
+        The snapshot (or sub-snapshot, e.g. the gas) on which to smooth
+
+    arrays : list of str | np.ndarray
+        The names of the arrays to smooth, or the arrays themselves. These may be 1D or NxK arrays.
+
+    operation : str
+        Either 'mean' for the SPH-smoothed mean, or 'disp' for the SPH dispersion. Dispersions are calculated
+        separately for each column of multi-dimensional inputs.
+
+    nsmooth : int, optional
+        The number of neighbours to use. If None, the configured number of smoothing particles is used.
+
+    Returns
+    -------
+
+    list of array.SimArray
+        The smoothed arrays, in the same order and with the same shape and units as the inputs.
+
+    """
+
+    if operation not in ('mean', 'disp'):
+        raise ValueError("operation must be 'mean' or 'disp'")
+
+    if nsmooth is None:
+        nsmooth = config['sph']['smooth-particles']
+
+    arrays = [sim[a] if isinstance(a, str) else a for a in arrays]
+    if len(arrays) == 0:
+        return []
+
+    sim.build_tree()
+    sim.kdtree.set_array_ref('rho', sim['rho'])
+    sim.kdtree.set_array_ref('smooth', sim['smooth'])
+    sim.kdtree.set_array_ref('mass', sim['mass'])
+
+    dtype = np.result_type(*[a.dtype for a in arrays])
+    if dtype not in (np.float32, np.float64):
+        dtype = np.dtype(np.float64)
+
+    columns = [np.asarray(a).reshape(len(a), -1) for a in arrays]
+    stacked = np.empty((len(sim), sum(c.shape[1] for c in columns)), dtype=dtype)
+    np.concatenate(columns, axis=1, out=stacked, casting='unsafe')
+
+    logger.info('Smoothing %d columns with %d nearest neighbours' % (stacked.shape[1], nsmooth))
+    if operation == 'mean':
+        smoothed = sim.kdtree.sph_mean(stacked, nsmooth)
+    else:
+        smoothed = sim.kdtree.sph_dispersion(stacked, nsmooth, separate_columns=True)
+
+    results = []
+    column = 0
+    for a, c in zip(arrays, columns):
+        result = array.SimArray(smoothed[:, column:column + c.shape[1]].reshape(a.shape),
+                                getattr(a, 'units', units.NoUnit()))
+        results.append(result)
+        column += c.shape[1]
+
+    return results
+
 def render_spherical_image(snap, quantity='rho', nside=None, kernel=None, denoise=None, out_units=None, threaded=None,
                            weight=None, qty=None):
     """Render an SPH image projected onto the sky around the origin.
@@ -154,7 +257,7 @@ def render_spherical_image(snap, quantity='rho', nside=None, kernel=None, denois
 
 def render_3d_grid(snap, quantity='rho', nx=None, ny=None, nz=None, width="10 kpc",
                    x2=None, out_units=None, kernel=None, approximate_fast=None,
-                   threaded=None,  denoise=None, qty=None):
+                   threaded=None,  denoise=None, qty=None, output=None, slab_thickness=None):
     """Create a 3d grid via SPH interpolation
 
     Parameters
@@ -207,6 +310,16 @@ def render_3d_grid(snap, quantity='rho', nx=None, ny=None, nz=None, width="10 kp
     qty : str, optional
         Deprecated - use 'quantity' instead
 
+    output : array-like, optional
+        If specified, the grid is written slab by slab into this existing array of shape (nx, ny, nz), e.g. a numpy
+        memmap or an h5py dataset, which is then returned. This allows grids larger than the available memory to be
+        produced. Approximate rendering and denoising are not available in this mode. For more information, see
+        :meth:`renderers.Grid3dRenderer.render_to`.
+
+    slab_thickness : int, optional
+        When output is specified, the number of x-planes in each slab held in memory by each thread. If None,
+        a quarter of the grid is held in memory at a time.
+
     """
 
     if x2 is not None:
@@ -216,6 +329,23 @@ def render_3d_grid(snap, quantity='rho', nx=None, ny=None, nz=None, width="10 kp
         warnings.warn("The 'qty' parameter is deprecated; use 'quantity' instead", DeprecationWarning)
         quantity = qty
 
+    if output is not None:
+        if approximate_fast or denoise:
+            raise ValueError("Approximate rendering and denoising are not available when rendering into an output array")
+
+        if threaded is None:
+            threaded = config_parser.getboolean('sph', 'threaded-image')
+
+        renderer = renderers.make_render_pipeline(snap, quantity=quantity, resolution=nx, width=width,
+                                                  out_units=out_units, kernel=kernel,
+                                                  approximate_fast=False, threaded=False,
+                                                  denoise=False, target='volume', nx=nx, ny=ny, nz=nz)
+        if threaded:
+            # only slab-based threading can write into the output as it goes
+            renderer = renderer.with_threading(tiled=True)
+
+        return renderer.render_to(output, slab_thickness)
+
     renderer = renderers.make_render_pipeline(snap, quantity=quantity, resolution=nx, width=width,
                                               out_units = out_units, kernel = kernel,
                                               approximate_fast=approximate_fast, threaded=threaded,
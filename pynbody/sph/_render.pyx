@@ -5,6 +5,7 @@ cimport libc.math as cmath
 cimport numpy as np
 
 np.import_array()
+from cython.parallel cimport prange
 from libc.math cimport atan, pow, sqrt
 from libc.stdlib cimport free, malloc
 
@@ -140,6 +141,161 @@ cdef image_output_type get_kernel_xyz(fixed_input_type x, fixed_input_type y, fi
 
 
 
+cdef struct _ImageParameters:
+    int nx, ny
+    fixed_input_type x1, x2, y1, y2
+    fixed_input_type z_camera, z0, z_lo, z_hi
+    fixed_input_type smooth_lo, smooth_hi, min_smooth
+    fixed_input_type max_d_over_h
+    int kernel_dim, use_z
+
+    # following are only used for "perspective" rendering
+    float per_z_dx, per_z_dy, mid_x, mid_y
+
+    int num_samples
+    image_output_type* samples
+
+cdef struct _ParticleFootprint:
+    bint valid
+    fixed_input_type x, y, z, qty
+    fixed_input_type pixel_dx, pixel_dy, x_start, y_start
+    image_output_type sm_to_kdim   # minimize casting when same type as output
+    fixed_input_type kernel_max_2  # minimize casting when same type as input
+    int x_pix_start, x_pix_stop, y_pix_start, y_pix_stop
+
+
+@cython.cdivision(True)
+cdef inline _ParticleFootprint _get_particle_footprint(const _ImageParameters* p,
+                                                       fixed_input_type x_i, fixed_input_type y_i,
+                                                       fixed_input_type z_i, fixed_input_type sm_i,
+                                                       fixed_input_type qty_i) noexcept nogil:
+    """Work out the range of pixels a particle touches, and the quantities needed to deposit it.
+
+    If the particle makes no contribution to the image, the valid flag of the returned footprint is false."""
+    cdef _ParticleFootprint fp
+    cdef fixed_input_type x1 = p.x1, x2 = p.x2, y1 = p.y1, y2 = p.y2
+    cdef fixed_input_type pixel_dx = (x2-x1)/p.nx
+    cdef fixed_input_type pixel_dy = (y2-y1)/p.ny
+    cdef fixed_input_type max_d_over_h = p.max_d_over_h
+    cdef float dz_i
+    cdef int x_pos, y_pos
+
+    fp.valid = False
+
+    if z_i<p.z_lo or z_i>p.z_hi :
+        return fp
+
+    if qty_i!=qty_i:
+        return fp
+
+    if p.z_camera!=0.0 :
+        # perspective image -
+        # update image bounds for the current z
+        if (z_i>p.z_camera and p.z_camera>0) or (z_i<p.z_camera and p.z_camera<0) :
+            # behind camera
+            return fp
+        dz_i = p.z_camera-z_i
+        x1 = p.mid_x - p.per_z_dx*dz_i
+        x2 = p.mid_x + p.per_z_dx*dz_i
+        y1 = p.mid_y - p.per_z_dy*dz_i
+        y2 = p.mid_y + p.per_z_dy*dz_i
+        pixel_dx = (x2-x1)/p.nx
+        pixel_dy = (y2-y1)/p.ny
+
+    # minimum smoothing can be specified to create a smoother image (esp useful for contour plots)
+    if sm_i<p.min_smooth:
+        sm_i = p.min_smooth
+
+    # check particle smoothing is within specified range
+    if sm_i<pixel_dx*p.smooth_lo or sm_i>pixel_dx*p.smooth_hi :
+        return fp
+
+    # check particle is within bounds
+    if not ((p.use_z*cmath.fabs(z_i-p.z0)<max_d_over_h*sm_i)
+            and x_i>x1-2*sm_i and x_i<x2+2*sm_i and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
+        return fp
+
+    fp.x = x_i; fp.y = y_i; fp.z = z_i; fp.qty = qty_i
+    fp.pixel_dx = pixel_dx; fp.pixel_dy = pixel_dy
+    fp.x_start = x1+pixel_dx/2
+    fp.y_start = y1+pixel_dy/2
+
+    # pre-cache sm^kdim and (sm*max_d_over_h)**2; tests showed massive speedups when doing this
+    if p.kernel_dim==2 :
+        fp.sm_to_kdim = sm_i*sm_i
+    else :
+        fp.sm_to_kdim = sm_i*sm_i*sm_i
+        # only 2, 3 supported
+
+    fp.kernel_max_2 = (sm_i*sm_i)*(max_d_over_h*max_d_over_h)
+
+    # decide whether this is a single pixel or a multi-pixel particle
+    if (max_d_over_h*sm_i/pixel_dx<1 and max_d_over_h*sm_i/pixel_dy<1) :
+        # single pixel, get pixel location
+        x_pos = int((x_i-x1)/pixel_dx)
+        y_pos = int((y_i-y1)/pixel_dy)
+
+        # final bounds check
+        if not (x_pos>=0 and x_pos<p.nx and y_pos>=0 and y_pos<p.ny) :
+            return fp
+
+        fp.x_pix_start = x_pos
+        fp.x_pix_stop = x_pos+1
+        fp.y_pix_start = y_pos
+        fp.y_pix_stop = y_pos+1
+    else :
+        # multi-pixel
+        fp.x_pix_start = int((x_i-max_d_over_h*sm_i-x1)/pixel_dx)
+        fp.x_pix_stop =  int((x_i+max_d_over_h*sm_i-x1)/pixel_dx)
+        fp.y_pix_start = int((y_i-max_d_over_h*sm_i-y1)/pixel_dy)
+        fp.y_pix_stop =  int((y_i+max_d_over_h*sm_i-y1)/pixel_dy)
+        if fp.x_pix_start<0 : fp.x_pix_start = 0
+        if fp.x_pix_stop>p.nx : fp.x_pix_stop = p.nx
+        if fp.y_pix_start<0 : fp.y_pix_start = 0
+        if fp.y_pix_stop>p.ny : fp.y_pix_stop = p.ny
+        if fp.x_pix_start>=fp.x_pix_stop or fp.y_pix_start>=fp.y_pix_stop :
+            return fp
+
+    fp.valid = True
+    return fp
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _deposit_particle(const _ImageParameters* p, const _ParticleFootprint* fp,
+                                   image_output_type* result,
+                                   int x_lo, int x_hi, int y_lo, int y_hi) noexcept nogil:
+    """Add a particle's contribution to the pixels of its footprint that lie in [x_lo,x_hi) x [y_lo,y_hi)"""
+    cdef int x_pos, y_pos
+    cdef fixed_input_type x_pixel, y_pixel
+
+    # copy everything needed into locals; otherwise the compiler must assume each write to the image
+    # may have changed them
+    cdef fixed_input_type x_i = fp.x, y_i = fp.y, qty_i = fp.qty
+    cdef fixed_input_type dz_i = (fp.z-p.z0)*p.use_z
+    cdef fixed_input_type pixel_dx = fp.pixel_dx, pixel_dy = fp.pixel_dy
+    cdef fixed_input_type x_start = fp.x_start, y_start = fp.y_start
+    cdef fixed_input_type kernel_max_2 = fp.kernel_max_2
+    cdef image_output_type sm_to_kdim = fp.sm_to_kdim
+    cdef int num_samples = p.num_samples
+    cdef image_output_type* samples_c = p.samples
+    cdef image_output_type* row
+
+    if x_lo<fp.x_pix_start : x_lo = fp.x_pix_start
+    if x_hi>fp.x_pix_stop : x_hi = fp.x_pix_stop
+    if y_lo<fp.y_pix_start : y_lo = fp.y_pix_start
+    if y_hi>fp.y_pix_stop : y_hi = fp.y_pix_stop
+
+    # loop over rows on the outside so that writes to the image are contiguous
+    for y_pos in range(y_lo, y_hi) :
+        y_pixel = pixel_dy*<fixed_input_type>(y_pos)+y_start
+        row = result+(<Py_ssize_t>y_pos)*p.nx
+        for x_pos in range(x_lo, x_hi) :
+            x_pixel = pixel_dx*<fixed_input_type>(x_pos)+x_start
+            row[x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, dz_i, kernel_max_2, sm_to_kdim,
+                                             num_samples, samples_c)
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -157,153 +313,259 @@ def render_image(int nx, int ny,
                  fixed_input_type z_lo, fixed_input_type z_hi,
                  fixed_input_type min_smooth,
                  kernel,
-                 wrap_offsets_x=[0], wrap_offsets_y=[0]) :
-
-    cdef fixed_input_type pixel_dx = (x2-x1)/nx
-    cdef fixed_input_type pixel_dy = (y2-y1)/ny
-    cdef fixed_input_type x_start = x1+pixel_dx/2
-    cdef fixed_input_type y_start = y1+pixel_dy/2
-    cdef int n_part = len(x)
-    cdef int nn=0, i=0
-    cdef fixed_input_type x_i, y_i, z_i, sm_i, qty_i
-    cdef fixed_input_type x_pixel, y_pixel, z_pixel
-    cdef int x_pos, y_pos
-    cdef int x_pix_start, x_pix_stop, y_pix_start, y_pix_stop
+                 wrap_offsets_x=[0], wrap_offsets_y=[0],
+                 int num_threads=1, int tile_size=0) :
+    """Render particles onto a 2d image
 
-    # following are only used for "perspective" rendering
-    cdef float per_z_dx = (x2-x1)/(2*z_camera)
-    cdef float per_z_dy = (y2-y1)/(2*z_camera)
-    cdef float mid_x = (x2+x1)/2
-    cdef float mid_y = (y2+y1)/2
-    cdef float dz_i
-
-    cdef float wrap_offset_x, wrap_offset_y
+    If num_threads>1, the image is split into square tiles of tile_size pixels (chosen automatically if tile_size
+    is zero). Particles are first binned into every tile that their kernel overlaps; the tiles are then rendered
+    in parallel, each by a single thread, directly into the output image. Within each pixel, contributions are
+    summed in the same order as for the single-threaded renderer, so the result is identical."""
 
+    cdef _ImageParameters params
+    cdef _ParticleFootprint fp
+    cdef Py_ssize_t n_part = len(x)
+    cdef Py_ssize_t i, j, e
+    cdef int w
 
     cdef int kernel_dim = kernel.h_power
-    cdef fixed_input_type max_d_over_h = kernel.max_d
-
 
     cdef np.ndarray[image_output_type,ndim=1] samples = kernel.get_samples(dtype=np_image_output_type)
-    cdef int num_samples = len(samples)
-    cdef image_output_type* samples_c = <image_output_type*>samples.data
-    cdef image_output_type sm_to_kdim   # minimize casting when same type as output
-
-    cdef fixed_input_type kernel_max_2 # minimize casting when same type as input
 
     cdef np.ndarray[image_output_type,ndim=2] result = np.zeros((ny,nx),dtype=np_image_output_type)
+    cdef image_output_type* result_c = <image_output_type*>result.data
 
-    z_pixel = z0
-    cdef int total_ptcls = 0
-
-    cdef int use_z = 1 if kernel_dim>=3 else 0
+    # wrap offsets are applied in single precision, for all combinations of x and y offsets
+    cdef np.ndarray[np.float32_t,ndim=1] wrap_x = np.repeat(np.asarray(wrap_offsets_x, dtype=np.float32),
+                                                            len(wrap_offsets_y))
+    cdef np.ndarray[np.float32_t,ndim=1] wrap_y = np.tile(np.asarray(wrap_offsets_y, dtype=np.float32),
+                                                          len(wrap_offsets_x))
+    cdef int n_wraps = len(wrap_x)
 
     assert kernel_dim==2 or kernel_dim==3, "Only kernels of dimension 2 or 3 currently supported"
     assert len(x) == len(y) == len(z) == len(sm) == len(qty) == len(mass) == len(rho), "Inconsistent array lengths passed to render_image_core"
 
-    for wrap_offset_x in wrap_offsets_x :
-        for wrap_offset_y in wrap_offsets_y :
-            with nogil:
-                for i in range(n_part) :
-                    # load particle details
-                    x_i = x[i]+wrap_offset_x; y_i=y[i]+wrap_offset_y;
-                    z_i=z[i]; sm_i = sm[i]; qty_i = qty[i]*mass[i]/rho[i]
-
-                    if z_i<z_lo or z_i>z_hi :
-                        continue
-
-                    if qty_i!=qty_i:
-                        continue
-
-                    if z_camera!=0.0 :
-                        # perspective image -
-                        # update image bounds for the current z
-                        if (z_i>z_camera and z_camera>0) or (z_i<z_camera and z_camera<0) :
-                            # behind camera
-                            continue
-                        dz_i = z_camera-z_i
-                        x1 = mid_x - per_z_dx*dz_i
-                        x2 = mid_x + per_z_dx*dz_i
-                        y1 = mid_y - per_z_dy*dz_i
-                        y2 = mid_y + per_z_dy*dz_i
-                        pixel_dx = (x2-x1)/nx
-                        pixel_dy = (y2-y1)/ny
-                        x_start = x1+pixel_dx/2
-                        y_start = y1+pixel_dy/2
-
-                    # minimum smoothing can be specified to create a smoother image (esp useful for contour plots)
-                    if sm_i<min_smooth:
-                        sm_i = min_smooth
-
-                    # check particle smoothing is within specified range
-                    if sm_i<pixel_dx*smooth_lo or sm_i>pixel_dx*smooth_hi : continue
-
-
-                    total_ptcls+=1
-
-                    # check particle is within bounds
-                    if not ((use_z*cmath.fabs(z_i-z0)<max_d_over_h*sm_i)
-                            and x_i>x1-2*sm_i and x_i<x2+2*sm_i and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
-                        continue
-
-                    # pre-cache sm^kdim and (sm*max_d_over_h)**2; tests showed massive speedups when doing this
-                    if kernel_dim==2 :
-                        sm_to_kdim = sm_i*sm_i
-                    else :
-                        sm_to_kdim = sm_i*sm_i*sm_i
-                        # only 2, 3 supported
-
-                    kernel_max_2 = (sm_i*sm_i)*(max_d_over_h*max_d_over_h)
-
-                    # decide whether this is a single pixel or a multi-pixel particle
-                    if (max_d_over_h*sm_i/pixel_dx<1 and max_d_over_h*sm_i/pixel_dy<1) :
-                        # single pixel, get pixel location
-                        x_pos = int((x_i-x1)/pixel_dx)
-                        y_pos = int((y_i-y1)/pixel_dy)
-
-                        # work out pixel centre
-                        x_pixel = (pixel_dx*<fixed_input_type>(x_pos)+x_start)
-                        y_pixel = (pixel_dy*<fixed_input_type>(y_pos)+y_start)
-
-                        # final bounds check
-                        if x_pos>=0 and x_pos<nx and y_pos>=0 and y_pos<ny :
-                            result[y_pos,x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
-                    else :
-                        # multi-pixel
-                        x_pix_start = int((x_i-max_d_over_h*sm_i-x1)/pixel_dx)
-                        x_pix_stop =  int((x_i+max_d_over_h*sm_i-x1)/pixel_dx)
-                        y_pix_start = int((y_i-max_d_over_h*sm_i-y1)/pixel_dy)
-                        y_pix_stop =  int((y_i+max_d_over_h*sm_i-y1)/pixel_dy)
-                        if x_pix_start<0 : x_pix_start = 0
-                        if x_pix_stop>nx : x_pix_stop = nx
-                        if y_pix_start<0 : y_pix_start = 0
-                        if y_pix_stop>ny : y_pix_stop = ny
-                        for x_pos in range(x_pix_start, x_pix_stop) :
-                            x_pixel = pixel_dx*<fixed_input_type>(x_pos)+x_start
-                            for y_pos in range(y_pix_start, y_pix_stop) :
-                                y_pixel = pixel_dy*<fixed_input_type>(y_pos)+y_start
-
-                                # could accessing the buffer manually be
-                                # faster? It seems to be FAR faster (x10!) but
-                                # only when using stack-allocated memory for
-                                # c_result, and when writing to memory, not
-                                # also reading (i.e. = instead of +=).  The
-                                # instruction that, according to Instruments,
-                                # holds everything up and disappears is
-                                # cvtss2sd, but it's not clear to me why this
-                                # disappears from the compiled version in the
-                                # instance described above.  Anyway for now, there
-                                # is no advantage to the manual approach -
-
-                                #c_result[x_pos+nx*y_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
-
-                                result[y_pos,x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+    params.nx = nx; params.ny = ny
+    params.x1 = x1; params.x2 = x2; params.y1 = y1; params.y2 = y2
+    params.z_camera = z_camera; params.z0 = z0; params.z_lo = z_lo; params.z_hi = z_hi
+    params.smooth_lo = smooth_lo; params.smooth_hi = smooth_hi; params.min_smooth = min_smooth
+    params.max_d_over_h = kernel.max_d
+    params.kernel_dim = kernel_dim
+    params.use_z = 1 if kernel_dim>=3 else 0
+    params.per_z_dx = (x2-x1)/(2*z_camera)
+    params.per_z_dy = (y2-y1)/(2*z_camera)
+    params.mid_x = (x2+x1)/2
+    params.mid_y = (y2+y1)/2
+    params.num_samples = len(samples)
+    params.samples = <image_output_type*>samples.data
+
+    if num_threads<=1:
+        with nogil:
+            for w in range(n_wraps):
+                for i in range(n_part):
+                    fp = _get_particle_footprint(&params, x[i]+wrap_x[w], y[i]+wrap_y[w], z[i], sm[i],
+                                                 qty[i]*mass[i]/rho[i])
+                    if fp.valid:
+                        _deposit_particle(&params, &fp, result_c, 0, nx, 0, ny)
+        return result
+
+    # Tiled rendering. Each (wrap, particle) pair is an "item", numbered j = w*n_part + i. The items are split into
+    # one contiguous chunk per thread. Each chunk first counts how many of its items overlap each tile, then writes
+    # the item numbers into a list sorted by tile, then chunk, then item; so that when the tiles are finally
+    # rendered, particles are visited in the same order as by the serial loop above.
+
+    if tile_size<=0:
+        # aim for enough tiles that threads can balance the load between them
+        tile_size = int(cmath.sqrt(<double>nx*ny/(16*num_threads)))
+        tile_size = max(16, min(tile_size, 128))
+
+    cdef int ntiles_x = (nx+tile_size-1)//tile_size
+    cdef int ntiles_y = (ny+tile_size-1)//tile_size
+    cdef int n_tiles = ntiles_x*ntiles_y
+    cdef int n_chunks = num_threads
+    cdef Py_ssize_t n_items = n_wraps*n_part
+    cdef Py_ssize_t chunk_len = (n_items+n_chunks-1)//n_chunks
+    cdef int c, k, tx, ty, x_lo, x_hi, y_lo, y_hi
+
+    cdef np.ndarray[np.int64_t,ndim=2] cursor = np.zeros((n_chunks, n_tiles), dtype=np.int64)
+
+    with nogil:
+        for c in prange(n_chunks, num_threads=num_threads, schedule='static', chunksize=1):
+            for j in range(c*chunk_len, min((c+1)*chunk_len, n_items)):
+                w = j//n_part
+                i = j-w*n_part
+                fp = _get_particle_footprint(&params, x[i]+wrap_x[w], y[i]+wrap_y[w], z[i], sm[i],
+                                             qty[i]*mass[i]/rho[i])
+                if fp.valid:
+                    for ty in range(fp.y_pix_start//tile_size, (fp.y_pix_stop-1)//tile_size+1):
+                        for tx in range(fp.x_pix_start//tile_size, (fp.x_pix_stop-1)//tile_size+1):
+                            cursor[c, ty*ntiles_x+tx]+=1
+
+    # convert counts into the position at which each chunk starts writing into each tile's list
+    cdef np.ndarray[np.int64_t,ndim=1] starts = np.concatenate(([0], np.cumsum(cursor.T.ravel())))
+    cursor = starts[:n_tiles*n_chunks].reshape(n_tiles, n_chunks).T.copy()
+    cdef np.ndarray[np.int64_t,ndim=1] tile_starts = np.ascontiguousarray(starts[::n_chunks])
+    cdef np.ndarray[np.int64_t,ndim=1] items = np.empty(starts[n_tiles*n_chunks], dtype=np.int64)
+
+    with nogil:
+        for c in prange(n_chunks, num_threads=num_threads, schedule='static', chunksize=1):
+            for j in range(c*chunk_len, min((c+1)*chunk_len, n_items)):
+                w = j//n_part
+                i = j-w*n_part
+                fp = _get_particle_footprint(&params, x[i]+wrap_x[w], y[i]+wrap_y[w], z[i], sm[i],
+                                             qty[i]*mass[i]/rho[i])
+                if fp.valid:
+                    for ty in range(fp.y_pix_start//tile_size, (fp.y_pix_stop-1)//tile_size+1):
+                        for tx in range(fp.x_pix_start//tile_size, (fp.x_pix_stop-1)//tile_size+1):
+                            items[cursor[c, ty*ntiles_x+tx]] = j
+                            cursor[c, ty*ntiles_x+tx]+=1
+
+        # each tile is owned by exactly one thread, so no locking is needed on the output image
+        for k in prange(n_tiles, num_threads=num_threads, schedule='dynamic'):
+            tx = k%ntiles_x
+            ty = k//ntiles_x
+            x_lo = tx*tile_size
+            x_hi = min(x_lo+tile_size, nx)
+            y_lo = ty*tile_size
+            y_hi = min(y_lo+tile_size, ny)
+            for e in range(tile_starts[k], tile_starts[k+1]):
+                j = items[e]
+                w = j//n_part
+                i = j-w*n_part
+                fp = _get_particle_footprint(&params, x[i]+wrap_x[w], y[i]+wrap_y[w], z[i], sm[i],
+                                             qty[i]*mass[i]/rho[i])
+                _deposit_particle(&params, &fp, result_c, x_lo, x_hi, y_lo, y_hi)
 
     return result
 
 
 
 
+cdef struct _GridParameters:
+    int nx, ny, nz
+    fixed_input_type x1, x2, y1, y2, z1, z2
+    fixed_input_type pixel_dx, pixel_dy, pixel_dz
+    fixed_input_type x_start, y_start, z_start
+    fixed_input_type smooth_lo, smooth_hi
+    fixed_input_type max_d_over_h
+    int num_samples
+    image_output_type* samples
+
+cdef struct _GridFootprint:
+    bint valid
+    fixed_input_type x, y, z, qty
+    image_output_type sm_to_kdim   # minimize casting when same type as output
+    fixed_input_type kernel_max_2  # minimize casting when same type as input
+    int x_pix_start, x_pix_stop, y_pix_start, y_pix_stop, z_pix_start, z_pix_stop
+
+
+@cython.cdivision(True)
+cdef inline _GridFootprint _get_grid_footprint(const _GridParameters* p,
+                                               fixed_input_type x_i, fixed_input_type y_i,
+                                               fixed_input_type z_i, fixed_input_type sm_i,
+                                               fixed_input_type qty_i) noexcept nogil:
+    """Work out the range of cells a particle touches, and the quantities needed to deposit it.
+
+    If the particle makes no contribution to the grid, the valid flag of the returned footprint is false."""
+    cdef _GridFootprint fp
+    cdef fixed_input_type max_d_over_h = p.max_d_over_h
+    cdef int x_pos, y_pos, z_pos
+
+    fp.valid = False
+
+    # check particle smoothing is within specified range
+    if sm_i<p.pixel_dx*p.smooth_lo or sm_i>p.pixel_dx*p.smooth_hi :
+        return fp
+
+    # check particle is within bounds
+    if not (z_i>p.z1-2*sm_i and z_i<p.z2+2*sm_i \
+            and x_i>p.x1-2*sm_i and x_i<p.x2+2*sm_i \
+            and y_i>p.y1-2*sm_i and y_i<p.y2+2*sm_i) :
+        return fp
+
+    fp.x = x_i; fp.y = y_i; fp.z = z_i; fp.qty = qty_i
+
+    # pre-cache sm^kdim and (sm*max_d_over_h)**2; tests showed massive speedups when doing this
+    # (only 3d kernels can be used for grids)
+    fp.sm_to_kdim = sm_i*sm_i*sm_i
+    fp.kernel_max_2 = (sm_i*sm_i)*(max_d_over_h*max_d_over_h)
+
+    # decide whether this is a single pixel or a multi-pixel particle
+    if (max_d_over_h*sm_i/p.pixel_dx<1 and max_d_over_h*sm_i/p.pixel_dy<1) :
+        # single pixel, get pixel location
+        x_pos = int((x_i-p.x1)/p.pixel_dx)
+        y_pos = int((y_i-p.y1)/p.pixel_dy)
+        z_pos = int((z_i-p.z1)/p.pixel_dz)
+
+        # final bounds check
+        if not (x_pos>=0 and x_pos<p.nx and y_pos>=0 and y_pos<p.ny \
+                and z_pos>=0 and z_pos<p.nz) :
+            return fp
+
+        fp.x_pix_start = x_pos
+        fp.x_pix_stop = x_pos+1
+        fp.y_pix_start = y_pos
+        fp.y_pix_stop = y_pos+1
+        fp.z_pix_start = z_pos
+        fp.z_pix_stop = z_pos+1
+    else :
+        # multi-pixel
+        fp.x_pix_start = int((x_i-max_d_over_h*sm_i-p.x1)/p.pixel_dx)
+        fp.x_pix_stop =  int((x_i+max_d_over_h*sm_i-p.x1)/p.pixel_dx)
+        fp.y_pix_start = int((y_i-max_d_over_h*sm_i-p.y1)/p.pixel_dy)
+        fp.y_pix_stop =  int((y_i+max_d_over_h*sm_i-p.y1)/p.pixel_dy)
+        fp.z_pix_start = int((z_i-max_d_over_h*sm_i-p.z1)/p.pixel_dz)
+        fp.z_pix_stop =  int((z_i+max_d_over_h*sm_i-p.z1)/p.pixel_dz)
+        if fp.x_pix_start<0 : fp.x_pix_start = 0
+        if fp.x_pix_stop>p.nx : fp.x_pix_stop = p.nx
+        if fp.y_pix_start<0 : fp.y_pix_start = 0
+        if fp.y_pix_stop>p.ny : fp.y_pix_stop = p.ny
+        if fp.z_pix_start<0 : fp.z_pix_start = 0
+        if fp.z_pix_stop>p.nz : fp.z_pix_stop = p.nz
+        if fp.x_pix_start>=fp.x_pix_stop or fp.y_pix_start>=fp.y_pix_stop or fp.z_pix_start>=fp.z_pix_stop :
+            return fp
+
+    fp.valid = True
+    return fp
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _deposit_grid_particle(const _GridParameters* p, const _GridFootprint* fp,
+                                        image_output_type* result, int result_x0,
+                                        int x_lo, int x_hi) noexcept nogil:
+    """Add a particle's contribution to the cells of its footprint with x index in [x_lo,x_hi).
+
+    The result buffer holds a contiguous block of x-planes of the grid, the first of which is result_x0."""
+    cdef int x_pos, y_pos, z_pos
+    cdef fixed_input_type x_pixel, y_pixel, z_pixel
+
+    # copy everything needed into locals; otherwise the compiler must assume each write to the grid
+    # may have changed them
+    cdef fixed_input_type x_i = fp.x, y_i = fp.y, z_i = fp.z, qty_i = fp.qty
+    cdef fixed_input_type pixel_dx = p.pixel_dx, pixel_dy = p.pixel_dy, pixel_dz = p.pixel_dz
+    cdef fixed_input_type x_start = p.x_start, y_start = p.y_start, z_start = p.z_start
+    cdef fixed_input_type kernel_max_2 = fp.kernel_max_2
+    cdef image_output_type sm_to_kdim = fp.sm_to_kdim
+    cdef int z_lo = fp.z_pix_start, z_hi = fp.z_pix_stop
+    cdef int num_samples = p.num_samples
+    cdef image_output_type* samples_c = p.samples
+    cdef image_output_type* row
+
+    if x_lo<fp.x_pix_start : x_lo = fp.x_pix_start
+    if x_hi>fp.x_pix_stop : x_hi = fp.x_pix_stop
+
+    for x_pos in range(x_lo, x_hi) :
+        x_pixel = pixel_dx*<fixed_input_type>(x_pos)+x_start
+        for y_pos in range(fp.y_pix_start, fp.y_pix_stop) :
+            y_pixel = pixel_dy*<fixed_input_type>(y_pos)+y_start
+            row = result+((<Py_ssize_t>(x_pos-result_x0))*p.ny+y_pos)*p.nz
+            for z_pos in range(z_lo, z_hi) :
+                z_pixel = pixel_dz*<fixed_input_type>(z_pos)+z_start
+                row[z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, z_i-z_pixel, kernel_max_2, sm_to_kdim,
+                                                 num_samples, samples_c)
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -319,40 +581,42 @@ def to_3d_grid(int nx, int ny, int nz,
                  np.ndarray[fused_input_type_5,ndim=1] rho,
                  fixed_input_type smooth_lo, fixed_input_type smooth_hi,
                  kernel,
-                 wrap_offsets_x=[0], wrap_offsets_y=[0],wrap_offsets_z=[0]) :
-
-
-
-    cdef fixed_input_type pixel_dx = (x2-x1)/nx
-    cdef fixed_input_type pixel_dy = (y2-y1)/ny
-    cdef fixed_input_type pixel_dz = (z2-z1)/ny
-    cdef fixed_input_type x_start = x1+pixel_dx/2
-    cdef fixed_input_type y_start = y1+pixel_dy/2
-    cdef fixed_input_type z_start = z1+pixel_dz/2
-    cdef int n_part = len(x)
-    cdef int nn=0, i=0
-    cdef fixed_input_type x_i, y_i, z_i, sm_i, qty_i
-    cdef fixed_input_type x_pixel, y_pixel, z_pixel
-    cdef int x_pos, y_pos, z_pos
-    cdef int x_pix_start, x_pix_stop, y_pix_start, y_pix_stop, z_pix_start, z_pix_stop
+                 wrap_offsets_x=[0], wrap_offsets_y=[0],wrap_offsets_z=[0],
+                 int num_threads=1, output=None, int slab_thickness=0, output_scale=1.0) :
+    """Render particles onto a 3d grid, indexed as [x,y,z]
+
+    If num_threads>1 or an output array is given, the grid is split along x into slabs of slab_thickness planes
+    (chosen automatically if zero). Particles are first binned into every slab that their kernel overlaps; the
+    slabs are then rendered in parallel, each by a single thread. Within each cell, contributions are summed in the
+    same order as for the single-threaded renderer, so the result is identical.
+
+    If output is None, a new array holding the full grid is returned. Otherwise, output must be an existing
+    array-like object of shape (nx,ny,nz) supporting assignment to slices along its first axis (e.g. a numpy
+    memmap or an h5py dataset). Slabs are rendered num_threads at a time, multiplied by output_scale, and
+    written into output as soon as they are complete, so that the full grid never needs to be held in memory.
+    The output object is then returned."""
+
+    cdef _GridParameters params
+    cdef _GridFootprint fp
+    cdef Py_ssize_t n_part = len(x)
+    cdef Py_ssize_t i, j, e
+    cdef int w
 
     cdef int kernel_dim = kernel.h_power
-    cdef fixed_input_type max_d_over_h = kernel.max_d
 
     cdef np.ndarray[image_output_type,ndim=1] samples = kernel.get_samples(dtype=np_image_output_type)
-    cdef int num_samples = len(samples)
-    cdef image_output_type* samples_c = <image_output_type*>samples.data
-    cdef image_output_type sm_to_kdim   # minimize casting when same type as output
-
-    cdef fixed_input_type kernel_max_2 # minimize casting when same type as input
-
-    cdef np.ndarray[image_output_type,ndim=3] result = np.zeros((nx,ny,nz),dtype=np_image_output_type)
-
-    cdef int total_ptcls = 0
 
-    cdef int use_z = 1 if kernel_dim>=3 else 0
+    cdef np.ndarray[image_output_type,ndim=3] result
+    cdef image_output_type* result_c
 
-    cdef float wrap_offset_x, wrap_offset_y, wrap_offset_z
+    # wrap offsets are applied in single precision, for all combinations of x, y and z offsets
+    wrap_x, wrap_y, wrap_z = np.meshgrid(np.asarray(wrap_offsets_x, dtype=np.float32),
+                                         np.asarray(wrap_offsets_y, dtype=np.float32),
+                                         np.asarray(wrap_offsets_z, dtype=np.float32), indexing='ij')
+    cdef np.ndarray[np.float32_t,ndim=1] wrap_x_c = wrap_x.ravel()
+    cdef np.ndarray[np.float32_t,ndim=1] wrap_y_c = wrap_y.ravel()
+    cdef np.ndarray[np.float32_t,ndim=1] wrap_z_c = wrap_z.ravel()
+    cdef int n_wraps = len(wrap_x_c)
 
     if kernel_dim<3:
         raise ValueError, \
@@ -362,73 +626,118 @@ def to_3d_grid(int nx, int ny, int nz,
             len(qty) == len(mass) == len(rho), \
             "Inconsistent array lengths passed to render_image_core"
 
-    for wrap_offset_x in wrap_offsets_x :
-        for wrap_offset_y in wrap_offsets_y :
-            for wrap_offset_z in wrap_offsets_z :
-                with nogil:
-                    for i in range(n_part) :
-                        # load particle details
-                        x_i = x[i]+wrap_offset_x; y_i=y[i]+wrap_offset_y; z_i=z[i]+wrap_offset_z
-                        sm_i = sm[i]
-                        qty_i = qty[i]*mass[i]/rho[i]
-
-                        # check particle smoothing is within specified range
-                        if sm_i<pixel_dx*smooth_lo or sm_i>pixel_dx*smooth_hi : continue
-
-                        total_ptcls+=1
-
-                        # check particle is within bounds
-                        if not (z_i>z1-2*sm_i and z_i<z2+2*sm_i \
-                                and x_i>x1-2*sm_i and x_i<x2+2*sm_i \
-                                and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
-                            continue
-
-                        # pre-cache sm^kdim and (sm*max_d_over_h)**2; tests showed massive speedups when doing this
-                        if kernel_dim==2 :
-                            sm_to_kdim = sm_i*sm_i
-                        else :
-                            sm_to_kdim = sm_i*sm_i*sm_i
-                            # only 2, 3 supported
-
-                        kernel_max_2 = (sm_i*sm_i)*(max_d_over_h*max_d_over_h)
-
-                        # decide whether this is a single pixel or a multi-pixel particle
-                        if (max_d_over_h*sm_i/pixel_dx<1 and max_d_over_h*sm_i/pixel_dy<1) :
-                            # single pixel, get pixel location
-                            x_pos = int((x_i-x1)/pixel_dx)
-                            y_pos = int((y_i-y1)/pixel_dy)
-                            z_pos = int((z_i-z1)/pixel_dz)
-
-                            # work out pixel centre
-                            x_pixel = (pixel_dx*<fixed_input_type>(x_pos)+x_start)
-                            y_pixel = (pixel_dy*<fixed_input_type>(y_pos)+y_start)
-                            z_pixel = (pixel_dz*<fixed_input_type>(z_pos)+z_start)
-
-                            # final bounds check
-                            if x_pos>=0 and x_pos<nx and y_pos>=0 and y_pos<ny \
-                               and z_pos>=0 and z_pos<nz :
-                                result[x_pos,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
-                        else :
-                            # multi-pixel
-                            x_pix_start = int((x_i-max_d_over_h*sm_i-x1)/pixel_dx)
-                            x_pix_stop =  int((x_i+max_d_over_h*sm_i-x1)/pixel_dx)
-                            y_pix_start = int((y_i-max_d_over_h*sm_i-y1)/pixel_dy)
-                            y_pix_stop =  int((y_i+max_d_over_h*sm_i-y1)/pixel_dy)
-                            z_pix_start = int((z_i-max_d_over_h*sm_i-z1)/pixel_dz)
-                            z_pix_stop =  int((z_i+max_d_over_h*sm_i-z1)/pixel_dz)
-                            if x_pix_start<0 : x_pix_start = 0
-                            if x_pix_stop>nx : x_pix_stop = nx
-                            if y_pix_start<0 : y_pix_start = 0
-                            if y_pix_stop>ny : y_pix_stop = ny
-                            if z_pix_start<0 : z_pix_start = 0
-                            if z_pix_stop>nz : z_pix_stop = nz
-                            for x_pos in range(x_pix_start, x_pix_stop) :
-                                x_pixel = pixel_dx*<fixed_input_type>(x_pos)+x_start
-                                for y_pos in range(y_pix_start, y_pix_stop) :
-                                    y_pixel = pixel_dy*<fixed_input_type>(y_pos)+y_start
-
-                                    for z_pos in range(z_pix_start,z_pix_stop) :
-                                        z_pixel = pixel_dz*<fixed_input_type>(z_pos)+z_start
-                                        result[x_pos,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel), kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+    if output is not None and tuple(output.shape) != (nx, ny, nz):
+        raise ValueError("Output array has shape %r, but the grid has shape %r" % (tuple(output.shape), (nx, ny, nz)))
+
+    params.nx = nx; params.ny = ny; params.nz = nz
+    params.x1 = x1; params.x2 = x2; params.y1 = y1; params.y2 = y2; params.z1 = z1; params.z2 = z2
+    params.pixel_dx = (x2-x1)/nx
+    params.pixel_dy = (y2-y1)/ny
+    params.pixel_dz = (z2-z1)/ny
+    params.x_start = x1+params.pixel_dx/2
+    params.y_start = y1+params.pixel_dy/2
+    params.z_start = z1+params.pixel_dz/2
+    params.smooth_lo = smooth_lo; params.smooth_hi = smooth_hi
+    params.max_d_over_h = kernel.max_d
+    params.num_samples = len(samples)
+    params.samples = <image_output_type*>samples.data
+
+    if num_threads<=1 and output is None:
+        result = np.zeros((nx,ny,nz),dtype=np_image_output_type)
+        result_c = <image_output_type*>result.data
+        with nogil:
+            for w in range(n_wraps):
+                for i in range(n_part):
+                    fp = _get_grid_footprint(&params, x[i]+wrap_x_c[w], y[i]+wrap_y_c[w], z[i]+wrap_z_c[w], sm[i],
+                                             qty[i]*mass[i]/rho[i])
+                    if fp.valid:
+                        _deposit_grid_particle(&params, &fp, result_c, 0, 0, nx)
+        return result
+
+    # Slab rendering. As for the tiles in render_image, each (wrap, particle) pair is an "item" numbered
+    # j = w*n_part + i; the items are split into one contiguous chunk per thread, which counts then lists
+    # the items overlapping each slab. The lists are sorted by slab, then chunk, then item, so that slabs
+    # visit particles in the same order as the serial loop above.
+
+    if num_threads<1:
+        num_threads = 1
+
+    if slab_thickness<=0:
+        # aim for enough slabs that threads can balance the load between them
+        slab_thickness = max(1, (nx+4*num_threads-1)//(4*num_threads))
+
+    cdef int n_slabs = (nx+slab_thickness-1)//slab_thickness
+    cdef int n_chunks = num_threads
+    cdef Py_ssize_t n_items = n_wraps*n_part
+    cdef Py_ssize_t chunk_len = (n_items+n_chunks-1)//n_chunks
+    cdef int c, k, s, x_lo, x_hi, batch_start, batch_stop, batch_x0, batch_x1
+
+    cdef np.ndarray[np.int64_t,ndim=2] cursor = np.zeros((n_chunks, n_slabs), dtype=np.int64)
 
-    return result
+    with nogil:
+        for c in prange(n_chunks, num_threads=num_threads, schedule='static', chunksize=1):
+            for j in range(c*chunk_len, min((c+1)*chunk_len, n_items)):
+                w = j//n_part
+                i = j-w*n_part
+                fp = _get_grid_footprint(&params, x[i]+wrap_x_c[w], y[i]+wrap_y_c[w], z[i]+wrap_z_c[w], sm[i],
+                                         qty[i]*mass[i]/rho[i])
+                if fp.valid:
+                    for s in range(fp.x_pix_start//slab_thickness, (fp.x_pix_stop-1)//slab_thickness+1):
+                        cursor[c, s]+=1
+
+    # convert counts into the position at which each chunk starts writing into each slab's list
+    cdef np.ndarray[np.int64_t,ndim=1] starts = np.concatenate(([0], np.cumsum(cursor.T.ravel())))
+    cursor = starts[:n_slabs*n_chunks].reshape(n_slabs, n_chunks).T.copy()
+    cdef np.ndarray[np.int64_t,ndim=1] slab_starts = np.ascontiguousarray(starts[::n_chunks])
+    cdef np.ndarray[np.int64_t,ndim=1] items = np.empty(starts[n_slabs*n_chunks], dtype=np.int64)
+
+    with nogil:
+        for c in prange(n_chunks, num_threads=num_threads, schedule='static', chunksize=1):
+            for j in range(c*chunk_len, min((c+1)*chunk_len, n_items)):
+                w = j//n_part
+                i = j-w*n_part
+                fp = _get_grid_footprint(&params, x[i]+wrap_x_c[w], y[i]+wrap_y_c[w], z[i]+wrap_z_c[w], sm[i],
+                                         qty[i]*mass[i]/rho[i])
+                if fp.valid:
+                    for s in range(fp.x_pix_start//slab_thickness, (fp.x_pix_stop-1)//slab_thickness+1):
+                        items[cursor[c, s]] = j
+                        cursor[c, s]+=1
+
+    cdef int slabs_per_batch
+    if output is None:
+        result = np.zeros((nx,ny,nz),dtype=np_image_output_type)
+        slabs_per_batch = n_slabs
+    else:
+        slabs_per_batch = num_threads
+        result = np.empty((min(slabs_per_batch*slab_thickness, nx),ny,nz),dtype=np_image_output_type)
+    result_c = <image_output_type*>result.data
+
+    for batch_start in range(0, n_slabs, slabs_per_batch):
+        batch_stop = min(batch_start+slabs_per_batch, n_slabs)
+        batch_x0 = batch_start*slab_thickness
+        batch_x1 = min(batch_stop*slab_thickness, nx)
+        if output is not None:
+            result[:batch_x1-batch_x0] = 0
+
+        # each slab is owned by exactly one thread, so no locking is needed on the grid
+        with nogil:
+            for k in prange(batch_start, batch_stop, num_threads=num_threads, schedule='dynamic'):
+                x_lo = k*slab_thickness
+                x_hi = min(x_lo+slab_thickness, nx)
+                for e in range(slab_starts[k], slab_starts[k+1]):
+                    j = items[e]
+                    w = j//n_part
+                    i = j-w*n_part
+                    fp = _get_grid_footprint(&params, x[i]+wrap_x_c[w], y[i]+wrap_y_c[w], z[i]+wrap_z_c[w], sm[i],
+                                             qty[i]*mass[i]/rho[i])
+                    _deposit_grid_particle(&params, &fp, result_c, batch_x0, x_lo, x_hi)
+
+        if output is not None:
+            if output_scale != 1.0:
+                result[:batch_x1-batch_x0] *= output_scale
+            output[batch_x0:batch_x1] = result[:batch_x1-batch_x0]
+
+    if output is None:
+        return result
+    else:
+        return output
@@ -122,6 +122,8 @@ class ReadOnlyGeometry:
 class ImageRendererBase:
     """An abstract base class for image renderers"""
 
+    _supports_tiled_threading = False
+
     def __init__(self, snap: snapshot.SimSnap):
         self._snapshot = snap
 
@@ -131,6 +133,8 @@ class ImageRendererBase:
 
         self._particle_array_slice = None
 
+        self._num_threads = 1
+
         self._geometry = ImageGeometry()
 
         self._out_units = None
@@ -332,6 +336,21 @@ class ImageRendererBase:
 
     def render(self) -> np.ndarray:
         """Render the image and return it as a numpy array or SimArray."""
+        return self._combine_linear_components(self._render_linear_components())
+
+    def _render_linear_components(self) -> list[np.ndarray]:
+        """Render the images from which the final image is built, each of which is a plain sum over particles.
+
+        Because each component is linear in the particles, components rendered from disjoint subsets of the
+        particles can be added together before being combined; see :class:`ChunkedImageRenderer`."""
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _num_linear_components(self) -> int:
+        """Return the number of images that :meth:`_render_linear_components` generates"""
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _combine_linear_components(self, images: list[np.ndarray]) -> np.ndarray:
+        """Combine the output of :meth:`_render_linear_components` into the final image"""
         raise NotImplementedError("Subclasses must implement this method")
 
 
@@ -358,14 +377,26 @@ class ImageRendererBase:
         else:
             return self
 
-    def with_threading(self, num_threads : int | NoneType = None) -> ImageRendererBase:
+    def with_threading(self, num_threads : int | NoneType = None, tiled : bool | NoneType = None) -> ImageRendererBase:
         """Return a version of this renderer that will use the specified number of threads for rendering.
 
         If num_threads is None, the number of threads is determined by the configuration file.
+
+        If tiled is True and the renderer supports it, the image is divided into tiles (or, for 3d grids, slabs)
+        which are rendered in parallel directly into a single output image (see :func:`pynbody.sph._render.render_image`
+        and :func:`pynbody.sph._render.to_3d_grid`). Otherwise, each thread renders a full-size image from a subset of
+        the particles, and the images are summed (see :class:`ThreadedImageRenderer`). If tiled is None, the choice is
+        determined by the configuration file.
         """
         self._check_quantity_set()
         if num_threads is None:
             num_threads = config['number_of_threads']
+        if tiled is None:
+            tiled = config_parser.getboolean('sph', 'tiled-threaded-image')
+        if tiled and self._supports_tiled_threading:
+            threaded = self.copy(share_geometry=True)
+            threaded._num_threads = num_threads
+            return threaded
         return ThreadedImageRenderer(self, num_threads)
 
     def with_approximate(self, levels : int | NoneType = None, factor = 8) -> ImageRendererBase:
@@ -462,11 +493,27 @@ class MultipassImageRenderer(ImageRendererBase):
         for r in self._subrenderers:
             r.set_projection(is_projected)
 
-    def with_threading(self, num_threads = None ):
+    def with_threading(self, num_threads = None, tiled = None):
         raise RenderPipelineLogicError("Threading cannot be set for a multipass image render. Try setting the threading status for the individual stages before generating the multipass renderer.")
 
-    def render(self):
-        return [r.render() for r in self._subrenderers]
+    def _render_linear_components(self):
+        return sum((r._render_linear_components() for r in self._subrenderers), [])
+
+    def _num_linear_components(self):
+        return sum(r._num_linear_components() for r in self._subrenderers)
+
+    def _combine_linear_components(self, images):
+        subimages = []
+        start = 0
+        for r in self._subrenderers:
+            stop = start + r._num_linear_components()
+            subimages.append(r._combine_linear_components(images[start:stop]))
+            start = stop
+        return self._combine_subrenderer_images(subimages)
+
+    def _combine_subrenderer_images(self, images):
+        """Combine the final images from each subrenderer into the overall result"""
+        return images
 
     def set_smooth_range(self, smooth_min: float = 0.0, smooth_max: float = None):
         for r in self._subrenderers:
@@ -490,8 +537,8 @@ class DenoisedImageRenderer(MultipassImageRenderer):
         self._subrenderers[1].set_quantity(np.ones(len(self._snapshot), dtype=base._array.dtype))
         self._subrenderers[1].set_output_units(None)
 
-    def render(self):
-        result_source_field, result_noise_field = super().render()
+    def _combine_subrenderer_images(self, images):
+        result_source_field, result_noise_field = images
         return result_source_field / result_noise_field
 
     def set_output_units(self, units_: str | units.UnitBase):
@@ -537,8 +584,8 @@ class ProjectionAverageImageRenderer(MultipassImageRenderer):
         self._subrenderers[1].set_output_units(None)
 
 
-    def render(self):
-        result_source_field, result_weight_field = super().render()
+    def _combine_subrenderer_images(self, images):
+        result_source_field, result_weight_field = images
 
         # note that we erradicate any unit information in the weight field, in case it is NoUnit, by casting to np.ndarray
         result = result_source_field / result_weight_field.view(np.ndarray)
@@ -561,12 +608,18 @@ class ThreadedImageRenderer(MultipassImageRenderer):
             # render every num_threads particle, starting at i
             r.set_particle_array_slice(slice(i, None, num_threads))
 
-    def render(self):
+    def _render_linear_components(self):
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(self._subrenderers)) as executor:
             # logger.info("Rendering image on %d threads..." % self._num_threads)
-            results = executor.map(lambda r: r.render(), self._subrenderers)
+            results = executor.map(lambda r: r._render_linear_components(), self._subrenderers)
 
-        return sum(results)
+        return [sum(images) for images in zip(*results)]
+
+    def _num_linear_components(self):
+        return self._subrenderers[0]._num_linear_components()
+
+    def _combine_linear_components(self, images):
+        return self._subrenderers[0]._combine_linear_components(images)
 
 
 class ApproximateImageRenderer(MultipassImageRenderer):
@@ -601,14 +654,123 @@ class ApproximateImageRenderer(MultipassImageRenderer):
             zoomed_images.append(zoomed_result)
         return zoomed_images
 
-    def render(self):
-        results = self._apply_zoom(super().render())
+    def _combine_subrenderer_images(self, images):
+        results = self._apply_zoom(images)
         summed = sum(results)
         return summed
 
+class ChunkedImageRenderer(ImageRendererBase):
+    """A class to render images with bounded memory, by streaming particles from disk in chunks.
+
+    Each chunk of particles is read from the snapshot's file using partial loading (see :mod:`pynbody.chunk`),
+    rendered through a pipeline built by :func:`make_render_pipeline`, and then discarded. Every stage of a render
+    pipeline is built from images which are plain sums over particles, so these are accumulated across chunks and
+    only combined (e.g. divided through by the weights for a weighted projection) once all chunks are done.
+
+    Smoothing lengths and densities cannot be correctly calculated from a single chunk, so they must be available
+    on disk, e.g. having been written out in an earlier session with ``f.gas['smooth'].write()``. The quantity and
+    any weighting must be specified by name. Chunks are loaded directly from disk, so any transformations applied to
+    the snapshot in memory are not reflected in the image.
+
+    Only file formats that support partial loading through the ``take`` keyword (e.g. tipsy and nchilada) can be
+    rendered in this way.
+    """
+
+    def __init__(self, sim: snapshot.SimSnap, chunk_size: int, pipeline_kwargs: dict): # noqa - no need to call super constructor
+        """Create a chunked renderer
+
+        Parameters
+        ----------
+        sim : snapshot.SimSnap
+            The snapshot, or a family or other sub-view of it, to be rendered. Its ancestor must have been loaded
+            from disk. Particle arrays do not need to be, and ideally should not be, loaded into memory.
+        chunk_size : int
+            The maximum number of particles to load at once.
+        pipeline_kwargs : dict
+            Keyword arguments to pass to :func:`make_render_pipeline` for each chunk.
+        """
+        for name in 'quantity', 'weight':
+            if isinstance(pipeline_kwargs.get(name), np.ndarray):
+                raise ValueError(f"The {name} for a chunked render must be specified by name, not as an array")
+
+        if getattr(sim.ancestor, 'filename', None) is None:
+            raise ValueError("A chunked render requires a snapshot that has been loaded from disk")
+
+        if chunk_size < 1:
+            raise ValueError("Chunk size must be at least one particle")
+
+        self._snapshot = sim
+        self._chunk_size = int(chunk_size)
+        self._pipeline_kwargs = pipeline_kwargs
+
+    def _chunk_index_lists(self):
+        sim = self._snapshot
+        ancestor = sim.ancestor
+
+        if sim is ancestor:
+            start, stop = 0, len(sim)
+        elif isinstance(sim, snapshot.FamilySubSnap):
+            family_slice = ancestor._get_family_slice(sim._unifamily)
+            start, stop = family_slice.start, family_slice.stop
+        else:
+            index_list = sim.get_index_list(ancestor)
+            for i in range(0, len(index_list), self._chunk_size):
+                yield index_list[i:i + self._chunk_size]
+            return
+
+        for i in range(start, stop, self._chunk_size):
+            yield np.arange(i, min(i + self._chunk_size, stop))
+
+    def _load_chunk(self, index_list):
+        ancestor = self._snapshot.ancestor
+        chunk = snapshot.load(ancestor.filename, take=index_list, priority=[type(ancestor)])
+        if isinstance(self._snapshot, snapshot.FamilySubSnap):
+            chunk = chunk[self._snapshot._unifamily]
+
+        with chunk.lazy_derive_off:
+            for name in 'smooth', 'rho':
+                try:
+                    chunk[name]
+                except KeyError:
+                    raise ValueError(f"A chunked render requires {name!r} to be available on disk; calculate and "
+                                     f"write it out (e.g. f.gas[{name!r}].write()) first") from None
+        return chunk
+
+    def render(self):
+        images = None
+        pipeline = None
+        for index_list in self._chunk_index_lists():
+            chunk = self._load_chunk(index_list)
+            pipeline = make_render_pipeline(chunk, **self._pipeline_kwargs)
+            components = pipeline._render_linear_components()
+            if images is None:
+                images = components
+            else:
+                for image, component in zip(images, components):
+                    image += component
+            del chunk
+
+        if pipeline is None:
+            raise ValueError("No particles to render")
+
+        result = pipeline._combine_linear_components(images)
+        if hasattr(result, 'sim'):
+            result.sim = self._snapshot
+        return result
+
+    def _chunked_pipeline_error(self, *args, **kwargs):
+        raise RenderPipelineLogicError("A chunked render pipeline cannot be modified; pass the required options to "
+                                       "make_render_pipeline instead.")
+
+    with_denoising = with_threading = with_approximate = _chunked_pipeline_error
+    with_weighted_projection = with_volume_weighted_projection = _chunked_pipeline_error
+
+
 class ImageRenderer(ImageRendererBase):
     """Implementation for rendering a simulation snapshot to 2d image"""
 
+    _supports_tiled_threading = True
+
     def _calculate_wrapping_repeat_array(self, x1, x2):
         if 'boxsize' in self._snapshot.properties:
             boxsize = self._snapshot.properties['boxsize'].in_units(self._snapshot['pos'].units,
@@ -643,14 +805,13 @@ class ImageRenderer(ImageRendererBase):
 
         return native_units
 
-    def render(self):
+    def _get_c_renderer_inputs(self):
+        """Return the kernel, particle arrays, output units and unit conversion factor for the C renderer"""
         kernel = kernels.create_kernel(self._kernel)
 
         if self._is_projected:
             kernel = kernel.projection()
 
-        g = self._geometry
-
         with self._snapshot.immediate_mode:
             if self._particle_array_slice is not None:
                 mass, rho, x, y, z, smooth = (self._snapshot[name][self._particle_array_slice]
@@ -672,7 +833,12 @@ class ImageRenderer(ImageRendererBase):
 
         smooth, array, mass, rho = (q.view(np.ndarray) for q in (smooth, array, mass, rho))
 
-        image = self._call_c_renderer(array, g, kernel, mass, rho, smooth, x, y, z)
+        return kernel, (array, mass, rho, smooth, x, y, z), out_units, conversion
+
+    def _render_linear_components(self):
+        kernel, (array, mass, rho, smooth, x, y, z), out_units, conversion = self._get_c_renderer_inputs()
+
+        image = self._call_c_renderer(array, self._geometry, kernel, mass, rho, smooth, x, y, z)
 
         if conversion != 1.0:
             image *= conversion
@@ -681,6 +847,13 @@ class ImageRenderer(ImageRendererBase):
         image.sim = self._snapshot
         image.units = out_units
 
+        return [image]
+
+    def _num_linear_components(self):
+        return 1
+
+    def _combine_linear_components(self, images):
+        image, = images
         return image
 
     def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array, z_array):
@@ -689,13 +862,16 @@ class ImageRenderer(ImageRendererBase):
                                      self._smooth_min, self._smooth_max, geometry.z1, geometry.z2,
                                      self._smooth_floor, kernel,
                                      self._calculate_wrapping_repeat_array(geometry.x1, geometry.x2),
-                                     self._calculate_wrapping_repeat_array(geometry.y1, geometry.y2))
+                                     self._calculate_wrapping_repeat_array(geometry.y1, geometry.y2),
+                                     num_threads=self._num_threads)
         return image
 
 
 class Grid3dRenderer(ImageRenderer):
     """Implementation for rendering a simulation snapshot to a 3d grid"""
 
+    _supports_tiled_threading = True
+
     def __init__(self, snap: snapshot.SimSnap):
         super().__init__(snap)
         self.geometry.restrict_z_range() # sets z1, z2 - here this is for the grid edges, not the camera
@@ -704,18 +880,53 @@ class Grid3dRenderer(ImageRenderer):
         super().set_width(width)
         self.geometry.restrict_z_range() # sets z1, z2 - here this is for the grid edges, not the camera
 
-    def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array, z_array):
+    def render_to(self, output, slab_thickness: int | NoneType = None):
+        """Render the grid directly into an existing array, without holding the whole grid in memory.
+
+        The grid is rendered in slabs along its first (x) axis, a few at a time, and each finished slab is written
+        straight into the output. This makes it possible to produce grids larger than the available memory.
+
+        Parameters
+        ----------
+        output : array-like
+            The array to write into, of shape (nx, ny, nz). It may be any object supporting assignment to slices
+            along its first axis, e.g. a numpy memmap or an h5py dataset. Its existing contents are overwritten. The
+            values are in the output units of this renderer; if the output has an ``attrs`` mapping (as for an h5py
+            dataset), these units are also stored as ``attrs['units']``.
+        slab_thickness : int, optional
+            The number of x-planes in each slab. The memory used for the grid is roughly slab_thickness * ny * nz
+            values per thread. If None, a quarter of the grid is rendered at a time.
+
+        Returns
+        -------
+        The output array.
+        """
+        kernel, (array, mass, rho, smooth, x, y, z), out_units, conversion = self._get_c_renderer_inputs()
+
+        self._call_c_renderer(array, self._geometry, kernel, mass, rho, smooth, x, y, z,
+                              output=output, slab_thickness=slab_thickness or 0, output_scale=conversion)
+
+        if hasattr(output, 'attrs'):
+            output.attrs['units'] = str(out_units)
+
+        return output
+
+    def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array, z_array,
+                         **kwargs):
         image = _render.to_3d_grid(geometry.nx, geometry.ny, geometry.nz, x_array, y_array, z_array,
                                    smooth_array, geometry.x1, geometry.x2, geometry.y1, geometry.y2, geometry.z1, geometry.z2,
                                    array, mass_array, rho_array, self._smooth_min, self._smooth_max, kernel,
                                    self._calculate_wrapping_repeat_array(geometry.x1, geometry.x2),
                                    self._calculate_wrapping_repeat_array(geometry.y1, geometry.y2),
-                                   self._calculate_wrapping_repeat_array(geometry.z1, geometry.z2))
+                                   self._calculate_wrapping_repeat_array(geometry.z1, geometry.z2),
+                                   num_threads=self._num_threads, **kwargs)
         return image
 
 class HealpixRenderer(ImageRenderer):
     """Implementation for rendering a simulation snapshot to healpix"""
 
+    _supports_tiled_threading = False
+
     def __init__(self, snap: snapshot.SimSnap):
         super().__init__(snap)
 
@@ -756,6 +967,7 @@ def make_render_pipeline(sim : snapshot.SimSnap, /,
                          approximate_fast: bool | NoneType = None,
                          denoise: bool | NoneType = None,
                          target: str = 'image',
+                         chunk_size: int | NoneType = None,
                          ) -> ImageRendererBase:
     """Generate a renderer object for rendering images of a simulation snapshot.
 
@@ -827,7 +1039,8 @@ def make_render_pipeline(sim : snapshot.SimSnap, /,
 
     threaded : bool, optional
         Whether to render the image across multiple threads. Yes if true; no if false. The number of threads to be
-        used is determined by the configuration file. If None, the use of threading is also determined by the
+        used, and whether 2d images are split into tiles between them (see :meth:`ImageRendererBase.with_threading`),
+        is determined by the configuration file. If None, the use of threading is also determined by the
         configuration file.
 
     approximate_fast : bool, optional
@@ -845,7 +1058,20 @@ def make_render_pipeline(sim : snapshot.SimSnap, /,
          * 'volume': a 3d cuboid
          * 'healpix': a healpix map
 
+    chunk_size : int, optional
+        If specified, the particles are streamed from disk this many at a time, rather than all being held in
+        memory. This allows very large snapshots to be rendered with bounded memory. The quantity and weight must
+        then be given by name, and smoothing lengths and densities must already be available on disk. For more
+        information see :class:`ChunkedImageRenderer`.
+
     """
+    if chunk_size is not None:
+        pipeline_kwargs = dict(quantity=quantity, width=width, resolution=resolution, nx=nx, ny=ny, nz=nz,
+                               nside=nside, out_units=out_units, weight=weight, restrict_depth=restrict_depth,
+                               kernel=kernel, smooth_floor=smooth_floor, z_camera=z_camera, threaded=threaded,
+                               approximate_fast=approximate_fast, denoise=denoise, target=target)
+        return ChunkedImageRenderer(sim, chunk_size, pipeline_kwargs)
+
     if resolution is None:
         resolution = config['image-default-resolution']
 
@@ -38,11 +38,26 @@ of course undone in the opposite order.
 
    As a consequence of this change, the system is also more strict about the order in which transformations are reverted.
    One cannot revert a transformation when another transformation has been applied after it (and not yet reverted).
+
+Deferred rotations
+------------------
+
+By default, a rotation immediately rewrites every (non-derived) 3D array in the simulation. If the ``deferred-rotation``
+option in the ``[general]`` section of the configuration is set to ``True`` (or ``deferred=True`` is passed to
+:class:`Rotation`), rotations of an entire snapshot are instead recorded, and successive rotations are composed into a
+single matrix. Each array is then rotated in place, in small blocks, the next time it is accessed through the
+snapshot. Arrays that are never accessed again (e.g. accelerations, during a sequence of
+:func:`~pynbody.analysis.angmom.faceon` and :func:`~pynbody.analysis.angmom.sideon` calls) are never rewritten,
+and a rotation that is reverted before the array is accessed costs nothing at all.
+
+Note that references to arrays obtained before a deferred rotation are only updated once the array is next accessed
+through the snapshot, e.g. as ``f['vel']``.
 """
 
 from __future__ import annotations
 
 import abc
+import contextlib
 import typing
 import weakref
 
@@ -52,7 +67,11 @@ if typing.TYPE_CHECKING:
 
 import numpy as np
 
-from . import util
+from . import units, util
+from .configuration import config
+
+# number of rows rotated at a time by _rotate_in_place; small enough for the block to stay in cache
+_ROTATION_BLOCK_SIZE = 8192
 
 
 class TransformationException(Exception):
@@ -396,10 +415,28 @@ class GenericTranslation(Transformation):
         super().__init__(f, description=description)
 
     def _apply_to_snapshot(self, f):
-        f[self.arname] += self.shift
+        with self._tree_preserving_context(f, self.shift):
+            f[self.arname] += self.shift
 
     def _unapply_to_snapshot(self, f):
-        f[self.arname] -= self.shift
+        with self._tree_preserving_context(f, -np.asanyarray(self.shift)):
+            f[self.arname] -= self.shift
+
+    def _tree_preserving_context(self, f, shift):
+        """Return a context in which a translation of the positions does not discard any kdtree"""
+        if self.arname != 'pos':
+            return contextlib.nullcontext()
+
+        array = f[self.arname]
+        if units.has_units(shift) and units.has_units(array):
+            # mirror the unit conversion applied by SimArray when adding the shift
+            context = {}
+            if hasattr(shift, 'conversion_context'):
+                context = shift.conversion_context()
+            context.update(array.conversion_context())
+            shift = np.asarray(shift) * shift.units.ratio(array.units, **context)
+
+        return f._rigid_transformation_of_positions(offset=np.asarray(shift, dtype=np.float64))
 
     def _apply_to_array(self, array):
         if array.name == self.arname:
@@ -409,7 +446,7 @@ class GenericTranslation(Transformation):
 class Rotation(Transformation):
     """A rotation on all 3d vectors in a simulation, by a given orthogonal 3x3 matrix"""
 
-    def __init__(self, f, matrix, ortho_tol=1.e-8, description = None):
+    def __init__(self, f, matrix, ortho_tol=1.e-8, description = None, deferred = None):
         """Initialise a rotation on a simulation.
 
         The matrix must be orthogonal to within *ortho_tol*.
@@ -429,6 +466,10 @@ class Rotation(Transformation):
         description: str
             A description of the rotation to be returned from str() and repr()
 
+        deferred: bool, optional
+            If True, and the rotation acts on an entire snapshot, each array is rotated only when next accessed
+            (see the :mod:`pynbody.transformation` documentation). If None, the ``deferred-rotation`` configuration
+            option is used.
 
         """
         # Check that the matrix is orthogonal
@@ -437,6 +478,9 @@ class Rotation(Transformation):
         if resid > ortho_tol or resid != resid:
             raise ValueError("Transformation matrix is not orthogonal")
         self.matrix = matrix
+        if deferred is None:
+            deferred = config['deferred-rotation']
+        self.deferred = deferred
         if description is None:
             description = "rotate"
         super().__init__(f, description=description)
@@ -452,6 +496,14 @@ class Rotation(Transformation):
 
         sim = self.sim
 
+        with sim._rigid_transformation_of_positions(matrix=matrix):
+            if self.deferred and sim is sim.ancestor:
+                sim._defer_rotation(matrix)
+            else:
+                self._transform_arrays(sim, matrix)
+
+    @staticmethod
+    def _transform_arrays(sim, matrix):
         # NB though it might seem more efficient to access _arrays and
         # _family_arrays directly, this would not work for SubSnaps.
         snapshot_keys = sim.keys()
@@ -477,6 +529,17 @@ class Rotation(Transformation):
 GenericRotation = Rotation # name from pynbody v1
 
 
+def _rotate_in_place(array, matrix):
+    """Rotate the Nx3 *array* in place by *matrix*, working in blocks so that no full-size temporary is needed.
+
+    No dirty flags are set on the array; it is the caller's responsibility to notify the snapshot if necessary."""
+    data = array.view(np.ndarray)
+    matrix_transposed = np.asarray(matrix).T
+    for start in range(0, len(data), _ROTATION_BLOCK_SIZE):
+        block = data[start:start + _ROTATION_BLOCK_SIZE]
+        block[:] = np.dot(block, matrix_transposed)
+
+
 @util.deprecated("This function is deprecated and will be removed in a future version. Use the translate method of a SimSnap object instead.")
 def translate(f, shift):
     """Deprecated alias for ``f.translate(shift)``"""
@@ -104,7 +104,9 @@ chunkscan = Extension('pynbody.chunk.scan',
 
 sph_render = Extension('pynbody.sph._render',
                   sources=['pynbody/sph/_render.pyx', 'pynbody/sph/healpix.c'],
-                  include_dirs=incdir)
+                  include_dirs=incdir,
+                  extra_compile_args=openmp_args,
+                  extra_link_args=extra_link_args)
 
 halo_pyx = Extension('pynbody.analysis._com',
                      sources=['pynbody/analysis/_com.pyx'],
@@ -60,6 +60,29 @@ def test_ahf_particles(do_load_all, cleanup_fpos_file):
     assert len(h[19])==3272
     assert(h[19]['iord'][::1000] == [232964, 341019, 752354, 793468]).all()
 
+@pytest.mark.parametrize("do_load_all", [True, False])
+def test_ahf_binary_cache(do_load_all):
+    cache_dir = "testdata/gasoline_ahf/g15784.lr.01024.z0.000.AHF_pynbody-cache"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    f = pynbody.load("testdata/gasoline_ahf/g15784.lr.01024")
+    h_reference = pynbody.halo.ahf.AHFCatalogue(f)
+
+    try:
+        for _ in range(2):
+            # first pass writes the cache, second pass reads it back
+            h = pynbody.halo.ahf.AHFCatalogue(f, binary_cache=True)
+            assert os.path.exists(cache_dir)
+            if do_load_all:
+                h.load_all()
+            assert len(h) == 1411
+            for key in 'Mvir', 'npart', 'hostHalo':
+                npt.assert_array_equal(h.get_properties_all_halos()[key],
+                                       h_reference.get_properties_all_halos()[key])
+            assert (h[0]['iord'][::10000] == h0_sample_iords).all()
+            npt.assert_array_equal(h[19]['iord'], h_reference[19]['iord'])
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
 def test_load_copy():
     f = pynbody.load("testdata/gasoline_ahf/g15784.lr.01024")
     h = pynbody.halo.ahf.AHFCatalogue(f)
@@ -287,6 +287,24 @@ def test_shared_arrays():
 
     assert pyn_array.shared.get_num_shared_arrays_owned() == baseline_num_shared_arrays
 
+def test_shared_array_strided_view():
+    """Test that a non-contiguous view of a shared array is reconstructed with the right layout"""
+    ar = pyn_array.array_factory((4, 3), dtype=np.float64, zeros=True, shared=True)
+    ar[:] = np.arange(12).reshape((4, 3))
+
+    column = ar[:, 1]
+    column2 = pyn_array.shared.unpack(pyn_array.shared.pack(column))
+
+    assert column2.strides == column.strides
+    npt.assert_equal(column2, [1, 4, 7, 10])
+
+    column2[:] = -1
+    npt.assert_equal(ar[:, 1], -1)
+    npt.assert_equal(ar[:, 0], [0, 3, 6, 9])
+
+    del ar, column, column2
+    gc.collect()
+
 def test_shared_array_ownership():
     """Test that we can have two copies of a shared array in a process, but that only the 'owner' cleans up the memory"""
 
@@ -1,4 +1,5 @@
 import numpy as np
+import numpy.testing as npt
 import pytest
 
 import pynbody
@@ -230,3 +231,21 @@ def test_fuzzy_match_halos(snapshot_pair):
     assert fuzzy_match_rev.keys() == set(f2['grp'])
 
     assert fuzzy_match_rev[1] == [(0, 2./3), (1, 1./3)]
+
+def test_sparse_particles_in_common(snapshot_pair):
+    f1, f2 = snapshot_pair
+    f1['grp'][::7] = -1 # some particles in no halo
+
+    b = pynbody.bridge.OrderBridge(f1, f2, monotonic=False)
+    h1 = pynbody.halo.number_array.HaloNumberCatalogue(f1, ignore=-1)
+    h2 = f2.halos()
+
+    dense = b.count_particles_in_common(h1, h2)
+    sparse = b.count_particles_in_common(h1, h2, sparse=True)
+
+    assert sparse.shape == dense.shape
+    assert sparse.nnz == np.count_nonzero(dense)
+    npt.assert_equal(sparse.toarray(), dense)
+
+    sparse_restricted = b.count_particles_in_common(h1, h2, max_num_halos=3, sparse=True)
+    npt.assert_equal(sparse_restricted.toarray(), b.count_particles_in_common(h1, h2, max_num_halos=3))
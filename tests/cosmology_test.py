@@ -29,3 +29,28 @@ def test_aform_saturation():
     assert tf[0]!=tf[0] # nan outside range
     assert tf[-1]!=tf[-1] # nan outside range
     assert (tf[1:-1]==tf[1:-1]).all() # no nans inside range
+
+
+@pytest.mark.filterwarnings("ignore:Assuming default value for property:RuntimeWarning")
+def test_cosmology_table():
+    """Test the tabulated forward and inverse transformations used for long arrays"""
+    f = pynbody.new()
+    ipoints = pynbody.analysis.cosmology._interp_points
+
+    z = np.array([0.0, 0.1, 1.0, 3.0, 10.0, 100.0])
+    z_long = np.resize(z, ipoints + 1)
+
+    npt.assert_allclose(pynbody.analysis.cosmology.age(f, z_long)[:len(z)],
+                        pynbody.analysis.cosmology.age(f, z), rtol=1e-6)
+    npt.assert_allclose(pynbody.analysis.cosmology.tau(f, z_long)[:len(z)],
+                        pynbody.analysis.cosmology.tau(f, z), rtol=1e-6, atol=1e-6)
+
+    t = pynbody.analysis.cosmology.age(f, z)
+    t_long = np.resize(t, ipoints + 1)
+    npt.assert_allclose(pynbody.analysis.cosmology.redshift(f, t_long)[:len(z)], z, rtol=1e-5, atol=1e-6)
+
+    assert pynbody.analysis.cosmology.get_cosmology_table(f) is pynbody.analysis.cosmology.get_cosmology_table(f)
+    f2 = pynbody.new()
+    f2.properties['omegaM0'] = 0.25
+    f2.properties['omegaL0'] = 0.75
+    assert pynbody.analysis.cosmology.get_cosmology_table(f) is not pynbody.analysis.cosmology.get_cosmology_table(f2)
@@ -1,4 +1,5 @@
 import gc
+import os
 import shutil
 
 import h5py
@@ -152,3 +153,111 @@ def test_arepo_style_units():
     with pytest.warns(UserWarning, match="Unable to infer units from HDF attributes"):
         assert f.st['EMP_BirthTemperature'].units == units.NoUnit()
     # here is a case where no unit information is recorded in the file (who knows why)
+
+
+def _make_spanned_gadgethdf(basename, ngas=(100, 50, 0, 70), ndm=(200, 150, 120, 90)):
+    np.random.seed(2)
+    iord = 0
+    for i in range(len(ndm)):
+        with h5py.File(f"{basename}.{i}.hdf5", "w") as f:
+            header = f.create_group("Header")
+            header.attrs['NumFilesPerSnapshot'] = len(ndm)
+            header.attrs['NumPart_ThisFile'] = np.array([ngas[i], ndm[i], 0, 0, 0, 0])
+            header.attrs['NumPart_Total'] = np.array([sum(ngas), sum(ndm), 0, 0, 0, 0])
+            header.attrs['NumPart_Total_HighWord'] = np.zeros(6, dtype=int)
+            header.attrs['MassTable'] = np.array([0, 0.5, 0, 0, 0, 0])
+            header.attrs['Time'] = 1.0
+            header.attrs['Redshift'] = 0.0
+            header.attrs['BoxSize'] = 10.0
+            header.attrs['Omega0'] = 0.3
+            header.attrs['OmegaLambda'] = 0.7
+            header.attrs['HubbleParam'] = 0.7
+            for particle_type, n in (0, ngas[i]), (1, ndm[i]):
+                group = f.create_group(f"PartType{particle_type}")
+                group['ParticleIDs'] = np.arange(iord, iord + n)
+                iord += n
+                group['Coordinates'] = np.random.uniform(0, 10, size=(n, 3))
+                group['Velocities'] = np.random.normal(size=(n, 3)).astype(np.float32)
+                if particle_type == 0:
+                    group['Masses'] = np.random.uniform(size=n)
+                    group['Density'] = np.random.uniform(size=n).astype(np.float32)
+
+
+@pytest.mark.filterwarnings("ignore:No unit information found:RuntimeWarning",
+                            "ignore:Unable to infer units:UserWarning")
+def test_parallel_read(tmp_path):
+    basename = str(tmp_path / "snap")
+    _make_spanned_gadgethdf(basename)
+
+    f_serial = pynbody.load(basename)
+    assert isinstance(f_serial, pynbody.snapshot.gadgethdf.GadgetHDFSnap)
+    for name in 'pos', 'vel', 'mass', 'iord':
+        f_serial[name]
+    f_serial.gas['rho']
+
+    previous = pynbody.config_parser.get('gadgethdf', 'parallel-read')
+    pynbody.config_parser.set('gadgethdf', 'parallel-read', '3')
+    try:
+        f_parallel = pynbody.load(basename)
+        for name in 'pos', 'vel', 'mass', 'iord':
+            npt.assert_equal(f_parallel[name], f_serial[name])
+        npt.assert_equal(f_parallel.gas['rho'], f_serial.gas['rho'])
+        npt.assert_equal(f_parallel.dm['vel'], f_serial.dm['vel'])
+    finally:
+        pynbody.config_parser.set('gadgethdf', 'parallel-read', previous)
+
+    assert f_serial.hdf_read_timings['pos']['readers'] == 1
+    assert f_parallel.hdf_read_timings['pos']['readers'] == 3
+    assert f_parallel.hdf_read_timings['pos']['files'] == 4
+    assert f_parallel.hdf_read_timings['pos']['bytes'] == f_parallel['pos'].nbytes
+
+
+@pytest.mark.filterwarnings("ignore:No unit information found:RuntimeWarning",
+                            "ignore:Unable to infer units:UserWarning")
+@pytest.mark.parametrize("take", [np.arange(80, 260), np.arange(200, 500), np.arange(0, 780, 7)])
+def test_partial_load(tmp_path, take):
+    basename = str(tmp_path / "snap")
+    _make_spanned_gadgethdf(basename)
+
+    f_full = pynbody.load(basename)
+    f_partial = pynbody.load(basename, take=take)
+
+    assert f_partial.partial_load
+    assert len(f_partial) == len(take)
+    assert len(f_partial.gas) == len(f_full[take].gas)
+
+    for name in 'pos', 'vel', 'mass', 'iord':
+        npt.assert_equal(f_partial[name], f_full[name][take])
+    npt.assert_equal(f_partial.gas['rho'], f_full[take].gas['rho'])
+
+    with pytest.raises(RuntimeError):
+        f_partial.write_array('pos')
+
+
+@pytest.mark.filterwarnings("ignore:No unit information found:RuntimeWarning",
+                            "ignore:Unable to infer units:UserWarning")
+def test_take_region(tmp_path):
+    basename = str(tmp_path / "snap")
+    _make_spanned_gadgethdf(basename)
+    pynbody.chunk.spatial_index.build_spatial_index(basename, nside=8)
+
+    region = pynbody.filt.Sphere(2.0, (3.0, 4.0, 5.0))
+    f_full = pynbody.load(basename)
+    f_region = pynbody.load(basename, take_region=region)
+
+    assert f_region.partial_load
+    assert len(f_region[region]) < len(f_region) < len(f_full)
+    for family in 'gas', 'dm':
+        exact = getattr(f_full, family)[region]
+        approx = getattr(f_region, family)[region]
+        npt.assert_equal(np.asarray(approx['iord']), np.asarray(exact['iord']))
+        npt.assert_equal(np.asarray(approx['pos']), np.asarray(exact['pos']))
+
+    with pytest.raises(ValueError):
+        pynbody.load(basename, take=[1, 2, 3], take_region=region)
+
+    # rewriting any one of the files invalidates the index
+    stat = os.stat(basename + ".2.hdf5")
+    os.utime(basename + ".2.hdf5", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    with pytest.raises(OSError, match="out of date"):
+        pynbody.load(basename, take_region=region)
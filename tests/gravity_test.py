@@ -73,3 +73,56 @@ def test_eps_retrieval_number():
                             -0.06739005, -0.06748439, -0.0695245,
                             -0.06803885, -0.0679833,  -0.07277965, -0.07189107])
     npt.assert_allclose(f['phi'][:10], true_phi_10)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_tree_matches_direct(dtype):
+    np.random.seed(1)
+    n = 5000
+    f = pynbody.new(n)
+    del f['pos']
+    del f['mass']
+    f['pos'] = np.random.normal(size=(n, 3)).astype(dtype)
+    f['mass'] = np.random.uniform(0.5, 1.5, n).astype(dtype)
+    f['eps'] = np.full(n, 0.01, dtype=dtype)
+    ipos = f['pos'].view(np.ndarray)[::10]
+
+    phi_direct, acc_direct = pynbody.gravity.direct(f, ipos)
+
+    # with zero opening angle, every cell is opened and the result is exact
+    phi_tree, acc_tree = pynbody.gravity.tree(f, ipos, theta=0.0)
+    npt.assert_allclose(phi_tree, phi_direct, rtol=1e-5)
+    npt.assert_allclose(acc_tree, acc_direct, rtol=1e-4, atol=1e-4 * abs(acc_direct).max())
+
+    phi_tree, acc_tree = pynbody.gravity.tree(f, ipos, theta=0.5)
+    npt.assert_allclose(phi_tree, phi_direct, rtol=1e-2)
+    acc_err = np.linalg.norm(acc_tree - acc_direct, axis=1) / np.linalg.norm(acc_direct, axis=1)
+    assert np.median(acc_err) < 1e-2
+
+    # the low-level routine uses the same default opening angle as the configuration
+    phi_default, acc_default = pynbody.gravity._gravity.tree(f, ipos)
+    phi_config, acc_config = pynbody.gravity._gravity.tree(f, ipos, theta=pynbody.config['gravity_opening_angle'])
+    npt.assert_array_equal(phi_default, phi_config)
+    npt.assert_array_equal(acc_default, acc_config)
+
+def test_gravity_calculation_mode():
+    f = pynbody.new(1000)
+    np.random.seed(2)
+    f['pos'] = np.random.normal(size=(1000, 3))
+    f['mass'] = np.ones(1000)
+    f['eps'] = np.full(1000, 0.05)
+    radii = np.linspace(0.1, 2.0, 5)
+
+    v_direct = pynbody.gravity.midplane_rot_curve(f, radii)
+
+    old_mode = pynbody.config['gravity_calculation_mode']
+    try:
+        pynbody.config['gravity_calculation_mode'] = 'tree'
+        v_tree = pynbody.gravity.midplane_rot_curve(f, radii)
+        pynbody.config['gravity_calculation_mode'] = 'nonsense'
+        with pytest.raises(ValueError):
+            pynbody.gravity.midplane_rot_curve(f, radii)
+    finally:
+        pynbody.config['gravity_calculation_mode'] = old_mode
+
+    npt.assert_allclose(v_tree, v_direct, rtol=1e-2)
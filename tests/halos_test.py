@@ -3,6 +3,7 @@
 import warnings
 
 import numpy as np
+import numpy.testing as npt
 import pytest
 
 import pynbody
@@ -408,3 +409,35 @@ def test_repr():
     f = pynbody.load("testdata/ramses/output_00080")
     halos = f.halos()
     assert repr(halos) == "<AdaptaHOPCatalogue, length 170>"
+
+
+def _halo_mass_and_centre(h):
+    return {'mass': h['mass'].sum(), 'centre': h['pos'].mean(axis=0), 'num_gas': len(h.gas)}
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_calculate_for_all_halos(snap_with_grp, processes):
+    f = snap_with_grp
+    f['pos'] = np.random.normal(size=(len(f), 3))
+    f['pos'].units = 'kpc'
+    f['mass'] = np.random.uniform(size=len(f))
+    f['mass'].units = 'Msol'
+    h = f.halos()
+
+    result = pynbody.analysis.halo.calculate_for_all_halos(h, _halo_mass_and_centre, ['mass', 'centre', 'num_gas'],
+                                                           processes=processes)
+
+    assert (result['halo_number'] == np.arange(10)).all()
+    assert result['mass'].units == 'Msol'
+    assert result['centre'].shape == (10, 3)
+    for i, halo_number in enumerate(result['halo_number']):
+        halo = h[halo_number]
+        npt.assert_allclose(result['mass'][i], halo['mass'].sum())
+        npt.assert_allclose(result['centre'][i], halo['pos'].mean(axis=0))
+        assert result['num_gas'][i] == len(halo.gas)
+
+
+def test_balance_halos_between_batches():
+    tasks = [(n, 0, length) for n, length in enumerate([100, 60, 50, 40, 10, 5])]
+    batches = pynbody.analysis.halo._balance_halos_between_batches(tasks, 2)
+    assert sorted(sum(t[2] - t[1] for t in b) for b in batches) == [125, 140]
+    assert sorted(t[0] for b in batches for t in b) == list(range(6))
@@ -64,3 +64,24 @@ def test_get_empirical_hmf(recwarn):
           3.99810849e-05])
     npt.assert_allclose(err, [1.48092011e-04, 8.53762344e-05, 5.53994163e-05, 4.45210519e-05,
           1.78800847e-05])
+
+
+@pytest.mark.parametrize("filter_class", [hmf.TophatFilter, hmf.GaussianFilter, hmf.HarmonicStepFilter])
+def test_batched_variance(recwarn, filter_class):
+    f = pynbody.new()
+    ps = hmf.PowerSpectrum(f)
+    f_filter = filter_class(f)
+
+    R = 10 ** np.linspace(-2.0, 1.0, 10)
+    expected = [hmf.variance(Ri, f_filter, ps, arg_is_R=True) for Ri in R]
+    npt.assert_allclose(hmf.variance(R, f_filter, ps, arg_is_R=True), expected, rtol=1e-4)
+
+    # the sigma(R) table is memoised on the power spectrum, and reused for further calls
+    assert len(ps._variance_tables) == 1
+    npt.assert_allclose(hmf.variance(R[::2], f_filter, ps, arg_is_R=True), expected[::2], rtol=1e-4)
+    assert len(ps._variance_tables) == 1
+
+    # scales outside the tabulated range are still evaluated directly (adaptive quadrature is not very accurate
+    # here for the harmonic step filter, hence the looser tolerance)
+    npt.assert_allclose(hmf.variance([1000.0], f_filter, ps, arg_is_R=True),
+                        hmf.variance(1000.0, f_filter, ps, arg_is_R=True), rtol=1e-2)
@@ -1,5 +1,6 @@
 import copy
 import gc
+import warnings
 from pathlib import Path
 
 import numpy as np
@@ -225,11 +226,13 @@ def test_div_curl_smoothing(div_curl):
     npt.assert_equal(f.g['vorticity'], f.g['v_curl'])
     assert f.g['vorticity'].units == f.g['vel'].units/f.g['pos'].units
 
-def test_kdtree_parallel_build():
+@pytest.mark.parametrize("num_threads", [2, 3, 4, 7])
+@pytest.mark.parametrize("npart", [5000, 600000]) # the larger case uses the parallel partition near the root
+def test_kdtree_parallel_build(num_threads, npart):
     """Check that parallel tree build results in identical tree to serial build."""
-    f = pynbody.new(dm=5000)
-    f['pos'] = np.random.uniform(size=(5000,3))
-    f['mass'] = np.random.uniform(size=5000)
+    f = pynbody.new(dm=npart)
+    f['pos'] = np.random.uniform(size=(npart,3))
+    f['mass'] = np.random.uniform(size=npart)
 
     f.build_tree(1)
     result_one_thread = f.kdtree.serialize()
@@ -238,9 +241,9 @@ def test_kdtree_parallel_build():
 
     del f.kdtree
 
-    f.build_tree(4)
-    result_four_threads = f.kdtree.serialize()
-    _, _, kdn4, poff4, _ = result_four_threads
+    f.build_tree(num_threads)
+    result_n_threads = f.kdtree.serialize()
+    _, _, kdn4, poff4, _ = result_n_threads
 
     assert (kdn1['pLower'] == kdn4['pLower']).all()
     assert (kdn1['pUpper'] == kdn4['pUpper']).all()
@@ -281,6 +284,190 @@ def test_particles_in_sphere(npart, offset, radius, dtype):
 
     assert (np.sort(particles) == np.sort(particles_compare)).all()
 
+@pytest.mark.parametrize("num_threads", [1, 3])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_particles_in_spheres(num_threads, dtype):
+    npart = 10000
+    f = pynbody.new(dm=npart)
+    f._create_array('pos', 3, dtype)
+    f._create_array('mass', 1, dtype)
+
+    np.random.seed(1337)
+    f['pos'] = np.random.uniform(low=-0.5, high=0.5, size=(npart, 3))
+    f['mass'] = np.random.uniform(size=npart)
+    f.properties['boxsize'] = 1.0
+    f.build_tree(num_threads)
+
+    centres = np.random.uniform(low=-0.5, high=0.5, size=(50, 3))
+    radii = np.random.uniform(0.0, 0.2, size=50)
+
+    offsets, indices = f.kdtree.particles_in_spheres(centres, radii)
+    assert len(offsets) == 51
+    assert offsets[-1] == len(indices)
+
+    for i, (cen, radius) in enumerate(zip(centres, radii)):
+        particles_compare = f.kdtree.particles_in_sphere(cen.astype(dtype), dtype(radius))
+        assert (np.sort(indices[offsets[i]:offsets[i+1]]) == np.sort(particles_compare)).all()
+
+    # a single radius is broadcast across all spheres
+    offsets, indices = f.kdtree.particles_in_spheres(centres, 0.1)
+    assert (np.sort(indices[offsets[3]:offsets[4]]) ==
+            np.sort(f.kdtree.particles_in_sphere(centres[3].astype(dtype), dtype(0.1)))).all()
+
+@pytest.mark.parametrize("boxsize", [None, 1.0])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_query(dtype, boxsize):
+    npart = 2000
+    f = pynbody.new(dm=npart)
+    f._create_array('pos', 3, dtype)
+    f._create_array('mass', 1, dtype)
+
+    np.random.seed(1337)
+    f['pos'] = np.random.uniform(low=-0.5, high=0.5, size=(npart, 3))
+    f['mass'] = np.random.uniform(size=npart)
+    if boxsize is not None:
+        f.properties['boxsize'] = boxsize
+    f.build_tree(3)
+
+    # some points lie outside the box, to check periodic wrapping
+    points = np.random.uniform(low=-0.6, high=0.6, size=(200, 3))
+    distances, indices = f.kdtree.query(points, 10)
+    assert distances.shape == indices.shape == (200, 10)
+    assert distances.dtype == dtype
+
+    offsets = points[:, np.newaxis, :] - np.asarray(f['pos'], dtype=np.float64)[np.newaxis, :, :]
+    if boxsize is not None:
+        offsets -= boxsize * np.round(offsets / boxsize)
+    all_distances = np.sqrt((offsets ** 2).sum(axis=-1))
+    indices_compare = np.argsort(all_distances, axis=1)[:, :10]
+
+    npt.assert_equal(indices, indices_compare)
+    npt.assert_allclose(distances, np.take_along_axis(all_distances, indices_compare, axis=1), rtol=1e-5)
+
+    with pytest.raises(ValueError):
+        f.kdtree.query(points, npart + 1)
+
+@pytest.mark.parametrize("num_threads", [1, 3])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_neighbour_cache(num_threads, dtype):
+    npart = 5000
+    np.random.seed(1337)
+    pos = np.random.uniform(low=-0.5, high=0.5, size=(npart, 3))
+    vel = np.random.normal(size=(npart, 3))
+
+    results = {}
+    for max_mb in 0, 100:
+        f = pynbody.new(gas=npart)
+        f._create_array('pos', 3, dtype)
+        f._create_array('vel', 3, dtype)
+        f._create_array('mass', 1, dtype)
+        f['pos'] = pos
+        f['vel'] = vel
+        f['mass'] = 1.0
+        f.properties['boxsize'] = 1.0
+        f.build_tree(num_threads)
+        f.kdtree.neighbour_cache_max_mb = max_mb
+        results[max_mb] = [f[name].copy() for name in ('rho', 'v_mean', 'v_disp', 'v_curl', 'v_div')]
+
+        if max_mb > 0:
+            offsets, indices, distances_squared = f.kdtree.neighbour_lists(pynbody.config['sph']['smooth-particles'])
+            assert f.kdtree._neighbour_cache is not None
+            assert len(offsets) == npart + 1
+            assert offsets[-1] == len(indices) == len(distances_squared)
+
+            # compare with a direct search for one particle
+            i = 100
+            particle = f.kdtree.particle_offsets[i]
+            neighbours = f.kdtree.particle_offsets[indices[offsets[i]:offsets[i+1]]]
+            compare = f.kdtree.particles_in_sphere(f['pos'][particle], 2 * f['smooth'][particle])
+            assert (np.sort(neighbours) == np.sort(compare)).all()
+
+        # changing the smoothing lengths in place must invalidate any cached neighbour lists
+        f['smooth'] *= 1.5
+        assert f.kdtree._neighbour_cache is None
+        results[max_mb] += [f[name].copy() for name in ('rho', 'v_mean', 'v_disp', 'v_curl', 'v_div')]
+
+    for uncached, cached in zip(results[0], results[100]):
+        npt.assert_array_equal(uncached, cached)
+
+def test_smooth_multiple_arrays():
+    npart = 5000
+    np.random.seed(1337)
+    f = pynbody.new(gas=npart)
+    f['pos'] = np.random.uniform(low=-0.5, high=0.5, size=(npart, 3))
+    f['mass'] = np.random.uniform(0.5, 1.0, size=npart)
+    f['temp'] = np.random.uniform(1e3, 1e5, size=npart)
+    f['temp'].units = 'K'
+    f['species'] = np.random.uniform(size=(npart, 6))
+
+    means = pynbody.sph.smooth_arrays(f, ['temp', 'species', 'vel'])
+    dispersions = pynbody.sph.smooth_arrays(f, ['temp', 'species'], operation='disp')
+
+    assert means[0].units == 'K'
+    assert means[1].shape == dispersions[1].shape == (npart, 6)
+    npt.assert_allclose(means[2], f['v_mean'], rtol=1e-6)
+
+    f.kdtree.set_array_ref('rho', f['rho'])
+    npt.assert_allclose(means[0], f.kdtree.sph_mean(f['temp'], 32), rtol=1e-6)
+    npt.assert_allclose(dispersions[0], f.kdtree.sph_dispersion(f['temp'], 32), rtol=1e-6)
+    for k in range(6):
+        column = np.ascontiguousarray(f['species'][:, k])
+        npt.assert_allclose(means[1][:, k], f.kdtree.sph_mean(column, 32), rtol=1e-6)
+        npt.assert_allclose(dispersions[1][:, k], f.kdtree.sph_dispersion(column, 32), rtol=1e-6)
+
+    # without separate_columns, the dispersions of all the columns are combined, however many there are
+    for ncol in 6, 2:
+        species = np.ascontiguousarray(f['species'][:, :ncol])
+        separate = f.kdtree.sph_dispersion(species, 32, separate_columns=True)
+        npt.assert_allclose(f.kdtree.sph_dispersion(species, 32), np.sqrt((separate ** 2).sum(axis=1)), rtol=1e-6)
+
+def test_kdtree_discarded_by_transformation():
+    f = _make_test_gaussian(1000)
+    f.build_tree()
+    with f.rotate_x(30):
+        assert not hasattr(f, 'kdtree')
+
+def test_kdtree_survives_rigid_transformation(monkeypatch):
+    monkeypatch.setitem(pynbody.config['sph'], 'tree-survives-transformation', True)
+    npart = 5000
+    np.random.seed(1337)
+    f = pynbody.new(gas=npart)
+    f['pos'] = np.random.uniform(low=-0.5, high=0.5, size=(npart, 3))
+    f['vel'] = np.random.normal(size=(npart, 3))
+    f['mass'] = np.random.uniform(0.5, 1.0, size=npart)
+    f.properties['boxsize'] = 1.0
+
+    smooth = f['smooth'].copy()
+    tree = f.kdtree
+    original_pos = f['pos'].view(np.ndarray).copy()
+    unrotated = {name: f[name].copy() for name in ('v_div', 'v_curl')}
+
+    with f.translate([0.1, -0.2, 0.3]).rotate_x(30).rotate_z(45) as transform:
+        assert f.kdtree is tree
+        npt.assert_array_equal(f['smooth'], smooth)
+
+        # periodicity is still respected, in the frame in which the tree was built
+        sphere = f.kdtree.particles_in_sphere(f['pos'][100], 0.1)
+        offsets = original_pos - original_pos[100]
+        offsets -= np.round(offsets)
+        assert np.sort(sphere).tolist() == np.where((offsets ** 2).sum(axis=1) < 0.01)[0].tolist()
+
+        distances, indices = f.kdtree.query(f['pos'][:10], 3)
+        assert (indices[:, 0] == np.arange(10)).all()
+        npt.assert_allclose(distances[:, 0], 0.0, atol=1e-8)
+
+        npt.assert_allclose(f['v_div'], unrotated['v_div'], atol=1e-6)
+        expected_curl = np.dot(transform.matrix, np.dot(
+            transform._previous_transformation.matrix, unrotated['v_curl'].T)).T
+        npt.assert_allclose(f['v_curl'], expected_curl, atol=1e-6)
+
+    assert f.kdtree is tree
+    npt.assert_allclose(f.kdtree.particles_in_sphere(f['pos'][100], 0.1).size, sphere.size)
+
+    # non-rigid changes to the positions must still discard the tree
+    f['pos'][0] += 0.01
+    assert not hasattr(f, 'kdtree')
+
 def test_kdtree_from_existing_kdtree(npart=1000):
     f = _make_test_gaussian(npart)
 
@@ -326,3 +513,57 @@ def test_boxsize_too_small():
     f.properties['boxsize'] = 0.1
     with pytest.warns(RuntimeWarning, match = "span a region larger than the specified boxsize"):
         _ = f['smooth']
+
+@pytest.fixture
+def snap_for_tree_cache(tmp_path):
+    f = pynbody.new(dm=5000)
+    np.random.seed(1337)
+    f['pos'] = np.random.normal(size=(5000, 3))
+    f['mass'] = np.random.uniform(size=5000)
+    f['vel'] = 0.0
+    f['eps'] = 0.01
+    f['phi'] = 0.0
+    f.properties['time'] = 1.0
+    filename = str(tmp_path / "tree_cache_test.tipsy")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        f.write(fmt=pynbody.snapshot.tipsy.TipsySnap, filename=filename)
+
+    def load():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return pynbody.load(filename)
+
+    yield filename, load
+
+def test_tree_cache(snap_for_tree_cache):
+    filename, load = snap_for_tree_cache
+    cache_dir = Path(filename + ".kdtree-cache")
+
+    f = load()
+    f.dm.build_tree(cache=False)
+    assert not cache_dir.exists()
+    smooth_nocache = f.dm['smooth']
+    rho_nocache = f.dm['rho']
+
+    f = load()
+    f.dm.build_tree(cache=True)
+    assert cache_dir.exists()
+    assert f.dm.kdtree.disk_cache is not None
+    npt.assert_allclose(f.dm['smooth'], smooth_nocache)
+    npt.assert_allclose(f.dm['rho'], rho_nocache)
+    assert len(list(cache_dir.glob("*.npy"))) == 4 # tree nodes, particle offsets, smooth, rho
+
+    f = load()
+    f.dm.build_tree(cache=True)
+    assert isinstance(f.dm.kdtree.kdnodes, np.memmap)
+    npt.assert_allclose(f.dm['smooth'], smooth_nocache)
+    npt.assert_allclose(f.dm['rho'], rho_nocache)
+    dm = f.dm
+    assert (dm[pynbody.filt.Sphere(0.5)].get_index_list(dm) == np.where(dm['r'] < 0.5)[0]).all()
+
+    # moving the particles invalidates the cache
+    f = load()
+    f['x'] += 1.0
+    f.dm.build_tree(cache=True)
+    assert not isinstance(f.dm.kdtree.kdnodes, np.memmap)
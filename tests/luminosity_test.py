@@ -1,5 +1,6 @@
 import warnings
 
+import numpy as np
 import numpy.testing as npt
 import pytest
 
@@ -131,3 +132,71 @@ def test_halo_half_light(testfile):
     pynbody.analysis.faceon(h[0])
     for (band, cylindrical), expected in expected_results.items():
         npt.assert_allclose(pynbody.analysis.luminosity.half_light_r(h[0], band, cylindrical=cylindrical), expected)
+
+
+def _reference_interpolation(table, ages, metallicities, band):
+    """Interpolate an SSP table with scipy, as SSPTable did before it evaluated the interpolation itself"""
+    from scipy.interpolate import RegularGridInterpolator
+
+    if isinstance(table, pynbody.analysis.luminosity.MultiSSPTable):
+        table = table._bandpass_to_table[band]
+
+    ages = table._clamp_value(np.copy(ages), table._ages)
+    metallicities = table._clamp_value(np.copy(metallicities), table._metallicities)
+    nan_mask = np.isnan(metallicities) | np.isnan(ages)
+    ages[nan_mask] = table._ages[0]
+    metallicities[nan_mask] = table._metallicities[0]
+    interpolator = RegularGridInterpolator((table._ages, table._metallicities), table._magnitudes[band].T,
+                                           method='linear', bounds_error=False, fill_value=np.nan)
+    result = interpolator(np.array([ages, metallicities]).T)
+    result[nan_mask] = np.nan
+    return result
+
+def test_multiband_interpolation():
+    np.random.seed(1)
+    ages = np.random.uniform(6.0, 11.0, 1000)
+    metallicities = np.log10(np.random.uniform(1e-4, 0.05, 1000))
+    ages[::50] = np.nan
+
+    table = pynbody.analysis.luminosity.get_current_ssp_table()
+    results = table.interpolate_bands(ages, metallicities, ['V', 'B', 'u'])
+    assert list(results.keys()) == ['V', 'B', 'u']
+    for band, result in results.items():
+        npt.assert_allclose(result, _reference_interpolation(table, ages, metallicities, band))
+    assert np.isnan(results['V'][::50]).all()
+
+    f = pynbody.new(star=1000)
+    f.properties['time'] = 14.0 * pynbody.units.Gyr
+    f['tform'] = pynbody.array.SimArray(np.random.uniform(0.0, 13.9, 1000), 'Gyr')
+    f['metals'] = np.random.uniform(1e-4, 0.05, 1000)
+    f['mass'] = pynbody.array.SimArray(np.random.uniform(1e4, 1e5, 1000), 'Msol')
+
+    mags = pynbody.analysis.luminosity.calc_mags(f, band=['V', 'B', 'u'])
+    for band in 'V', 'B', 'u':
+        npt.assert_allclose(mags[band], pynbody.analysis.luminosity.calc_mags(f, band=band))
+        npt.assert_allclose(mags[band], f[band + '_mag'])
+
+def test_render_interpolates_bands_together(monkeypatch):
+    np.random.seed(1)
+    f = pynbody.new(star=2000)
+    f['pos'] = np.random.normal(scale=2.0, size=(2000, 3))
+    f['pos'].units = 'kpc'
+    f.properties['time'] = 14.0 * pynbody.units.Gyr
+    f['tform'] = pynbody.array.SimArray(np.random.uniform(0.0, 13.9, 2000), 'Gyr')
+    f['metals'] = np.random.uniform(1e-4, 0.05, 2000)
+    f['mass'] = pynbody.array.SimArray(np.random.uniform(1e4, 1e5, 2000), 'Msol')
+
+    calls = []
+    get_weights = pynbody.analysis.luminosity.SSPTable._get_interpolation_weights
+    monkeypatch.setattr(pynbody.analysis.luminosity.SSPTable, '_get_interpolation_weights',
+                        lambda self, *args: calls.append(1) or get_weights(self, *args))
+
+    pynbody.plot.stars.render(f, width='10 kpc', resolution=50, noplot=True)
+    assert len(calls) == 1
+
+    for band in 'I', 'V', 'U':
+        npt.assert_allclose(f.s[band + '_mag'], pynbody.analysis.luminosity.calc_mags(f.s, band=band))
+
+    # the magnitudes derived together must each still depend on the stellar properties
+    f['metals'] *= 0.5
+    assert not any(band + '_mag' in f.s for band in ('I', 'V', 'U'))
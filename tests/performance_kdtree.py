@@ -66,6 +66,11 @@ with timer("cube queries without tree"):
         _ = snap[pynbody.filt.Cuboid(xc - s, yc - s, zc - s, xc + s, yc + s, zc + s)]
 
 
+for build_threads in (1, 2, 4, 8):
+    with timer(f"tree build with {build_threads} thread(s)"):
+        snap.build_tree(num_threads=build_threads)
+    del snap.kdtree
+
 with timer("tree build"):
     snap.build_tree(num_threads=num_threads)
 
@@ -77,6 +82,9 @@ with timer("sphere queries from tree"):
         sys.stdout.flush()
         _ = snap[pynbody.filt.Sphere(rad, cen)]
 
+with timer("batched sphere queries from tree"):
+    _ = snap.kdtree.particles_in_spheres(centres, radii)
+
 # with timer("cube queries from tree"):
 #     for xc, yc, zc, s in zip(xcs, ycs, zcs, radii):
 #         print(".", end="")
@@ -194,3 +194,28 @@ def test_quantile_profile(weight):
         # for where the cdf is 0.16 and 0.84
         expected_width *= 1.8724
     npt.assert_allclose(np.diff(pro['testquantity'], axis=1), expected_width, atol=2.5e-2)
+
+def test_vectorised_bin_statistics():
+    np.random.seed(1337)
+    Npart = 20000
+    f = pynbody.new(Npart)
+    f['pos'] = np.random.normal(size=(Npart, 3))
+    f['mass'] = np.random.uniform(0.5, 1.5, size=Npart)
+    f['testquantity'] = np.random.normal(size=Npart) + f['r']
+    p = pynbody.analysis.profile.Profile(f, nbins=30, ndim=3, rmax=3.0)
+
+    partbin = np.digitize(f['r'], p['bin_edges']) - 1
+    for i in range(p.nbins):
+        in_bin = np.where(partbin == i)[0]
+        npt.assert_equal(p.binind[i], in_bin)
+        assert p['npart_bins'][i] == len(in_bin)
+
+        mass = f['mass'][in_bin]
+        quantity = f['testquantity'][in_bin]
+        mean = (quantity * mass).sum() / mass.sum()
+        npt.assert_allclose(p['weight_fn'][i], mass.sum())
+        npt.assert_allclose(p['testquantity'][i], mean)
+        npt.assert_allclose(p['testquantity_rms'][i], np.sqrt((quantity ** 2 * mass).sum() / mass.sum()))
+        npt.assert_allclose(p['testquantity_disp'][i],
+                            np.sqrt((quantity ** 2 * mass).sum() / mass.sum() - mean ** 2))
+        assert p['testquantity_med'][i] == np.sort(quantity)[len(quantity) // 2]
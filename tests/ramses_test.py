@@ -1,4 +1,5 @@
 import os
+import shutil
 from pathlib import Path
 
 import numpy as np
@@ -386,6 +387,66 @@ def test_family_array(ramses_file):
     assert ramses_file.dm['mass'].sim == ramses_file.dm
 
 
+def test_amr_structure_cache():
+    path = "testdata/ramses/ramses_partial_output_00250"
+    cache_path = Path(os.path.abspath(path) + ".amr-cache")
+    shutil.rmtree(cache_path, ignore_errors=True)
+
+    reference = pynbody.load(path)
+
+    try:
+        for _ in range(2):
+            # first pass writes the cache, second pass reads it back
+            f = pynbody.load(path, amr_cache=True)
+            assert cache_path.is_dir()
+            assert len(f.gas) == len(reference.gas)
+            for name in 'pos', 'smooth', 'rho', 'cpu':
+                npt.assert_array_equal(f.gas[name], reference.gas[name])
+    finally:
+        shutil.rmtree(cache_path, ignore_errors=True)
+
+
+def test_hilbert_keys():
+    from pynbody.snapshot.ramses import _hilbert3d
+
+    nside = 8
+    ix, iy, iz = (x.ravel() for x in np.meshgrid(*[np.arange(nside)] * 3, indexing='ij'))
+    keys = _hilbert3d(ix, iy, iz, 3)
+    npt.assert_equal(np.sort(keys), np.arange(nside ** 3))
+
+    # successive keys must be neighbouring cells
+    order = np.argsort(keys)
+    steps = np.abs(np.diff(np.stack((ix, iy, iz))[:, order], axis=1)).sum(axis=0)
+    assert (steps == 1).all()
+
+    # keys at a coarser level must be the prefix of the finer keys
+    npt.assert_equal(_hilbert3d(ix >> 1, iy >> 1, iz >> 1, 2), keys >> 3)
+
+
+@pytest.mark.parametrize("region", [pynbody.filt.Sphere(0.05, (0.3, 0.6, 0.5)),
+                                    pynbody.filt.Cuboid(0.4, 0.4, 0.4, 0.5, 0.55, 0.6)])
+def test_take_region(region):
+    path = "testdata/ramses/output_00080"
+    f = pynbody.load(path)
+    f_sub = pynbody.load(path, take_region=region)
+
+    assert len(f_sub._cpus) < len(f._cpus)
+    assert len(f_sub.gas) < len(f.gas)
+
+    # the selection must be a superset of the exact selection, and reduce to it when filtered
+    for family in 'gas', 'dm':
+        exact = getattr(f, family)[region]
+        approx = getattr(f_sub, family)[region]
+        assert len(approx) == len(exact)
+        order_exact = np.lexsort(exact['pos'].T)
+        order_approx = np.lexsort(approx['pos'].T)
+        npt.assert_equal(approx['pos'][order_approx], exact['pos'][order_exact])
+        npt.assert_equal(approx['mass'][order_approx], exact['mass'][order_exact])
+
+    with pytest.raises(ValueError):
+        pynbody.load(path, cpus=[1, 2], take_region=region)
+
+
 def test_file_descriptor_reading():
     f = pynbody.load("testdata/ramses/prop_time_output_00030")
 
@@ -0,0 +1,71 @@
+import os
+import warnings
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import pynbody
+import pynbody.chunk.spatial_index
+import pynbody.snapshot.tipsy
+
+
+@pytest.fixture
+def indexed_tipsy_file(tmp_path):
+    np.random.seed(1)
+    f = pynbody.new(dm=3000, gas=1000)
+    f['pos'] = np.random.normal(scale=1.0, size=f['pos'].shape)
+    f['vel'] = np.random.normal(size=f['vel'].shape)
+    f['mass'] = np.random.uniform(1.0, 2.0, size=len(f))
+    f['eps'] = 0.01
+    f['phi'] = 0.0
+    f.gas['temp'] = 1e4
+    f.gas['metals'] = 0.0
+    f.properties['time'] = 1.0
+    filename = str(tmp_path / "indexed.tipsy")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        f.write(fmt=pynbody.snapshot.tipsy.TipsySnap, filename=filename)
+
+    pynbody.chunk.spatial_index.build_spatial_index(filename, nside=8)
+    return filename
+
+
+@pytest.mark.filterwarnings("ignore:No readable param file:RuntimeWarning")
+@pytest.mark.parametrize("region", [pynbody.filt.Sphere(0.5, (0.2, -0.3, 0.1)),
+                                    pynbody.filt.Cuboid(-0.2, -0.3, -0.4, 0.5, 0.1, 0.3),
+                                    pynbody.filt.Sphere(1.0, (20.0, 20.0, 20.0))])
+def test_take_region(indexed_tipsy_file, region):
+    f = pynbody.load(indexed_tipsy_file)
+    f_sub = pynbody.load(indexed_tipsy_file, take_region=region)
+
+    assert len(f_sub) < len(f)
+    assert len(f_sub.gas) + len(f_sub.dm) == len(f_sub)
+
+    # the cell-level selection must be a superset of the exact selection, and must reduce to it when filtered
+    for family in 'gas', 'dm':
+        exact = getattr(f, family)[region]
+        approx = getattr(f_sub, family)[region]
+        assert len(approx) == len(exact)
+        order_exact = np.argsort(exact['mass'])
+        order_approx = np.argsort(approx['mass'])
+        npt.assert_equal(approx['mass'][order_approx], exact['mass'][order_exact])
+        npt.assert_equal(approx['pos'][order_approx], exact['pos'][order_exact])
+
+
+@pytest.mark.filterwarnings("ignore:No readable param file:RuntimeWarning")
+def test_take_region_errors(indexed_tipsy_file):
+    region = pynbody.filt.Sphere(0.5, (0.0, 0.0, 0.0))
+
+    with pytest.raises(ValueError):
+        pynbody.load(indexed_tipsy_file, take=[1, 2, 3], take_region=region)
+
+    # modifying the snapshot invalidates the index
+    stat = os.stat(indexed_tipsy_file)
+    os.utime(indexed_tipsy_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    with pytest.raises(OSError, match="out of date"):
+        pynbody.load(indexed_tipsy_file, take_region=region)
+
+    os.remove(pynbody.chunk.spatial_index.index_filename(indexed_tipsy_file))
+    with pytest.raises(OSError, match="No spatial index"):
+        pynbody.load(indexed_tipsy_file, take_region=region)
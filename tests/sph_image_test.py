@@ -1,5 +1,7 @@
+import warnings
 from pathlib import Path
 
+import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 import numpy.testing as npt
@@ -202,6 +204,53 @@ def test_projection_average(simple_test_file):
     npt.assert_allclose(im_collapsed, answer, atol=0.3)
 
 
+@pytest.mark.parametrize("options", [{}, {'z_camera': 5.0}, {'out_units': 'Msol kpc^-3'},
+                                     {'nx': 123, 'ny': 301}, {'resolution': 10}])
+def test_tiled_threaded_render(simple_test_file, options):
+    f = simple_test_file
+    options = {'quantity': 'rho', 'width': 3.0, 'resolution': 200,
+               'approximate_fast': False, 'denoise': False} | options
+
+    serial = renderers.make_render_pipeline(f, threaded=False, **options)
+    tiled = serial.with_threading(4, tiled=True)
+    copies = serial.with_threading(4, tiled=False)
+
+    assert not isinstance(tiled, renderers.ThreadedImageRenderer)
+    assert isinstance(copies, renderers.ThreadedImageRenderer)
+
+    serial_image = serial.render()
+
+    # tiles sum each pixel's contributions in the same order as the serial renderer
+    npt.assert_array_equal(tiled.render(), serial_image)
+    npt.assert_allclose(copies.render(), serial_image, rtol=1e-5, atol=1e-6 * serial_image.max())
+
+
+def test_3d_grid_slabs(simple_test_file, tmp_path):
+    f = simple_test_file
+    options = {'quantity': 'rho', 'width': 3.0, 'nx': 30, 'ny': 30, 'nz': 30, 'approximate_fast': False,
+               'denoise': False, 'out_units': 'Msol kpc^-3'}
+
+    serial = pynbody.sph.render_3d_grid(f, threaded=False, **options)
+    renderer = renderers.make_render_pipeline(f, threaded=False, target='volume', **options)
+    npt.assert_array_equal(renderer.with_threading(4, tiled=True).render(), serial)
+
+    output = np.lib.format.open_memmap(tmp_path / "grid.npy", mode='w+', dtype=np.float32, shape=(30, 30, 30))
+    assert pynbody.sph.render_3d_grid(f, threaded=True, output=output, slab_thickness=4, **options) is output
+    npt.assert_allclose(output, serial, rtol=1e-6)
+
+    with h5py.File(tmp_path / "grid.hdf5", "w") as h5:
+        dataset = h5.create_dataset("grid", shape=(30, 30, 30), dtype=np.float32)
+        pynbody.sph.render_3d_grid(f, threaded=False, output=dataset, **options)
+        npt.assert_allclose(dataset[:], serial, rtol=1e-6)
+        assert pynbody.units.Unit(dataset.attrs['units']) == serial.units
+
+    with pytest.raises(ValueError, match="shape"):
+        pynbody.sph.render_3d_grid(f, output=np.zeros((30, 30, 29), dtype=np.float32), **options)
+
+    with pytest.raises(ValueError, match="not available"):
+        pynbody.sph.render_3d_grid(f, output=output, **(options | {'approximate_fast': True}))
+
+
 def test_spherical_render(simple_test_file):
     f = simple_test_file
 
@@ -282,3 +331,56 @@ def test_render_stars_spherical(snap):
                                  [0.31345788, 0.2856903, 0.18001786],
                                  [0.27264443, 0.22463608, 0.07668419]],
                         atol = 1e-3)
+
+@pytest.fixture
+def tipsy_file_with_smoothing(tmp_path):
+    npart = 3000
+    f = pynbody.new(gas=npart, dm=1000)
+    np.random.seed(1337)
+    f['pos'] = np.random.normal(size=(len(f), 3))
+    f['mass'] = np.random.uniform(size=len(f))
+    f['vel'] = 0.0
+    f['eps'] = 0.01
+    f['phi'] = 0.0
+    f.gas['temp'] = np.random.uniform(1e3, 1e5, size=npart)
+    f.gas['metals'] = 0.0
+    f.gas['rho'] # calculate the SPH density and smoothing length, so that both are written to disk below
+    f.properties['time'] = 1.0
+    filename = str(tmp_path / "chunked_render.tipsy")
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        f.write(fmt=pynbody.snapshot.tipsy.TipsySnap, filename=filename)
+
+    yield filename
+
+
+@pytest.mark.filterwarnings("ignore:No readable param file:RuntimeWarning")
+@pytest.mark.filterwarnings("ignore:invalid value encountered in divide:RuntimeWarning") # empty pixels when weighting
+@pytest.mark.parametrize("options", [{}, {'threaded': True}, {'approximate_fast': True, 'resolution': 400},
+                                     {'quantity': 'temp', 'weight': 'rho'},
+                                     {'quantity': 'temp', 'denoise': True},
+                                     {'out_units': 'Msol kpc^-2'}, {'target': 'volume', 'resolution': 20}])
+def test_chunked_render(tipsy_file_with_smoothing, options):
+    options = {'quantity': 'rho', 'width': 4.0} | options
+    full = renderers.make_render_pipeline(pynbody.load(tipsy_file_with_smoothing).gas, **options).render()
+
+    f = pynbody.load(tipsy_file_with_smoothing)
+    renderer = renderers.make_render_pipeline(f.gas, chunk_size=700, **options)
+    assert isinstance(renderer, renderers.ChunkedImageRenderer)
+    chunked = renderer.render()
+
+    assert 'pos' not in f.keys() # particles were never loaded into the snapshot
+    assert chunked.units == full.units
+    npt.assert_allclose(chunked, full, rtol=1e-4, atol=1e-5 * np.nanmax(np.abs(full)))
+
+@pytest.mark.filterwarnings("ignore:No readable param file:RuntimeWarning")
+def test_chunked_render_requirements(tipsy_file_with_smoothing):
+    f = pynbody.load(tipsy_file_with_smoothing)
+
+    # no densities are on disk for the dark matter
+    with pytest.raises(ValueError, match="available on disk"):
+        renderers.make_render_pipeline(f.dm, quantity='rho', width=4.0, chunk_size=700).render()
+
+    with pytest.raises(ValueError, match="by name"):
+        renderers.make_render_pipeline(f.gas, quantity=np.ones(len(f.gas)), width=4.0, chunk_size=700)
@@ -226,3 +226,20 @@ def test_eps_array(snap_arepo, snap):
     assert np.allclose(snap_arepo['eps'][[0,-1000,-1]],[0.0025, 0.0005, 0.04])
     assert snap['eps'].units == '3.085678e+24 cm a h^-1'
     assert snap_arepo['eps'].units == '3.085678e+24 cm a h^-1'
+
+
+@pytest.mark.filterwarnings("ignore:Masses are either stored")
+@pytest.mark.filterwarnings("ignore:Incorrect number of ")
+def test_load_copy_tng_halos():
+    f = pynbody.load("testdata/arepo/tng/snapdir_261/snap_261")
+    h = f.halos()
+
+    h1 = h.load_copy(1)
+    assert h1.partial_load
+    assert len(h1) == len(h[1])
+    assert len(h1.dm) == len(h[1].dm)
+    assert (h1['iord'] == h[1]['iord']).all()
+    assert np.allclose(h1['pos'], h[1]['pos'])
+
+    sub = h[1].subhalos.load_copy(3)
+    assert (sub['iord'] == h[1].subhalos[3]['iord']).all()
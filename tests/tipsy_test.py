@@ -429,3 +429,77 @@ def test_load_without_paramfile(no_paramfile_snap):
         f = pynbody.load(no_paramfile_snap)
         assert isinstance(f, pynbody.snapshot.tipsy.TipsySnap)
         assert len(f) == 1717156
+
+
+def _make_native_tipsy_file(filename, **family_lengths):
+    np.random.seed(1)
+    f = pynbody.new(**family_lengths)
+    f['pos'] = np.random.normal(size=f['pos'].shape)
+    f['vel'] = np.random.normal(size=f['vel'].shape)
+    f['mass'] = np.random.uniform(size=len(f))
+    f['eps'] = 0.01
+    f['phi'] = np.random.normal(size=len(f))
+    f.properties['time'] = 1.0
+    for fam in f.families():
+        f[fam]['metals'] = np.random.uniform(size=len(f[fam]))
+        if fam is pynbody.family.gas:
+            f.gas['temp'] = np.random.uniform(size=len(f.gas))
+            f.gas['rho'] = np.random.uniform(size=len(f.gas))
+        if fam is pynbody.family.star:
+            f.star['tform'] = np.random.uniform(size=len(f.star))
+    f['my_aux'] = np.random.uniform(size=len(f))
+
+    f._byteswap = False # write in native byte order, so that memory mapping is possible
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        f.write(fmt=pynbody.snapshot.tipsy.TipsySnap, filename=filename, binary_aux_arrays=True)
+
+
+@pytest.mark.filterwarnings("ignore:No readable param file:RuntimeWarning")
+@pytest.mark.parametrize("family_lengths", [dict(dm=1000), dict(gas=500, dm=1000, star=300)])
+def test_memmap(tmp_path, family_lengths):
+    filename = str(tmp_path / "native.tipsy")
+    _make_native_tipsy_file(filename, **family_lengths)
+
+    f_read = pynbody.load(filename)
+    f_mapped = pynbody.load(filename, memmap=True)
+
+    for name in 'pos', 'vel', 'mass', 'eps', 'phi', 'my_aux':
+        npt.assert_equal(f_mapped[name], f_read[name])
+        assert f_mapped[name].units == f_read[name].units
+
+    for fam in f_read.families():
+        for name in f_read[fam].loadable_keys():
+            npt.assert_allclose(f_mapped[fam][name], f_read[fam][name], rtol=1e-6)
+
+    assert isinstance(f_mapped['my_aux'].base, np.memmap)
+    if len(f_read.families()) == 1:
+        assert isinstance(f_mapped['pos'].base, np.memmap)
+        assert np.shares_memory(f_mapped['x'], f_mapped['pos'])
+
+    # copy-on-write: changes are visible in memory but not written to disk
+    f_mapped['pos'] *= 2
+    f_mapped['my_aux'] += 1
+    f_reread = pynbody.load(filename, memmap=True)
+    npt.assert_equal(f_reread['pos'], f_read['pos'])
+    npt.assert_equal(f_reread['my_aux'], f_read['my_aux'])
+
+    f_readonly = pynbody.load(filename, memmap='r')
+    assert not f_readonly['my_aux'].flags['WRITEABLE']
+
+
+@pytest.mark.filterwarnings("ignore:No readable param file:RuntimeWarning")
+def test_memmap_fallback(tmp_path):
+    filename = str(tmp_path / "native.tipsy")
+    _make_native_tipsy_file(filename, dm=1000)
+
+    f_read = pynbody.load(filename)
+
+    # a partial load cannot be memory-mapped, so is read normally
+    f_partial = pynbody.load(filename, memmap=True, take=np.arange(10, 500, 3))
+    npt.assert_equal(f_partial['pos'], f_read['pos'][10:500:3])
+    npt.assert_equal(f_partial['my_aux'], f_read['my_aux'][10:500:3])
+    assert not isinstance(f_partial['pos'].base, np.memmap)
+
+    with pytest.raises(ValueError):
+        pynbody.load(filename, memmap='w')
@@ -340,3 +340,42 @@ def test_apply_move_to_subsnap():
 
     # the following would fail
     tx = f[subindex].translate([1,0,0])
+
+def test_deferred_rotation(monkeypatch):
+    monkeypatch.setitem(pynbody.config, 'deferred-rotation', True)
+    monkeypatch.setitem(pynbody.config['sph'], 'tree-survives-transformation', True)
+    np.random.seed(1)
+    f = pynbody.new(dm=500, gas=500)
+    for name in 'pos', 'vel', 'acc':
+        f[name] = np.random.normal(size=(1000, 3))
+    f['mass'] = np.ones(1000)
+    f.gas['gas_only_3d'] = np.random.normal(size=(500, 3))
+    original = {name: f[name].copy() for name in ('pos', 'vel', 'acc')}
+    original_gas_only = f.gas['gas_only_3d'].copy()
+
+    f.build_tree()
+    tree = f.kdtree
+
+    with f.rotate_x(90).rotate_z(90) as tx:
+        matrix = np.dot(tx.matrix, tx._previous_transformation.matrix)
+        assert set(f._pending_rotations.keys()) == {('pos', None), ('vel', None), ('acc', None),
+                                                    ('gas_only_3d', pynbody.family.gas)}
+
+        # accessing a 1D slice, or a sub-snapshot, causes the full array to be rotated
+        npt.assert_allclose(f.dm['y'], np.dot(original['pos'], matrix.T)[:500, 1])
+        assert ('pos', None) not in f._pending_rotations
+        npt.assert_allclose(f['pos'], np.dot(original['pos'], matrix.T))
+        npt.assert_allclose(f.gas['gas_only_3d'], np.dot(original_gas_only, matrix.T))
+
+        # writing into an array first applies the rotation
+        f['acc'][0] = 0.0
+        npt.assert_allclose(f['acc'][1:], np.dot(original['acc'], matrix.T)[1:])
+
+        assert f.kdtree is tree
+
+    # velocities were never accessed, so the rotation and its inverse cancel without touching the array
+    assert ('vel', None) not in f._pending_rotations
+    npt.assert_array_equal(f['vel'], original['vel'])
+    npt.assert_allclose(f['pos'], original['pos'], atol=1e-12)
+    npt.assert_allclose(f['acc'][1:], original['acc'][1:], atol=1e-12)
+    assert f.kdtree is tree